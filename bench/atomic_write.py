@@ -0,0 +1,114 @@
+"""Benchmark the file-write strategies used by the backend.
+
+Compares the pre-existing behaviour (in-place writes, fixed ".tmp" rename without fsync)
+with main.atomic_write with and without fsync and with group commit, both sequentially
+and with concurrent writers into one directory. Prints one JSON document.
+
+    python bench/atomic_write.py --files 200 --size 4096 --threads 8
+"""
+import argparse, json, os, shutil, statistics, sys, tempfile, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+
+
+def legacy_in_place(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def legacy_tmp_rename(path: str, data: bytes):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def atomic_nofsync(path: str, data: bytes):
+    main.atomic_write(path, data, fsync=False)
+
+
+def atomic_fsync(path: str, data: bytes):
+    main.atomic_write(path, data, fsync=True)
+
+
+STRATEGIES = {
+    "legacy_in_place": (legacy_in_place, False),
+    "legacy_tmp_rename": (legacy_tmp_rename, False),
+    "atomic_nofsync": (atomic_nofsync, False),
+    "atomic_fsync": (atomic_fsync, False),
+    "atomic_fsync_group_commit": (atomic_fsync, True),
+}
+
+
+def _pct(sorted_ms, q):
+    if not sorted_ms:
+        return 0.0
+    return sorted_ms[min(len(sorted_ms) - 1, int(round(q * (len(sorted_ms) - 1))))]
+
+
+def run(fn, group: bool, workdir: str, files: int, size: int, threads: int):
+    os.makedirs(workdir, exist_ok=True)
+    data = os.urandom(size)
+    latencies = []
+    lock = threading.Lock()
+    main.ATOMIC_GROUP_COMMIT = group
+
+    def worker(idx: int):
+        mine = []
+        for i in range(idx, files, threads):
+            t0 = time.perf_counter()
+            fn(os.path.join(workdir, f"f{i % 32}.bin"), data)   # overwrite a small working set
+            mine.append((time.perf_counter() - t0) * 1000.0)
+        with lock:
+            latencies.extend(mine)
+
+    t0 = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    latencies.sort()
+    return {
+        "writes": len(latencies),
+        "seconds": round(elapsed, 4),
+        "writes_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(statistics.fmean(latencies), 3) if latencies else 0.0,
+        "p50_ms": round(_pct(latencies, 0.50), 3),
+        "p95_ms": round(_pct(latencies, 0.95), 3),
+        "p99_ms": round(_pct(latencies, 0.99), 3),
+    }
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--files", type=int, default=200, help="writes per strategy and concurrency level")
+    ap.add_argument("--size", type=int, default=4096, help="bytes per write")
+    ap.add_argument("--threads", type=int, default=8, help="concurrent writers for the burst run")
+    ap.add_argument("--dir", default=None, help="directory to write in (default: a temp dir; use the real data volume)")
+    ap.add_argument("--only", default="", help="comma-separated strategy names")
+    args = ap.parse_args()
+
+    base = tempfile.mkdtemp(prefix="atomic-bench-", dir=args.dir)
+    names = [n for n in (args.only.split(",") if args.only else STRATEGIES) if n]
+    results = {}
+    try:
+        for name in names:
+            fn, group = STRATEGIES[name]
+            results[name] = {
+                "sequential": run(fn, group, os.path.join(base, name, "seq"), args.files, args.size, 1),
+                f"threads_{args.threads}": run(fn, group, os.path.join(base, name, "par"), args.files, args.size, args.threads),
+            }
+    finally:
+        main.ATOMIC_GROUP_COMMIT = False
+        shutil.rmtree(base, ignore_errors=True)
+    print(json.dumps({
+        "params": {"files": args.files, "size": args.size, "threads": args.threads, "dir": args.dir or tempfile.gettempdir()},
+        "results": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,375 @@
+"""Offline load test of the backend against a stub chat-completions server.
+
+Builds a synthetic workspace and chat histories in a temp data dir, starts bench/stub_llm.py
+and the app (uvicorn main:app) as subprocesses wired together through OLLAMA_BASE_URL, then
+drives each scenario at each concurrency level and prints one JSON document with p50/p95/p99
+latency, throughput and server RSS.
+
+    python bench/load.py --files 10000 --chats 200 --history 100 --concurrency 1,8,32 --duration 20
+    python bench/load.py --files 1000 --requests 200 --out run.json --baseline previous.json
+
+Scenarios:
+    message   POST .../message; the stub answers with search_text + list_files, then read_file
+              (--llm-latency-ms per model call), then a text reply
+    search    POST .../message whose only tool call is a search_text for a random token, with
+              zero model latency, so the turn time is dominated by the search itself
+    files     read 50% / list 20% / tree 10% / write 20% (writes go to bench_out/, 64 slots)
+    chats     GET .../chats (api_list_chats) over the synthetic chat index
+"""
+import argparse, asyncio, json, os, platform, random, shutil, socket, statistics, subprocess, sys, tempfile, threading, time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+import synth  # noqa: E402
+
+SCENARIOS = ("message", "search", "files", "chats")
+SCRIPTS = {
+    "agent": {"steps": [
+        [{"name": "search_text", "arguments": {"query": "token_{n}", "max_results": 20}},
+         {"name": "list_files", "arguments": {"path": "", "depth": 2}}],
+        [{"name": "read_file", "arguments": {"path": "{file}"}}],
+    ]},
+    "search": {"latency_ms": 0, "steps": [
+        [{"name": "search_text", "arguments": {"query": "token_{n}", "max_results": 50}}],
+    ]},
+}
+FILE_OPS = (("read", 50), ("list", 20), ("tree", 10), ("write", 20))
+
+
+def _pct(sorted_ms, q):
+    if not sorted_ms:
+        return 0.0
+    return sorted_ms[min(len(sorted_ms) - 1, int(round(q * (len(sorted_ms) - 1))))]
+
+
+def _summary(lat_ms, errors: int, seconds: float):
+    lat_ms = sorted(lat_ms)
+    return {
+        "requests": len(lat_ms),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "rps": round(len(lat_ms) / seconds, 2) if seconds else 0.0,
+        "mean_ms": round(statistics.fmean(lat_ms), 3) if lat_ms else 0.0,
+        "p50_ms": round(_pct(lat_ms, 0.50), 3),
+        "p95_ms": round(_pct(lat_ms, 0.95), 3),
+        "p99_ms": round(_pct(lat_ms, 0.99), 3),
+        "max_ms": round(lat_ms[-1], 3) if lat_ms else 0.0,
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rss_kb(pid: int) -> int:
+    """VmRSS of a process plus its descendants (uvicorn workers), in KiB; 0 where /proc is missing."""
+    total, todo = 0, [pid]
+    while todo:
+        p = todo.pop()
+        try:
+            with open(f"/proc/{p}/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+            with open(f"/proc/{p}/task/{p}/children", "r") as f:
+                todo.extend(int(c) for c in f.read().split())
+        except (OSError, ValueError):
+            pass
+    return total
+
+
+class RssSampler:
+    def __init__(self, pid: int, interval: float = 0.1):
+        self.pid, self.interval = pid, interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _rss_kb(self.pid))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start_kb = _rss_kb(self.pid)
+        self.peak = self.start_kb
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.end_kb = _rss_kb(self.pid)
+        self.peak = max(self.peak, self.end_kb)
+
+    def result(self):
+        return {"start_mb": round(self.start_kb / 1024, 1), "end_mb": round(self.end_kb / 1024, 1), "peak_mb": round(self.peak / 1024, 1)}
+
+
+def _spawn(args, env, cwd, log_path):
+    log = open(log_path, "wb")
+    return subprocess.Popen(args, env=env, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+
+
+def _wait_http(url: str, proc, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"process exited with {proc.returncode} before {url} came up")
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"timed out waiting for {url}")
+
+
+def _stop(proc):
+    if proc and proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def _git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def setup(workdir: str, args):
+    """Project, workspace and chats, written in-process into workdir/data (the server's data dir)."""
+    cwd = os.getcwd()
+    os.chdir(workdir)   # main resolves DATA_DIR from the cwd at import time
+    try:
+        sys.path.insert(0, REPO_DIR)
+        import main
+        ws = os.path.join(workdir, "workspace")
+        t0 = time.perf_counter()
+        info = synth.make_workspace(ws, args.files, args.binary_ratio, seed=args.seed)
+        t_ws = time.perf_counter() - t0
+        pid = main.api_create_project(main.ProjectCreate(name="bench", model="ollama:stub", root=ws))["project"]["id"]
+        t0 = time.perf_counter()
+        cids = synth.make_chats(main, pid, args.chats, args.history, seed=args.seed)
+        t_chats = time.perf_counter() - t0
+    finally:
+        os.chdir(cwd)
+    return pid, info, cids, {
+        "workspace_s": round(t_ws, 3), "workspace_bytes": info["bytes"], "text_files": len(info["text"]),
+        "binary_files": len(info["binary"]), "dirs": len(info["dirs"]), "chats_s": round(t_chats, 3),
+    }
+
+
+class Driver:
+    def __init__(self, client: httpx.AsyncClient, pid: str, info, cids, seed: int):
+        self.client, self.pid, self.info = client, pid, info
+        self.rng = random.Random(seed)
+        self.text = info["text"]
+        self.dirs = [""] + info["dirs"]
+        self.cids = cids
+        self.msg_seq = 0
+
+    def _chat(self, worker: int) -> str:
+        # One chat per worker: concurrent turns on one chat would serialize on its lock.
+        return self.cids[worker % len(self.cids)]
+
+    def _message_request(self, worker: int, script: str):
+        self.msg_seq += 1
+        content = f"[bench:{script}] request {self.msg_seq}: look at {self.rng.choice(self.text)}"
+        return "message", ("POST", f"/projects/{self.pid}/chats/{self._chat(worker)}/message", {"json": {"content": content}})
+
+    def request(self, scenario: str, worker: int):
+        """(op name, (method, url, kwargs)) for the next request of a scenario."""
+        if scenario == "message":
+            return self._message_request(worker, "agent")
+        if scenario == "search":
+            return self._message_request(worker, "search")
+        if scenario == "chats":
+            return "chats", ("GET", f"/projects/{self.pid}/chats", {"params": {"limit": 50}})
+        op = self.rng.choices([o for o, _ in FILE_OPS], [w for _, w in FILE_OPS])[0]
+        base = f"/projects/{self.pid}/files"
+        if op == "read":
+            return op, ("POST", base + "/read", {"json": {"path": self.rng.choice(self.text)}})
+        if op == "list":
+            return op, ("GET", base + "/list", {"params": {"path": self.rng.choice(self.dirs)}})
+        if op == "tree":
+            return op, ("GET", base + "/tree", {"params": {"path": self.rng.choice(self.dirs), "depth": 2, "limit": 500}})
+        body = "x" * self.rng.randint(200, 8192)
+        return op, ("POST", base + "/write", {"json": {"path": f"bench_out/w{self.rng.randrange(64)}.txt", "content": body}})
+
+    async def one(self, scenario: str, worker: int):
+        op, (method, url, kw) = self.request(scenario, worker)
+        t0 = time.perf_counter()
+        try:
+            r = await self.client.request(method, url, **kw)
+            ok = r.status_code < 400
+        except httpx.HTTPError:
+            ok = False
+        return op, (time.perf_counter() - t0) * 1000.0, ok
+
+
+async def run_level(driver: Driver, scenario: str, concurrency: int, duration: float, requests: int):
+    lat, per_op = [], {}
+    errors = [0]
+    remaining = [requests]
+    deadline = time.perf_counter() + duration if not requests else None
+
+    async def worker(idx: int):
+        while True:
+            if deadline is not None:
+                if time.perf_counter() >= deadline:
+                    return
+            else:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            op, ms, ok = await driver.one(scenario, idx)
+            if not ok:
+                errors[0] += 1
+                per_op.setdefault(op, ([], [0]))[1][0] += 1
+                continue
+            lat.append(ms)
+            per_op.setdefault(op, ([], [0]))[0].append(ms)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    out = _summary(lat, errors[0], elapsed)
+    if len(per_op) > 1:
+        out["ops"] = {op: _summary(ms, err[0], elapsed) for op, (ms, err) in sorted(per_op.items())}
+    return out
+
+
+async def drive(base_url: str, server_pid: int, pid: str, info, cids, args):
+    results = {}
+    limits = httpx.Limits(max_connections=max(args.concurrency) + 4, max_keepalive_connections=max(args.concurrency) + 4)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        driver = Driver(client, pid, info, cids, args.seed)
+        for scenario in args.scenarios:
+            # First request pays one-off costs (search index build, caches); reported, not measured.
+            _op, warm_ms, warm_ok = await driver.one(scenario, 0)
+            results[scenario] = {"warmup_ms": round(warm_ms, 3), "warmup_ok": warm_ok, "levels": {}}
+            for c in args.concurrency:
+                with RssSampler(server_pid) as rss:
+                    level = await run_level(driver, scenario, c, args.duration, args.requests)
+                level["rss"] = rss.result()
+                results[scenario]["levels"][str(c)] = level
+    return results
+
+
+def compare(results, baseline):
+    """Percent change against a previous run's results for the latency and throughput figures."""
+    out = {}
+    for scenario, res in results.items():
+        for level, cur in res["levels"].items():
+            old = ((baseline.get(scenario) or {}).get("levels") or {}).get(level)
+            if not old:
+                continue
+            out.setdefault(scenario, {})[level] = {
+                k: round((cur[k] - old[k]) * 100.0 / old[k], 1)
+                for k in ("rps", "p50_ms", "p95_ms", "p99_ms")
+                if old.get(k)
+            }
+            if old.get("rss", {}).get("peak_mb"):
+                out[scenario][level]["rss_peak_mb"] = round((cur["rss"]["peak_mb"] - old["rss"]["peak_mb"]) * 100.0 / old["rss"]["peak_mb"], 1)
+    return out
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--files", type=int, default=1000, help="workspace size (files)")
+    ap.add_argument("--binary-ratio", type=float, default=0.2)
+    ap.add_argument("--chats", type=int, default=50)
+    ap.add_argument("--history", type=int, default=40, help="messages per chat")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS))
+    ap.add_argument("--concurrency", default="1,8,32", help="comma-separated levels")
+    ap.add_argument("--duration", type=float, default=10.0, help="seconds per scenario and level")
+    ap.add_argument("--requests", type=int, default=0, help="fixed request count per level instead of --duration")
+    ap.add_argument("--llm-latency-ms", type=float, default=50.0)
+    ap.add_argument("--llm-jitter-ms", type=float, default=0.0)
+    ap.add_argument("--timeout", type=float, default=120.0, help="per-request client timeout (s)")
+    ap.add_argument("--workers", type=int, default=1, help="uvicorn workers for the app")
+    ap.add_argument("--server-env", action="append", default=[], metavar="K=V", help="extra env for the app (repeatable)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--dir", default=None, help="where to create the work dir (default: system temp)")
+    ap.add_argument("--keep", action="store_true", help="keep the work dir (data, workspace, server logs)")
+    ap.add_argument("--out", default=None, help="also write the JSON document to this file")
+    ap.add_argument("--baseline", default=None, help="previous --out file to compare against")
+    args = ap.parse_args()
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        ap.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix="load-bench-", dir=args.dir)
+    stub = server = None
+    try:
+        pid, info, cids, setup_info = setup(workdir, args)
+        # The stub cannot see the workspace, so read_file gets a fixed existing path.
+        scripts = json.loads(json.dumps(SCRIPTS).replace("{file}", info["text"][0] if info["text"] else "missing.txt"))
+
+        stub_port, app_port = _free_port(), _free_port()
+        env = dict(os.environ)
+        env.update({
+            "STUB_LATENCY_MS": str(args.llm_latency_ms), "STUB_JITTER_MS": str(args.llm_jitter_ms),
+            "STUB_SCRIPTS": json.dumps(scripts),
+        })
+        stub = _spawn([sys.executable, "-m", "uvicorn", "stub_llm:app", "--app-dir", BENCH_DIR,
+                       "--port", str(stub_port), "--log-level", "warning"], env, workdir, os.path.join(workdir, "stub.log"))
+
+        env = dict(os.environ)
+        env.update({"OLLAMA_BASE_URL": f"http://127.0.0.1:{stub_port}", "OLLAMA_SUPPORTS_TOOLS": "1", "PUBLIC_DEMO": "0"})
+        if args.workers > 1:
+            env.setdefault("LOCKS_CROSS_PROCESS", "1")
+        env.update(kv.split("=", 1) for kv in args.server_env)
+        server = _spawn([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", REPO_DIR, "--port", str(app_port),
+                         "--workers", str(args.workers), "--log-level", "warning"], env, workdir, os.path.join(workdir, "server.log"))
+        t0 = time.perf_counter()
+        _wait_http(f"http://127.0.0.1:{stub_port}/stats", stub)
+        _wait_http(f"http://127.0.0.1:{app_port}/health", server)
+        setup_info["server_start_s"] = round(time.perf_counter() - t0, 3)
+
+        results = asyncio.run(drive(f"http://127.0.0.1:{app_port}", server.pid, pid, info, cids, args))
+        stub_stats = httpx.get(f"http://127.0.0.1:{stub_port}/stats", timeout=5).json()
+    finally:
+        _stop(server)
+        _stop(stub)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    doc = {
+        "params": {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "keep", "dir")},
+        "env": {
+            "python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+            "git_rev": _git_rev(), "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "setup": setup_info,
+        "stub": stub_stats,
+        "results": results,
+    }
+    if args.keep:
+        doc["workdir"] = workdir
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            doc["vs_baseline"] = compare(results, json.load(f).get("results") or {})
+    text = json.dumps(doc, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,146 @@
+"""Stub OpenAI-compatible chat-completions server for benchmarks.
+
+Answers POST /v1/chat/completions (plain and streamed) after a configurable latency, with
+scripted tool calls, so the backend's agent loop can be driven offline. Point the app at it
+with OLLAMA_BASE_URL=http://127.0.0.1:<port> OLLAMA_SUPPORTS_TOOLS=1 and a project model
+of "ollama:stub".
+
+Scripts are chosen per turn by a "[bench:<name>]" tag in the latest user message. A script
+is a list of steps, each a list of tool calls; once the steps are used up (or when the
+request carries no tools) the stub replies with text. Steps are counted from the assistant
+tool-call messages after the latest user message. String arguments may contain "{n}", which
+is replaced by a random integer below 997 (the synthetic workspaces' token range).
+
+    python bench/stub_llm.py --port 8799 --latency-ms 50 --scripts scripts.json
+
+    scripts.json: {"agent": {"steps": [[{"name": "search_text", "arguments": {"query": "x"}}]]},
+                   "search": {"latency_ms": 0, "steps": [...]}}
+
+Configuration is read from the environment at import (STUB_LATENCY_MS, STUB_JITTER_MS,
+STUB_REPLY_CHARS, STUB_SCRIPTS as JSON) so it also works as `uvicorn stub_llm:app`.
+"""
+import argparse, asyncio, json, os, random, re
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+LATENCY_MS = float(os.environ.get("STUB_LATENCY_MS", "0") or 0)
+JITTER_MS = float(os.environ.get("STUB_JITTER_MS", "0") or 0)
+REPLY_CHARS = int(os.environ.get("STUB_REPLY_CHARS", "400") or 400)
+SCRIPTS = json.loads(os.environ.get("STUB_SCRIPTS", "") or "{}")
+STREAM_CHUNK_CHARS = 16
+_TAG_RE = re.compile(r"\[bench:([\w-]+)\]")
+_STATS = {"requests": 0, "streamed": 0, "tool_steps": 0}
+
+
+def _turn(messages):
+    """(script name, step index) for the current agent turn."""
+    last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=-1)
+    content = str(messages[last_user].get("content") or "") if last_user >= 0 else ""
+    tag = _TAG_RE.search(content)
+    step = sum(1 for m in messages[last_user + 1:] if m.get("role") == "assistant" and m.get("tool_calls"))
+    return (tag.group(1) if tag else ""), step
+
+
+def _fill(value):
+    if isinstance(value, str):
+        return value.replace("{n}", str(random.randrange(997)))
+    if isinstance(value, dict):
+        return {k: _fill(v) for k, v in value.items()}
+    return value
+
+
+def _reply_text(n: int) -> str:
+    words = ("the", "file", "search", "result", "shows", "that", "module", "calls", "config", "value")
+    out, size = [], 0
+    while size < n:
+        w = random.choice(words)
+        out.append(w)
+        size += len(w) + 1
+    return " ".join(out)[:n]
+
+
+def _respond(body):
+    messages = body.get("messages") or []
+    name, step = _turn(messages)
+    script = SCRIPTS.get(name) or {}
+    steps = script.get("steps") or []
+    latency = float(script.get("latency_ms", LATENCY_MS))
+    if body.get("tools") and step < len(steps):
+        calls = [
+            {"id": f"call_{step}_{i}", "type": "function",
+             "function": {"name": c["name"], "arguments": json.dumps(_fill(c.get("arguments") or {}))}}
+            for i, c in enumerate(steps[step])
+        ]
+        msg = {"role": "assistant", "content": None, "tool_calls": calls}
+        _STATS["tool_steps"] += 1
+    else:
+        msg = {"role": "assistant", "content": _reply_text(REPLY_CHARS)}
+    prompt_chars = sum(len(str(m.get("content") or "")) for m in messages)
+    usage = {
+        "prompt_tokens": prompt_chars // 4,
+        "completion_tokens": len(msg.get("content") or "") // 4 + 8 * len(msg.get("tool_calls") or []),
+    }
+    delay = max(0.0, latency + (random.uniform(-JITTER_MS, JITTER_MS) if JITTER_MS else 0.0)) / 1000.0
+    return msg, usage, delay
+
+
+async def chat_completions(request: Request):
+    body = await request.json()
+    msg, usage, delay = _respond(body)
+    _STATS["requests"] += 1
+    model = body.get("model") or "stub"
+    if not body.get("stream"):
+        await asyncio.sleep(delay)
+        return JSONResponse({
+            "id": "chatcmpl-stub", "object": "chat.completion", "model": model,
+            "choices": [{"index": 0, "message": msg, "finish_reason": "tool_calls" if msg.get("tool_calls") else "stop"}],
+            "usage": usage,
+        })
+
+    _STATS["streamed"] += 1
+
+    async def events():
+        # Latency is spent before the first chunk (time to first token), like a real provider.
+        await asyncio.sleep(delay)
+        if msg.get("tool_calls"):
+            deltas = [{"tool_calls": [{**tc, "index": i} for i, tc in enumerate(msg["tool_calls"])]}]
+        else:
+            text = msg["content"]
+            deltas = [{"content": text[i:i + STREAM_CHUNK_CHARS]} for i in range(0, len(text), STREAM_CHUNK_CHARS)]
+        for d in deltas:
+            yield "data: " + json.dumps({"object": "chat.completion.chunk", "model": model, "choices": [{"index": 0, "delta": d}]}) + "\n\n"
+        yield "data: " + json.dumps({"object": "chat.completion.chunk", "model": model, "choices": [], "usage": usage}) + "\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+async def stats(request: Request):
+    return JSONResponse(_STATS)
+
+
+app = Starlette(routes=[
+    Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+    Route("/stats", stats, methods=["GET"]),
+])
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8799)
+    ap.add_argument("--latency-ms", type=float, default=LATENCY_MS)
+    ap.add_argument("--jitter-ms", type=float, default=JITTER_MS)
+    ap.add_argument("--reply-chars", type=int, default=REPLY_CHARS)
+    ap.add_argument("--scripts", default=None, help="JSON file with named scripts")
+    args = ap.parse_args()
+    LATENCY_MS, JITTER_MS, REPLY_CHARS = args.latency_ms, args.jitter_ms, args.reply_chars
+    if args.scripts:
+        with open(args.scripts, "r", encoding="utf-8") as f:
+            SCRIPTS = json.load(f)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,98 @@
+"""Synthetic workspaces and chat histories for the benchmarks.
+
+    python bench/synth.py workspace /tmp/ws --files 10000 --binary-ratio 0.2
+
+Workspaces are deterministic for a given seed: text files (.py/.md/.txt/.js, 200 B - 8 KB)
+carry searchable tokens "token_<n>" (n < 997) plus one "needle" line per 100 files, and
+binary files (.bin/.png, 512 B - 8 KB) start with a NUL so the backend skips them as binary.
+"""
+import argparse, json, os, random, sys, time
+
+TEXT_EXTS = (".py", ".md", ".txt", ".js")
+BINARY_EXTS = (".bin", ".png")
+TOKENS = 997
+_WORDS = ("alpha", "beta", "gamma", "delta", "config", "handler", "request", "value", "index", "cache",
+          "render", "parse", "import", "return", "self", "data", "path", "state", "error", "result")
+
+
+def _text(rng: random.Random, i: int, size: int) -> str:
+    lines, n = [f"# file {i} token_{i % TOKENS}"], 0
+    if i % 100 == 0:
+        lines.append(f"needle_{i // 100} = True")
+    while n < size:
+        line = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(4, 12)))
+        if rng.random() < 0.1:
+            line += f" token_{rng.randrange(TOKENS)}"
+        lines.append(line)
+        n += len(line) + 1
+    return "\n".join(lines) + "\n"
+
+
+def make_workspace(root: str, files: int, binary_ratio: float = 0.2, per_dir: int = 100, seed: int = 1):
+    """Writes `files` files under `root`, `per_dir` per directory, two directory levels deep."""
+    rng = random.Random(seed)
+    out = {"text": [], "binary": [], "dirs": set(), "bytes": 0}
+    for i in range(files):
+        d = i // per_dir
+        rel_dir = f"pkg{d // 100:03d}/mod{d % 100:02d}"
+        if rel_dir not in out["dirs"]:
+            os.makedirs(os.path.join(root, rel_dir), exist_ok=True)
+            out["dirs"].add(rel_dir)
+        if rng.random() < binary_ratio:
+            rel = f"{rel_dir}/blob{i}{rng.choice(BINARY_EXTS)}"
+            data = b"\x00" + rng.randbytes(rng.randint(512, 8192) - 1)
+            out["binary"].append(rel)
+        else:
+            rel = f"{rel_dir}/file{i}{rng.choice(TEXT_EXTS)}"
+            data = _text(rng, i, rng.randint(200, 8192)).encode("utf-8")
+            out["text"].append(rel)
+        with open(os.path.join(root, rel), "wb") as f:
+            f.write(data)
+        out["bytes"] += len(data)
+    out["dirs"] = sorted(out["dirs"])
+    return out
+
+
+def make_chats(main, pid: str, chats: int, history: int, seed: int = 1):
+    """Creates `chats` chats with `history` alternating user/assistant messages each (through main's chat store)."""
+    rng = random.Random(seed)
+    cids = []
+    for c in range(chats):
+        cid = f"bench{c:05d}"
+        main.chat_create(pid, cid, f"Bench chat {c}")
+        batch = []
+        for m in range(history):
+            words = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(8, 80)))
+            batch.append({"role": "user" if m % 2 == 0 else "assistant", "content": words, "ts": main.now_iso()})
+            if len(batch) == 50:
+                main.chat_append(pid, cid, batch)
+                batch = []
+        if batch:
+            main.chat_append(pid, cid, batch)
+        cids.append(cid)
+    return cids
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ws = sub.add_parser("workspace", help="write a synthetic workspace")
+    ws.add_argument("root")
+    ws.add_argument("--files", type=int, default=1000)
+    ws.add_argument("--binary-ratio", type=float, default=0.2)
+    ws.add_argument("--per-dir", type=int, default=100)
+    ws.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    info = make_workspace(args.root, args.files, args.binary_ratio, args.per_dir, args.seed)
+    json.dump({
+        "root": os.path.abspath(args.root), "files": args.files, "text": len(info["text"]),
+        "binary": len(info["binary"]), "dirs": len(info["dirs"]), "bytes": info["bytes"],
+        "seconds": round(time.perf_counter() - t0, 3),
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -161,6 +161,15 @@ async function demoApi(path, opts = {}) {
     }
   }
 
+  // Chat fetch
+  const mChatGet = p.match(/^\/projects\/([^/]+)\/chats\/([^/]+)$/);
+  if (mChatGet && method === "GET") {
+    if (decodeURIComponent(mChatGet[1]) !== pid) throw new Error("Demo: unknown project");
+    const chat = findChat(store, decodeURIComponent(mChatGet[2]));
+    if (!chat) throw new Error("Demo: unknown chat");
+    return { chat };
+  }
+
   // Chat delete
   const mChatDel = p.match(/^\/projects\/([^/]+)\/chats\/([^/]+)$/);
   if (mChatDel && method === "DELETE") {
@@ -235,6 +244,37 @@ async function api(path, opts = {}) {
   return await res.text();
 }
 
+// NDJSON streaming POST: calls onEvent(obj) for every line as it arrives.
+async function apiStream(path, body, onEvent) {
+  const base = String(process.env.REACT_APP_API_BASE || "").replace(/\/+$/, "");
+  const url = (base ? base : "") + path;
+  const res = await fetch(url, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(body),
+  });
+  if (!res.ok || !res.body) {
+    const text = await res.text().catch(() => "");
+    throw new Error(text || res.statusText || `HTTP ${res.status}`);
+  }
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = "";
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buf += decoder.decode(value, { stream: true });
+    let nl;
+    while ((nl = buf.indexOf("\n")) >= 0) {
+      const line = buf.slice(0, nl).trim();
+      buf = buf.slice(nl + 1);
+      if (line) onEvent(JSON.parse(line));
+    }
+  }
+  if (buf.trim()) onEvent(JSON.parse(buf.trim()));
+}
+
 
 
 
@@ -546,6 +586,28 @@ useEffect(() => {
   // eslint-disable-next-line react-hooks/exhaustive-deps
 }, [pid, view, cid, chatTitleOverrides]);
 
+// Workspace changes (including edits made outside the app) are pushed by the server;
+// refresh the file count and root listing once a burst of changes has settled.
+useEffect(() => {
+  if (DEMO_MODE || !pid || typeof EventSource === "undefined") return;
+  const base = String(process.env.REACT_APP_API_BASE || "").replace(/\/+$/, "");
+  const es = new EventSource(`${base}/projects/${pid}/files/events`);
+  let timer = null, rootChanged = false;
+  es.addEventListener("change", (e) => {
+    let ev = {};
+    try { ev = JSON.parse(e.data); } catch {}
+    rootChanged = rootChanged || ev.full || (ev.paths || []).some(p => !p.includes("/"));
+    clearTimeout(timer);
+    timer = setTimeout(() => {
+      recountFiles();
+      if (rootChanged) listRootFiles();
+      rootChanged = false;
+    }, 300);
+  });
+  return () => { clearTimeout(timer); es.close(); };
+  // eslint-disable-next-line react-hooks/exhaustive-deps
+}, [pid]);
+
 useEffect(() => {
   if (!pid || !cid) return;
 
@@ -555,11 +617,14 @@ useEffect(() => {
   if (hasTypingPlaceholder) return;
 
   (async () => {
-    const res = await api(`/projects/${pid}/chats`);
+    const [res, one] = await Promise.all([
+      api(`/projects/${pid}/chats`),
+      api(`/projects/${pid}/chats/${cid}`).catch(() => null),
+    ]);
     const list = (res.chats || []).map(c => ({
       ...c, title: chatTitleOverrides[`${pid}:${c.id}`] || c.title
     }));
-    const found = list.find((c) => c.id === cid) || { messages: [] };
+    const found = one?.chat ? { ...one.chat, messages: one.chat.messages || [] } : { messages: [] };
     setChats(list);
     setChat(found);
     setTimeout(() => endRef.current?.scrollIntoView({ behavior: "smooth" }), 50);
@@ -682,12 +747,34 @@ async function send() {
 
   setLoading(true);
   try {
-    const res = await api(`/projects/${targetPid}/chats/${activeChatId}/message`, {
-      method: "POST",
-      body: { content }
-    });
-    // Stream into the existing assistant placeholder
-    streamIntoLastAssistant(res.reply || "");
+    if (DEMO_MODE) {
+      const res = await api(`/projects/${targetPid}/chats/${activeChatId}/message`, {
+        method: "POST",
+        body: { content }
+      });
+      // Stream into the existing assistant placeholder
+      streamIntoLastAssistant(res.reply || "");
+    } else {
+      // Relay server-side token deltas straight into the assistant placeholder
+      let text = "";
+      const setLastAssistant = (value) => setChat((c) => {
+        const msgs = [...(c.messages || [])];
+        for (let k = msgs.length - 1; k >= 0; k--) {
+          if (msgs[k].role === "assistant") { msgs[k] = { ...msgs[k], content: value }; break; }
+        }
+        return { ...c, messages: msgs };
+      });
+      setIsStreaming(true);
+      try {
+        await apiStream(`/projects/${targetPid}/chats/${activeChatId}/message/stream`, { content }, (ev) => {
+          if (ev.type === "delta") { text += ev.content || ""; setLastAssistant(text); }
+          else if (ev.type === "done") { text = ev.reply || text; setLastAssistant(text); }
+          else if (ev.type === "error") throw new Error(ev.detail || "Stream error");
+        });
+      } finally {
+        setIsStreaming(false);
+      }
+    }
 
     // AFTER the server responds, reconcile titles/timestamps from backend
     await loadChatsAndSelect(activeChatId, targetPid);
@@ -743,18 +830,18 @@ async function send() {
     if (DEMO_MODE) { setFileCount(0); return; }
     if (!pid) return;
 
-    async function countAll(path = "") {
-      const r = await api(`/projects/${pid}/files/list?path=${encodeURIComponent(path)}`);
-      const items = r.entries || [];
-      let files = 0; const dirs = [];
-      for (const e of items) {
-        if (e.type === "file") files++;
-        else if (e.type === "dir") dirs.push(e.name);
-      }
-      for (const d of dirs) files += await countAll(path ? `${path}/${d}` : d);
+    // One recursive listing, paged by cursor, instead of a request per directory
+    async function countAll() {
+      let files = 0, cursor = null;
+      do {
+        const q = `depth=0&limit=5000${cursor ? `&cursor=${encodeURIComponent(cursor)}` : ""}`;
+        const r = await api(`/projects/${pid}/files/tree?${q}`);
+        for (const e of r.entries || []) if (e.type === "file") files++;
+        cursor = r.next_cursor;
+      } while (cursor);
       return files;
     }
-    try { setFileCount(await countAll("")); } catch {}
+    try { setFileCount(await countAll()); } catch {}
   }
 
   async function listRootFiles() {
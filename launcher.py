@@ -1,7 +1,10 @@
 # ==================================================
 # =============== CHUNK: LAUNCHER.PY ===============
 # ==================================================
-import os, sys, threading, time, webbrowser
+# Desktop mode (default): one in-process server on a free port, then open the browser.
+# Production mode (--production or LAUNCH_MODE=production): uvicorn's process supervisor
+# with N workers, graceful shutdown and keep-alive/backlog tuning; no browser.
+import os, sys, shutil, tempfile, threading, time, webbrowser, importlib.util
 from pathlib import Path
 
 # Run from the folder that contains main.py
@@ -9,14 +12,69 @@ ROOT = Path(__file__).parent.resolve()
 os.chdir(ROOT)
 sys.path.insert(0, str(ROOT))
 
-from main import app  # FastAPI app
 import uvicorn
 
 HOST = os.environ.get("HOST", "127.0.0.1")
 # If PORT not set, use 0 so OS chooses a free port (avoids WinError 10048)
 REQUESTED_PORT = int(os.environ.get("PORT", "0"))
+LAUNCH_MODE = (os.environ.get("LAUNCH_MODE", "desktop") or "desktop").strip().lower()
+
+# Production tuning (all optional)
+WORKERS = (os.environ.get("WORKERS") or os.environ.get("WEB_CONCURRENCY") or "auto").strip().lower()
+KEEP_ALIVE_S = int(os.environ.get("KEEP_ALIVE_S", "15") or 15)             # idle keep-alive before closing
+BACKLOG = int(os.environ.get("BACKLOG", "2048") or 2048)                     # listen() queue length
+GRACEFUL_TIMEOUT_S = int(os.environ.get("GRACEFUL_TIMEOUT_S", "30") or 30)   # drain time for in-flight requests/streams
+LIMIT_CONCURRENCY = int(os.environ.get("LIMIT_CONCURRENCY", "0") or 0)       # 0 => unlimited; else 503 above it
+
+def _worker_count() -> int:
+    if WORKERS in ("", "auto", "0"):
+        return max(1, os.cpu_count() or 1)
+    return max(1, int(WORKERS))
+
+def _pick(module: str, preferred: str, fallback: str) -> str:
+    """Use the optional fast implementation (uvloop/httptools) only when it is installed."""
+    return preferred if importlib.util.find_spec(module) is not None else fallback
+
+def run_production():
+    workers = _worker_count()
+    # Workers share data/ on disk: their chat/project locks must be file locks too.
+    # main.py reads these at import time in each worker.
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    metrics_dir = None
+    if workers > 1:
+        os.environ.setdefault("LOCKS_CROSS_PROCESS", "1")
+        # /metrics sums the workers' flushed series; a fresh dir per run so old pids don't linger.
+        if not os.environ.get("METRICS_MULTIPROC_DIR"):
+            metrics_dir = tempfile.mkdtemp(prefix="metrics-")
+            os.environ["METRICS_MULTIPROC_DIR"] = metrics_dir
+
+    loop = os.environ.get("UVICORN_LOOP") or _pick("uvloop", "uvloop", "asyncio")
+    http = os.environ.get("UVICORN_HTTP") or _pick("httptools", "httptools", "h11")
+    port = REQUESTED_PORT or 8000   # workers need a fixed port to share the socket
+    print(f"[launcher] Production: {workers} worker(s) on http://{HOST}:{port} (loop={loop}, http={http})")
+    try:
+        uvicorn.run(
+            "main:app",                 # import string: every worker imports its own app
+            host=HOST,
+            port=port,
+            workers=workers,
+            loop=loop,
+            http=http,
+            backlog=BACKLOG,
+            timeout_keep_alive=KEEP_ALIVE_S,
+            timeout_graceful_shutdown=GRACEFUL_TIMEOUT_S,
+            limit_concurrency=LIMIT_CONCURRENCY or None,
+            proxy_headers=True,
+            log_level="info",
+            reload=False,
+        )
+    finally:
+        if metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+def run_desktop():
+    from main import app  # FastAPI app
 
-def main():
     config = uvicorn.Config(
         app,
         host=HOST,
@@ -73,5 +131,11 @@ def main():
     # Keep foreground attached to the server
     t.join()
 
+def main():
+    if "--production" in sys.argv[1:] or LAUNCH_MODE in ("production", "prod"):
+        run_production()
+    else:
+        run_desktop()
+
 if __name__ == "__main__":
     main()
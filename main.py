@@ -4,20 +4,50 @@
 ## // main.py — Projects/Chats/Files + Delete + Full File Ops + Voice STT/TTS
 from fastapi import FastAPI, HTTPException, Query, UploadFile, File, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit, quote
 from pathlib import Path
 from datetime import datetime
-import os, json, requests, uuid, shutil, mimetypes, io, re
+import os, errno, json, uuid, shutil, mimetypes, io, re, asyncio, sqlite3, threading, math, time, bisect, hashlib, base64, fnmatch
+from collections import OrderedDict, deque
+from array import array
+import contextvars, ctypes, ctypes.util, itertools, select, struct, sys
+import httpx
+try:  # advisory file locks for LOCKS_CROSS_PROCESS
+    import fcntl
+    msvcrt = None
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+    import msvcrt
 
 
 # main.py
 ### // ==================================================
 ### // =============== CHUNK: APP + CONFIG ==============
 ### // ==================================================
-app = FastAPI()
+# Startup/shutdown hooks (async callables) registered by the chunks below.
+_STARTUP_HOOKS: List[Callable] = []
+_SHUTDOWN_HOOKS: List[Callable] = []
+
+@asynccontextmanager
+async def _lifespan(_app):
+    for hook in _STARTUP_HOOKS:
+        await hook()
+    try:
+        yield
+    finally:
+        for hook in reversed(_SHUTDOWN_HOOKS):
+            try:
+                await hook()
+            except Exception:
+                pass
+
+app = FastAPI(lifespan=_lifespan)
 
 def _env_flag(name: str, default: bool = False) -> bool:
     v = os.environ.get(name, "")
@@ -89,6 +119,469 @@ async def health():
     return {"ok": True}
 
 
+# ==================================================
+# ================= CHUNK: METRICS =================
+# ==================================================
+# Prometheus text exposition at /metrics, without a client library. Series live in plain
+# dicts keyed by label tuples; recording is a dict update (plus a bisect for histograms)
+# under one lock, a microsecond or two. With several workers (WEB_CONCURRENCY > 1) each
+# worker flushes its series to METRICS_MULTIPROC_DIR every METRICS_FLUSH_S, and a scrape
+# sums every worker's file into its own live values, so counters stay monotonic whichever
+# worker answers. Files of exited workers keep counting (like prometheus_client's
+# multiprocess mode); their gauges are dropped. The launcher creates a fresh directory per
+# run; without one, a multi-worker /metrics answers 503 rather than per-worker numbers.
+METRICS = _env_flag("METRICS", default=True)
+METRICS_MULTIPROC_DIR = os.environ.get("METRICS_MULTIPROC_DIR", "")
+METRICS_FLUSH_S = float(os.environ.get("METRICS_FLUSH_S", "2") or 2)
+_METRICS_LOCK = threading.Lock()
+_METRICS: Dict[str, Dict[str, Any]] = {}
+_METRICS_FLUSHER: Dict[str, Any] = {"task": None}
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+def metric_define(name: str, kind: str, help_text: str, labels: tuple = (), buckets: tuple = ()):
+    _METRICS[name] = {"kind": kind, "help": help_text, "labels": tuple(labels), "buckets": tuple(buckets), "series": {}}
+
+def metric_inc(name: str, labels: tuple = (), value: float = 1.0):
+    """Counter increment, or gauge add (negative values allowed for gauges)."""
+    if not METRICS:
+        return
+    series = _METRICS[name]["series"]
+    with _METRICS_LOCK:
+        series[labels] = series.get(labels, 0) + value
+
+def metric_observe(name: str, value: float, labels: tuple = ()):
+    if not METRICS:
+        return
+    m = _METRICS[name]
+    i = bisect.bisect_left(m["buckets"], value)
+    with _METRICS_LOCK:
+        row = m["series"].get(labels)
+        if row is None:
+            row = m["series"][labels] = [[0] * (len(m["buckets"]) + 1), 0.0, 0]
+        row[0][i] += 1
+        row[1] += value
+        row[2] += 1
+
+def _metric_num(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+def _metric_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    esc = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, esc)) + "}"
+
+def _metrics_snapshot() -> Dict[str, Dict[tuple, Any]]:
+    with _METRICS_LOCK:
+        return {
+            name: {k: ([list(v[0]), v[1], v[2]] if m["kind"] == "histogram" else v) for k, v in m["series"].items()}
+            for name, m in _METRICS.items()
+        }
+
+def _metrics_file(pid: int) -> str:
+    return os.path.join(METRICS_MULTIPROC_DIR, f"worker-{pid}.json")
+
+def _metrics_flush():
+    snap = _metrics_snapshot()
+    doc = {"pid": os.getpid(), "series": {name: [[list(k), v] for k, v in rows.items()] for name, rows in snap.items() if rows}}
+    atomic_write(_metrics_file(os.getpid()), json.dumps(doc), fsync=False)
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+def _metrics_merge_workers(snap: Dict[str, Dict[tuple, Any]]):
+    """Adds every other worker's flushed series into `snap` (this worker's live values)."""
+    try:
+        names = [n for n in os.listdir(METRICS_MULTIPROC_DIR) if n.startswith("worker-") and n.endswith(".json")]
+    except OSError:
+        return
+    for fname in names:
+        doc = read_json(os.path.join(METRICS_MULTIPROC_DIR, fname), None)
+        if not isinstance(doc, dict) or doc.get("pid") == os.getpid():
+            continue
+        alive = _pid_alive(int(doc.get("pid") or 0))
+        for name, rows in (doc.get("series") or {}).items():
+            m = _METRICS.get(name)
+            if m is None or (m["kind"] == "gauge" and not alive):
+                continue
+            dst = snap.setdefault(name, {})
+            for labels, v in rows:
+                key = tuple(labels)
+                if m["kind"] != "histogram":
+                    dst[key] = dst.get(key, 0) + v
+                    continue
+                cur = dst.get(key)
+                if cur is None:
+                    dst[key] = [list(v[0]), v[1], v[2]]
+                    continue
+                if len(cur[0]) != len(v[0]):
+                    continue   # written by a build with other buckets
+                cur[0] = [a + b for a, b in zip(cur[0], v[0])]
+                cur[1] += v[1]
+                cur[2] += v[2]
+
+def metrics_render() -> str:
+    snap = _metrics_snapshot()
+    if METRICS_MULTIPROC_DIR:
+        _metrics_merge_workers(snap)
+    lines: List[str] = []
+    for name, m in _METRICS.items():
+        lines.append(f"# HELP {name} {m['help']}")
+        lines.append(f"# TYPE {name} {m['kind']}")
+        for labels, v in sorted(snap.get(name, {}).items()):
+            lab = _metric_labels(m["labels"], labels)
+            if m["kind"] != "histogram":
+                lines.append(f"{name}{lab} {_metric_num(v)}")
+                continue
+            counts, total, count = v
+            cum = 0
+            for bound, n in zip(m["buckets"] + (math.inf,), counts):
+                cum += n
+                lines.append(f"{name}_bucket{_metric_labels(m['labels'] + ('le',), labels + (_metric_num(bound),))} {cum}")
+            lines.append(f"{name}_sum{lab} {_metric_num(total)}")
+            lines.append(f"{name}_count{lab} {count}")
+    return "\n".join(lines) + "\n"
+
+async def _metrics_flush_loop():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_S)
+        try:
+            await run_in_threadpool(_metrics_flush)
+        except Exception:
+            pass
+
+async def _metrics_start():
+    if METRICS and METRICS_MULTIPROC_DIR:
+        os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+        _METRICS_FLUSHER["task"] = asyncio.create_task(_metrics_flush_loop())
+
+async def _metrics_stop():
+    task = _METRICS_FLUSHER.pop("task", None)
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        _metrics_flush()   # keep this worker's final counts for the survivors' scrapes
+
+_STARTUP_HOOKS.append(_metrics_start)
+_SHUTDOWN_HOOKS.append(_metrics_stop)
+
+metric_define("http_requests_total", "counter", "HTTP requests by route template and status.", ("method", "route", "status"))
+metric_define("http_request_duration_seconds", "histogram", "HTTP request latency until the last body chunk.", ("method", "route"), _LATENCY_BUCKETS)
+metric_define("http_requests_in_flight", "gauge", "HTTP requests currently being served.", ("method",))
+metric_define("llm_request_duration_seconds", "histogram", "Upstream chat-completions latency.", ("provider", "model", "stream"), _LATENCY_BUCKETS)
+metric_define("llm_requests_total", "counter", "Upstream chat-completions requests by outcome.", ("provider", "model", "outcome"))
+metric_define("llm_prompt_tokens_total", "counter", "Prompt tokens reported in usage.", ("provider", "model"))
+metric_define("llm_cached_prompt_tokens_total", "counter", "Prompt tokens served from the provider's prompt cache.", ("provider", "model"))
+metric_define("llm_completion_tokens_total", "counter", "Completion tokens reported in usage.", ("provider", "model"))
+metric_define("llm_tool_duration_seconds", "histogram", "Agent tool execution time.", ("tool",), (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+metric_define("llm_tool_errors_total", "counter", "Agent tool calls that returned an error.", ("tool",))
+metric_define("llm_agent_steps", "histogram", "LLM calls per agent run.", ("mode", "outcome"), (1, 2, 3, 4, 5, 6, 8, 10, 12, 16, 20))
+metric_define("context_gather_duration_seconds", "histogram", "Time to build the project files context.", (), (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+metric_define("context_gather_bytes", "histogram", "Size of the project files context.", (), (1024, 4096, 16384, 32768, 65536, 131072, 262144, 524288, 1048576))
+
+
+class _MetricsMiddleware:
+    """Pure ASGI (no BaseHTTPMiddleware), so streamed responses are timed to their last chunk."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS:
+            await self.app(scope, receive, send)
+            return
+        method = scope.get("method", "GET")
+        status = [500]
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        metric_inc("http_requests_in_flight", (method,))
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - t0
+            metric_inc("http_requests_in_flight", (method,), -1)
+            # The router stores the matched route in the scope; templates keep label sets bounded.
+            route = getattr(scope.get("route"), "path", None) or "<unmatched>"
+            metric_observe("http_request_duration_seconds", elapsed, (method, route))
+            metric_inc("http_requests_total", (method, route, str(status[0])))
+
+app.add_middleware(_MetricsMiddleware)
+
+@app.get("/metrics")
+def api_metrics():
+    if not METRICS_MULTIPROC_DIR and int(os.environ.get("WEB_CONCURRENCY", "1") or 1) > 1:
+        raise HTTPException(503, "Several workers and no METRICS_MULTIPROC_DIR: per-worker counters would look like constant resets.")
+    return Response(metrics_render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+
+# ==================================================
+# ================= CHUNK: TRACING =================
+# ==================================================
+# Per-turn timelines. A turn (message, stream or background job) opens a trace in a context
+# variable; spans opened below it, including in threadpool calls (they copy the context),
+# are recorded with timings and sizes. Finished traces go to a per-chat ring buffer and,
+# with TRACE_DISK, to chats/_traces/<cid>.jsonl (shared by all workers; on by default when
+# WEB_CONCURRENCY > 1, since each worker's ring only holds the turns it served).
+# TRACE_PROFILE runs a sampling profiler while turns are in flight; turns slower than
+# TRACE_SLOW_MS keep its collapsed stacks (flamegraph.pl / speedscope input). Samples cover
+# every busy thread of the process, so concurrent turns appear in each other's profiles.
+TRACE = _env_flag("TRACE", default=True)
+TRACE_RING_SIZE = int(os.environ.get("TRACE_RING_SIZE", "20") or 20)          # traces kept per chat
+TRACE_MAX_CHATS = int(os.environ.get("TRACE_MAX_CHATS", "200") or 200)
+TRACE_MAX_SPANS = 500
+TRACE_DISK = _env_flag("TRACE_DISK", default=int(os.environ.get("WEB_CONCURRENCY", "1") or 1) > 1)
+TRACE_DISK_MAX_BYTES = int(os.environ.get("TRACE_DISK_MAX_BYTES", "2000000") or 2000000)   # then rotated to .1
+TRACE_PROFILE = _env_flag("TRACE_PROFILE", default=False)
+TRACE_PROFILE_INTERVAL_MS = float(os.environ.get("TRACE_PROFILE_INTERVAL_MS", "10") or 10)
+TRACE_PROFILE_MAX_STACKS = 500
+TRACE_PROFILE_MAX_S = 900
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "5000") or 5000)
+
+_TRACE: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+_TRACE_SPAN: contextvars.ContextVar = contextvars.ContextVar("trace_span", default=None)
+_TRACES: "OrderedDict[Any, deque]" = OrderedDict()   # (pid, cid) -> recent traces
+_TRACES_LOCK = threading.Lock()
+
+@contextmanager
+def trace_span(name: str, nest: bool = True, **attrs: Any):
+    """
+    Records a span in the current turn's trace and yields its attrs dict, for sizes and
+    results known only at the end. Outside a traced turn this is one context-variable read.
+    Pass nest=False in async generators: between yields they run in the consumer's context.
+    """
+    tr = _TRACE.get()
+    if tr is None:
+        yield attrs
+        return
+    span = {"id": next(tr["ids"]), "parent": _TRACE_SPAN.get(), "name": name, "attrs": attrs}
+    token = _TRACE_SPAN.set(span["id"]) if nest else None
+    t0 = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        span["start_ms"] = round((t0 - tr["t0"]) * 1000.0, 3)
+        span["duration_ms"] = round((time.perf_counter() - t0) * 1000.0, 3)
+        if token is not None:
+            _TRACE_SPAN.reset(token)
+        if len(tr["spans"]) < TRACE_MAX_SPANS:
+            tr["spans"].append(span)
+        else:
+            tr["dropped"] += 1
+
+def trace_active() -> bool:
+    return _TRACE.get() is not None
+
+@asynccontextmanager
+async def trace_turn(pid: str, cid: str, kind: str, trace: Optional[Dict[str, Any]] = None, finish: bool = True, **attrs: Any):
+    """
+    Traces one chat turn; the finished trace is stored even when the turn fails.
+    A turn split over two blocks (a streamed turn prepares in the endpoint and finishes in
+    the response generator) opens with finish=False and continues with trace=<the first one>.
+    """
+    if not TRACE:
+        yield None
+        return
+    tr = trace or {
+        "id": uuid.uuid4().hex[:16],
+        "project_id": pid,
+        "chat_id": cid,
+        "kind": kind,
+        "attrs": attrs,
+        "started_at": now_iso(),
+        "t0": time.perf_counter(),
+        "ids": itertools.count(1),
+        "spans": [],
+        "dropped": 0,
+    }
+    token, span_token = _TRACE.set(tr), _TRACE_SPAN.set(None)
+    if TRACE_PROFILE and trace is None:
+        _profile_start(tr)
+    status = "ok"
+    try:
+        yield tr
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        _TRACE_SPAN.reset(span_token)
+        _TRACE.reset(token)
+        if finish or status != "ok":
+            rec = _trace_finish(tr, status)
+            if TRACE_DISK:
+                try:
+                    await asyncio.shield(run_in_threadpool(_trace_append_disk, rec))
+                except Exception:
+                    pass
+
+def _trace_finish(tr: Dict[str, Any], status: str) -> Dict[str, Any]:
+    duration_ms = round((time.perf_counter() - tr["t0"]) * 1000.0, 3)
+    rec = {k: v for k, v in tr.items() if k not in ("t0", "ids")}
+    rec.update(status=status, duration_ms=duration_ms, spans=sorted(tr["spans"], key=lambda s: (s["start_ms"], s["id"])))
+    profile = _profile_stop(tr) if TRACE_PROFILE else None
+    if profile and duration_ms >= TRACE_SLOW_MS:
+        top = sorted(profile["stacks"].items(), key=lambda kv: -kv[1])[:TRACE_PROFILE_MAX_STACKS]
+        rec["profile"] = {
+            "interval_ms": TRACE_PROFILE_INTERVAL_MS,
+            "samples": profile["samples"],
+            "collapsed": "\n".join(f"{stack} {n}" for stack, n in top),
+        }
+    with _TRACES_LOCK:
+        key = (tr["project_id"], tr["chat_id"])
+        ring = _TRACES.pop(key, None) or deque(maxlen=TRACE_RING_SIZE)
+        ring.append(rec)
+        _TRACES[key] = ring
+        while len(_TRACES) > TRACE_MAX_CHATS:
+            _TRACES.popitem(last=False)
+    return rec
+
+def trace_log_path(pid: str, cid: str) -> str:
+    return os.path.join(chats_dir(pid), "_traces", f"{cid}.jsonl")
+
+def _trace_append_disk(rec: Dict[str, Any]):
+    path = trace_log_path(rec["project_id"], rec["chat_id"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+    try:
+        if os.path.getsize(path) + len(line) > TRACE_DISK_MAX_BYTES:
+            os.replace(path, path + ".1")
+    except OSError:
+        pass
+    with open(path, "ab") as f:
+        f.write(line)   # one write per record, so appends from several workers do not interleave
+
+def trace_list(pid: str, cid: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """Newest first. With TRACE_DISK the log is read, so every worker's turns are included."""
+    if not TRACE_DISK:
+        with _TRACES_LOCK:
+            ring = list(_TRACES.get((pid, cid)) or [])
+        return ring[::-1][:limit]
+    out: List[Dict[str, Any]] = []
+    path = trace_log_path(pid, cid)
+    for p in (path, path + ".1"):
+        try:
+            with open(p, "rb") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        for raw in reversed(lines):
+            try:
+                out.append(json.loads(raw))
+            except ValueError:
+                continue
+            if len(out) >= limit:
+                return out
+    return out
+
+def trace_forget(pid: str, cid: str):
+    with _TRACES_LOCK:
+        _TRACES.pop((pid, cid), None)
+    path = trace_log_path(pid, cid)
+    for p in (path, path + ".1"):
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+# --- Sampling profiler (TRACE_PROFILE) ---
+_PROFILER: Dict[str, Any] = {"lock": threading.Lock(), "active": {}, "thread": None}
+# Leaf frames of threads that are only waiting (idle pool workers, the event loop's select,
+# the workspace watcher's poll), left out so profiles show where time is spent.
+_PROFILE_IDLE = {
+    ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("queue.py", "get"),
+    ("selectors.py", "select"), ("main.py", "_inotify_loop"),
+}
+
+def _profile_start(tr: Dict[str, Any]):
+    with _PROFILER["lock"]:
+        _PROFILER["active"][tr["id"]] = {"samples": 0, "stacks": {}, "started": time.monotonic()}
+        if _PROFILER["thread"] is None:
+            _PROFILER["thread"] = threading.Thread(target=_profile_loop, name="trace-profiler", daemon=True)
+            _PROFILER["thread"].start()
+
+def _profile_stop(tr: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    with _PROFILER["lock"]:
+        return _PROFILER["active"].pop(tr["id"], None)
+
+def _profile_sample(skip: int) -> List[str]:
+    names = {t.ident: t.name for t in threading.enumerate()}
+    stacks = []
+    for ident, frame in sys._current_frames().items():
+        if ident == skip:
+            continue
+        if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _PROFILE_IDLE:
+            continue
+        parts = []
+        while frame is not None and len(parts) < 128:
+            parts.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+            frame = frame.f_back
+        parts.append(names.get(ident, f"thread-{ident}"))
+        stacks.append(";".join(reversed(parts)))
+    return stacks
+
+def _profile_loop():
+    me = threading.get_ident()
+    while True:
+        with _PROFILER["lock"]:
+            # A streamed turn whose response never ran is never finished; stop sampling for it.
+            now = time.monotonic()
+            for tid in [t for t, p in _PROFILER["active"].items() if now - p["started"] > TRACE_PROFILE_MAX_S]:
+                _PROFILER["active"].pop(tid, None)
+            active = list(_PROFILER["active"].values())
+            if not active:
+                _PROFILER["thread"] = None
+                return
+        stacks = _profile_sample(me)
+        with _PROFILER["lock"]:
+            for prof in active:
+                prof["samples"] += 1
+                for s in stacks:
+                    prof["stacks"][s] = prof["stacks"].get(s, 0) + 1
+        time.sleep(TRACE_PROFILE_INTERVAL_MS / 1000.0)
+
+@app.get("/projects/{pid}/chats/{cid}/traces")
+def api_chat_traces(pid: str, cid: str, limit: int = Query(default=20, ge=1, le=200), profile: bool = Query(default=False)):
+    """Recent turn timelines, newest first. Profiles are summarized unless profile=true."""
+    traces = trace_list(pid, cid, limit)
+    if not profile:
+        traces = [
+            {**t, "profile": {k: v for k, v in t["profile"].items() if k != "collapsed"}} if t.get("profile") else t
+            for t in traces
+        ]
+    out: Dict[str, Any] = {"traces": traces}
+    if not TRACE_DISK and int(os.environ.get("WEB_CONCURRENCY", "1") or 1) > 1:
+        out["warning"] = "TRACE_DISK is off with several workers: only turns served by this worker are listed."
+    return out
+
+@app.get("/projects/{pid}/chats/{cid}/traces/{tid}/profile")
+def api_chat_trace_profile(pid: str, cid: str, tid: str):
+    """Collapsed stacks of one slow turn, ready for flamegraph.pl or speedscope."""
+    for t in trace_list(pid, cid, TRACE_RING_SIZE if not TRACE_DISK else 1000):
+        if t.get("id") == tid:
+            if not t.get("profile"):
+                raise HTTPException(404, "No profile for this trace")
+            return Response(t["profile"]["collapsed"] + "\n", media_type="text/plain; charset=utf-8")
+    if not TRACE_DISK and int(os.environ.get("WEB_CONCURRENCY", "1") or 1) > 1:
+        raise HTTPException(404, "Trace not found in this worker (TRACE_DISK is off with several workers).")
+    raise HTTPException(404, "Trace not found")
+
+
 
 ### // ==================================================
 ### // =============== CHUNK: LEGACY CHAT ===============
@@ -97,10 +590,11 @@ class ChatBody(BaseModel):
     messages: Optional[List[Dict[str, str]]] = None
     message: Optional[str] = None
     model: Optional[str] = None   # allow override
+    cache: Optional[bool] = None  # override LLM_CACHE for this request
 
 
 @app.post("/chat")
-def chat(req: ChatBody):
+async def chat(req: ChatBody):
     if req.messages:
         msgs = req.messages
     elif req.message:
@@ -110,7 +604,7 @@ def chat(req: ChatBody):
 
     # use request override or fallback to a safe default
     model = req.model or "gpt-5"
-    reply = llm_chat(msgs, {"model": model})
+    reply = await llm_chat(msgs, {"model": model, "llm_cache": req.cache})
     return {"response": reply}
 
 
@@ -198,14 +692,273 @@ def resolve_provider(project: Dict[str, Any]) -> Dict[str, Any]:
         },
     }
 
-def post_json(url: str, payload: dict, headers: dict) -> dict:
-    r = requests.post(url, json=payload, headers=headers, timeout=120)
+# --- Shared pooled HTTP client for LLM + voice calls ---
+# One AsyncClient per event loop keeps TCP/TLS connections alive between agent steps.
+LLM_HTTP_TIMEOUT = float(os.environ.get("LLM_HTTP_TIMEOUT", "120") or 120)
+LLM_HTTP_MAX_CONNECTIONS = int(os.environ.get("LLM_HTTP_MAX_CONNECTIONS", "100") or 100)
+LLM_HTTP_MAX_KEEPALIVE = int(os.environ.get("LLM_HTTP_MAX_KEEPALIVE", "20") or 20)
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_HTTP_KEEPALIVE_EXPIRY", "30") or 30)
+LLM_HTTP_PER_HOST = int(os.environ.get("LLM_HTTP_PER_HOST", "0") or 0)  # 0 => no per-host cap
+
+_HTTP: Dict[str, Any] = {"client": None, "loop": None, "host_slots": {}}
+
+def _http2_available() -> bool:
+    if not _env_flag("LLM_HTTP2", default=True):
+        return False
+    try:
+        import h2  # noqa: F401  (in requirements.txt; installs without it fall back to HTTP/1.1)
+        return True
+    except Exception:
+        return False
+
+def llm_http_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _HTTP["client"]
+    if client is None or client.is_closed or _HTTP["loop"] is not loop:
+        client = httpx.AsyncClient(
+            http2=_http2_available(),
+            timeout=httpx.Timeout(LLM_HTTP_TIMEOUT, connect=min(LLM_HTTP_TIMEOUT, 10.0)),
+            limits=httpx.Limits(
+                max_connections=LLM_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        _HTTP.update(client=client, loop=loop, host_slots={})
+    return client
+
+@asynccontextmanager
+async def _llm_http_slot(url: str):
+    if LLM_HTTP_PER_HOST <= 0:
+        yield
+        return
+    host = urlsplit(url).netloc
+    sem = _HTTP["host_slots"].get(host)
+    if sem is None:
+        sem = _HTTP["host_slots"][host] = asyncio.Semaphore(LLM_HTTP_PER_HOST)
+    async with sem:
+        yield
+
+async def _close_llm_http_client():
+    client = _HTTP["client"]
+    _HTTP.update(client=None, loop=None, host_slots={})
+    if client is not None and not client.is_closed:
+        await client.aclose()
+
+_SHUTDOWN_HOOKS.append(_close_llm_http_client)
+
+def _upstream_error(r: httpx.Response) -> HTTPException:
     try:
-        r.raise_for_status()
+        text = r.text
     except Exception:
-        raise HTTPException(502, (getattr(r, "text", "") or str(r))[:800])
+        text = ""
+    return HTTPException(502, (text or f"Upstream HTTP {r.status_code}")[:800])
+
+async def post_json(url: str, payload: dict, headers: dict, provider: str = "other") -> dict:
+    labels = (provider, str(payload.get("model") or ""))
+    t0 = time.perf_counter()
+    try:
+        async with _llm_http_slot(url):
+            r = await llm_http_client().post(url, json=payload, headers=headers)
+    except httpx.HTTPError as e:
+        metric_inc("llm_requests_total", labels + ("error",))
+        raise HTTPException(502, f"Upstream request failed: {e}"[:800])
+    finally:
+        metric_observe("llm_request_duration_seconds", time.perf_counter() - t0, labels + ("false",))
+    if r.status_code >= 400:
+        metric_inc("llm_requests_total", labels + ("error",))
+        raise _upstream_error(r)
+    metric_inc("llm_requests_total", labels + ("ok",))
     return r.json()
 
+# --- Response cache for chat completions (opt-in) ---
+# Content-addressed: sha256 over provider, model, normalized messages, tools and sampling
+# params. Memory tier is an LRU bounded by entries and bytes; optional disk tier in data/llm_cache.
+LLM_CACHE = _env_flag("LLM_CACHE", default=False)
+LLM_CACHE_DISK = _env_flag("LLM_CACHE_DISK", default=False)
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", "86400") or 86400)
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "512") or 512)
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)) or 64 * 1024 * 1024)
+
+_LLM_CACHE: "OrderedDict[str, Any]" = OrderedDict()   # key -> (created, size, data)
+_LLM_CACHE_LOCK = threading.Lock()
+_LLM_CACHE_STATS = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "bytes": 0}
+
+def llm_cache_dir() -> str:
+    return os.path.join(DATA_DIR, "llm_cache")
+
+def llm_cache_enabled(project: Dict[str, Any]) -> bool:
+    flag = (project or {}).get("llm_cache")
+    return LLM_CACHE if flag is None else bool(flag)
+
+def _normalize_cache_message(m: Dict[str, Any]) -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for k in ("role", "content", "name", "tool_call_id", "tool_calls"):
+        v = (m or {}).get(k)
+        if v is None:
+            continue
+        if k == "content" and isinstance(v, str):
+            v = "\n".join(line.rstrip() for line in v.replace("\r\n", "\n").strip().split("\n"))
+        out[k] = v
+    return out
+
+def _llm_cache_key(provider_name: str, payload: Dict[str, Any]) -> str:
+    norm = {k: v for k, v in payload.items() if k not in ("messages", "stream", "stream_options", "user", "prompt_cache_key")}
+    norm["provider"] = provider_name
+    norm["messages"] = [_normalize_cache_message(m) for m in payload.get("messages") or []]
+    blob = json.dumps(norm, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+def _llm_cache_disk_path(key: str) -> str:
+    return os.path.join(llm_cache_dir(), key[:2], f"{key}.json")
+
+def _llm_cache_put_memory(key: str, created: float, data: Dict[str, Any]):
+    size = len(json.dumps(data, ensure_ascii=False))
+    if size > LLM_CACHE_MAX_BYTES:
+        return
+    with _LLM_CACHE_LOCK:
+        old = _LLM_CACHE.pop(key, None)
+        if old is not None:
+            _LLM_CACHE_STATS["bytes"] -= old[1]
+        _LLM_CACHE[key] = (created, size, data)
+        _LLM_CACHE_STATS["bytes"] += size
+        while _LLM_CACHE and (len(_LLM_CACHE) > LLM_CACHE_MAX_ENTRIES or _LLM_CACHE_STATS["bytes"] > LLM_CACHE_MAX_BYTES):
+            _, (_, sz, _) = _LLM_CACHE.popitem(last=False)
+            _LLM_CACHE_STATS["bytes"] -= sz
+            _LLM_CACHE_STATS["evictions"] += 1
+
+def llm_cache_get(key: str) -> Optional[Dict[str, Any]]:
+    now = time.time()
+    with _LLM_CACHE_LOCK:
+        hit = _LLM_CACHE.get(key)
+        if hit is not None:
+            if now - hit[0] <= LLM_CACHE_TTL:
+                _LLM_CACHE.move_to_end(key)
+                _LLM_CACHE_STATS["hits"] += 1
+                return hit[2]
+            _LLM_CACHE.pop(key, None)
+            _LLM_CACHE_STATS["bytes"] -= hit[1]
+    if LLM_CACHE_DISK:
+        path = _llm_cache_disk_path(key)
+        try:
+            rec = read_json(path, None)
+        except Exception:
+            rec = None
+        if rec and now - float(rec.get("created") or 0) <= LLM_CACHE_TTL:
+            _llm_cache_put_memory(key, float(rec["created"]), rec["data"])
+            with _LLM_CACHE_LOCK:
+                _LLM_CACHE_STATS["disk_hits"] += 1
+            return rec["data"]
+        if rec:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    with _LLM_CACHE_LOCK:
+        _LLM_CACHE_STATS["misses"] += 1
+    return None
+
+def llm_cache_put(key: str, data: Dict[str, Any]):
+    created = time.time()
+    _llm_cache_put_memory(key, created, data)
+    if LLM_CACHE_DISK:
+        try:
+            # A lost cache entry is only a miss, so skip the fsyncs.
+            write_json(_llm_cache_disk_path(key), {"created": created, "data": data}, fsync=False)
+        except OSError:
+            pass
+    with _LLM_CACHE_LOCK:
+        _LLM_CACHE_STATS["stores"] += 1
+
+@app.get("/llm/cache/stats")
+def api_llm_cache_stats():
+    with _LLM_CACHE_LOCK:
+        stats = dict(_LLM_CACHE_STATS)
+        stats["entries"] = len(_LLM_CACHE)
+    lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+    stats["hit_rate"] = round((stats["hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+    stats.update(enabled=LLM_CACHE, disk=LLM_CACHE_DISK, ttl_seconds=LLM_CACHE_TTL)
+    return stats
+
+@app.delete("/llm/cache")
+def api_llm_cache_clear():
+    with _LLM_CACHE_LOCK:
+        _LLM_CACHE.clear()
+        _LLM_CACHE_STATS["bytes"] = 0
+    shutil.rmtree(llm_cache_dir(), ignore_errors=True)
+    return {"status": "ok"}
+
+# --- Token usage, including provider prompt-cache hits ---
+# Every upstream completion reports usage.prompt_tokens; OpenAI adds
+# usage.prompt_tokens_details.cached_tokens for the prefix served from its prompt cache.
+# Totals are kept per provider:model and per project (responses served by the local
+# response cache above never reach the provider and are not counted).
+_LLM_USAGE_LOCK = threading.Lock()
+_LLM_USAGE: Dict[str, Dict[str, Dict[str, int]]] = {"models": {}, "projects": {}}
+
+def llm_record_usage(provider: Dict[str, Any], project: Dict[str, Any], usage: Any):
+    if not isinstance(usage, dict):
+        return
+    details = usage.get("prompt_tokens_details") or {}
+    nums = {
+        "prompt_tokens": int(usage.get("prompt_tokens") or 0),
+        "cached_tokens": int((details.get("cached_tokens") if isinstance(details, dict) else 0) or 0),
+        "completion_tokens": int(usage.get("completion_tokens") or 0),
+    }
+    labels = (str(provider.get("name")), str(provider.get("model")))
+    metric_inc("llm_prompt_tokens_total", labels, nums["prompt_tokens"])
+    metric_inc("llm_cached_prompt_tokens_total", labels, nums["cached_tokens"])
+    metric_inc("llm_completion_tokens_total", labels, nums["completion_tokens"])
+    rows = [("models", f"{provider.get('name')}:{provider.get('model')}")]
+    if (project or {}).get("id"):
+        rows.append(("projects", str(project["id"])))
+    with _LLM_USAGE_LOCK:
+        for group, key in rows:
+            row = _LLM_USAGE[group].setdefault(key, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0})
+            row["requests"] += 1
+            for k, v in nums.items():
+                row[k] += v
+
+def llm_usage_stats() -> Dict[str, Any]:
+    def with_rate(row: Dict[str, int]) -> Dict[str, Any]:
+        rate = row["cached_tokens"] / row["prompt_tokens"] if row["prompt_tokens"] else 0.0
+        return {**row, "cached_hit_rate": round(rate, 4)}
+    with _LLM_USAGE_LOCK:
+        models = {k: dict(v) for k, v in _LLM_USAGE["models"].items()}
+        projects = {k: dict(v) for k, v in _LLM_USAGE["projects"].items()}
+    total = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+    for row in models.values():
+        for k in total:
+            total[k] += row[k]
+    return {
+        "total": with_rate(total),
+        "models": {k: with_rate(v) for k, v in models.items()},
+        "projects": {k: with_rate(v) for k, v in projects.items()},
+    }
+
+@app.get("/llm/usage")
+def api_llm_usage():
+    """Token usage since start (this process): prompt, cached prompt and completion tokens, with hit rates."""
+    return llm_usage_stats()
+
+async def llm_complete(provider: Dict[str, Any], payload: Dict[str, Any], project: Dict[str, Any]) -> Dict[str, Any]:
+    """post_json for chat completions, going through the response cache when enabled."""
+    if not llm_cache_enabled(project):
+        data = await post_json(provider["url"], payload, provider["headers"], provider=provider["name"])
+        llm_record_usage(provider, project, data.get("usage"))
+        return data
+    key = _llm_cache_key(provider["name"], payload)
+    data = await run_in_threadpool(llm_cache_get, key) if LLM_CACHE_DISK else llm_cache_get(key)
+    if data is not None:
+        return data
+    data = await post_json(provider["url"], payload, provider["headers"], provider=provider["name"])
+    llm_record_usage(provider, project, data.get("usage"))
+    if LLM_CACHE_DISK:
+        await run_in_threadpool(llm_cache_put, key, data)
+    else:
+        llm_cache_put(key, data)
+    return data
+
 def _extract_from_chat_completions(data: Dict[str, Any]) -> str:
     try:
         return data["choices"][0]["message"]["content"]
@@ -222,17 +975,144 @@ def _clean_chat_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, str]]
         cleaned.append({"role": role, "content": "" if content is None else str(content)})
     return cleaned
 
-def _llm_call(messages: List[Dict[str, Any]], project: Dict[str, Any], tools: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
-    provider = resolve_provider(project)
+# OpenAI routes requests sharing a prompt_cache_key to the same cache shard; one key per
+# project keeps its stable prefix (tools, capabilities, instructions) warm across chats.
+LLM_PROMPT_CACHE_KEY = _env_flag("LLM_PROMPT_CACHE_KEY", default=True)
+
+def _llm_payload(
+    provider: Dict[str, Any],
+    messages: List[Dict[str, Any]],
+    project: Dict[str, Any],
+    tools: Optional[List[Dict[str, Any]]] = None,
+    stream: bool = False,
+) -> Dict[str, Any]:
     payload: Dict[str, Any] = {"model": provider["model"], "messages": messages}
     if tools and bool(provider.get("supports_tools")):
         payload["tools"] = tools
         payload["tool_choice"] = "auto"
-    data = post_json(provider["url"], payload, provider["headers"])
+    if provider.get("name") == "openai":
+        if LLM_PROMPT_CACHE_KEY and (project or {}).get("id"):
+            payload["prompt_cache_key"] = f"project-{project['id']}"
+        if stream:
+            payload["stream_options"] = {"include_usage": True}   # final chunk carries usage
+    if stream:
+        payload["stream"] = True
+    return payload
+
+def _llm_chars(messages: List[Dict[str, Any]]) -> int:
+    return sum(len(str(m.get("content") or "")) for m in messages or [])
+
+def _trace_llm_result(sp: Dict[str, Any], msg: Dict[str, Any], usage: Any):
+    sp["reply_chars"] = len(str(msg.get("content") or ""))
+    sp["tool_calls"] = len(msg.get("tool_calls") or [])
+    if isinstance(usage, dict):
+        details = usage.get("prompt_tokens_details") or {}
+        sp.update(
+            prompt_tokens=usage.get("prompt_tokens"),
+            cached_tokens=details.get("cached_tokens") if isinstance(details, dict) else None,
+            completion_tokens=usage.get("completion_tokens"),
+        )
+
+async def _llm_call(messages: List[Dict[str, Any]], project: Dict[str, Any], tools: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    provider = resolve_provider(project)
+    payload = _llm_payload(provider, messages, project, tools)
+    with trace_span("llm_call", provider=provider["name"], model=provider["model"], messages=len(messages), prompt_chars=_llm_chars(messages)) as sp:
+        data = await llm_complete(provider, payload, project)
+        try:
+            msg = data["choices"][0]["message"] or {}
+        except Exception:
+            msg = {}
+        if trace_active():
+            _trace_llm_result(sp, msg, data.get("usage"))
+    return msg
+
+_SSE_DONE = object()
+
+def _parse_sse_line(raw: str) -> Any:
+    # OpenAI and Ollama both stream chat completions as `data: {...}` lines ending with `data: [DONE]`.
+    line = (raw or "").strip()
+    if not line.startswith("data:"):
+        return None
+    body = line[5:].strip()
+    if body == "[DONE]":
+        return _SSE_DONE
     try:
-        return data["choices"][0]["message"] or {}
+        return json.loads(body)
     except Exception:
-        return {}
+        return None
+
+def _merge_tool_call_deltas(acc: List[Dict[str, Any]], deltas: List[Dict[str, Any]]):
+    for d in deltas or []:
+        idx = int(d.get("index", len(acc)) or 0)
+        while len(acc) <= idx:
+            acc.append({"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+        tc = acc[idx]
+        if d.get("id"):
+            tc["id"] = d["id"]
+        if d.get("type"):
+            tc["type"] = d["type"]
+        fn = d.get("function") or {}
+        if fn.get("name"):
+            tc["function"]["name"] += fn["name"]
+        if fn.get("arguments"):
+            tc["function"]["arguments"] += fn["arguments"]
+
+async def _llm_call_stream(messages: List[Dict[str, Any]], project: Dict[str, Any], tools: Optional[List[Dict[str, Any]]] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Streaming variant of _llm_call.
+    Yields {"type": "delta", "content": ...} as tokens arrive, then one {"type": "message", "message": {...}}
+    holding the assembled assistant message (content + tool_calls) in the non-streaming shape.
+    """
+    provider = resolve_provider(project)
+    payload = _llm_payload(provider, messages, project, tools, stream=True)
+
+    content_parts: List[str] = []
+    tool_calls: List[Dict[str, Any]] = []
+    usage = None
+    labels = (provider["name"], provider["model"])
+    outcome = "error"
+    # nest=False: this generator runs in its consumer's context between yields.
+    with trace_span("llm_call", nest=False, provider=provider["name"], model=provider["model"], stream=True, messages=len(messages), prompt_chars=_llm_chars(messages)) as sp:
+        t0 = time.perf_counter()
+        try:
+            async with _llm_http_slot(provider["url"]):
+                async with llm_http_client().stream("POST", provider["url"], json=payload, headers=provider["headers"]) as r:
+                    if r.status_code >= 400:
+                        await r.aread()
+                        raise _upstream_error(r)
+                    async for line in r.aiter_lines():
+                        chunk = _parse_sse_line(line)
+                        if chunk is _SSE_DONE:
+                            break
+                        if not chunk:
+                            continue
+                        if chunk.get("usage"):
+                            usage = chunk["usage"]
+                        try:
+                            delta = chunk["choices"][0].get("delta") or {}
+                        except Exception:
+                            continue
+                        piece = delta.get("content")
+                        if piece:
+                            content_parts.append(piece)
+                            yield {"type": "delta", "content": piece}
+                        if delta.get("tool_calls"):
+                            _merge_tool_call_deltas(tool_calls, delta["tool_calls"])
+            outcome = "ok"
+        except httpx.HTTPError as e:
+            raise HTTPException(502, f"Upstream request failed: {e}"[:800])
+        finally:
+            # Time to the end of the stream (or to the failure / consumer going away).
+            metric_observe("llm_request_duration_seconds", time.perf_counter() - t0, labels + ("true",))
+            metric_inc("llm_requests_total", labels + (outcome,))
+        llm_record_usage(provider, project, usage)
+
+        msg: Dict[str, Any] = {"role": "assistant", "content": "".join(content_parts)}
+        if tool_calls:
+            msg["tool_calls"] = tool_calls
+        if trace_active():
+            _trace_llm_result(sp, msg, usage)
+    yield {"type": "message", "message": msg}
 
 def _llm_denied_path(rel: str) -> bool:
     rel = (rel or "").replace("\\", "/").lstrip("/")
@@ -270,7 +1150,7 @@ def _llm_capabilities_prompt(pid: str) -> str:
         "You have local file tools via this server.\n"
         f"- Project id: {pid}\n"
         f"- Project root (absolute): {root}\n"
-        "- Tools: list_files, read_file, write_file, mkdir, delete_path, move_path, search_text, get_capabilities, get_project_instructions, set_project_instructions\n"
+        "- Tools: list_files, read_file, write_file, patch_file, mkdir, delete_path, move_path, search_text, get_capabilities, get_project_instructions, set_project_instructions\n"
         f"- write_file allowed: {allow_write}\n"
         f"- delete_path allowed: {allow_delete}\n"
         f"- move_path allowed: {allow_rename}\n"
@@ -279,8 +1159,12 @@ def _llm_capabilities_prompt(pid: str) -> str:
         "- Never try to access secrets (for example `.env`, `.pem`, `.key`) or `.git`/`node_modules`.\n"
         "- You may suggest short instruction/rule changes, but DO NOT apply them unless the user explicitly includes `ALLOW_INSTRUCTIONS_EDIT=YES` in their most recent message.\n"
         "- If asked to change code/files, use the tools and be explicit about what you will read/write.\n"
+        "- To edit an existing file, prefer patch_file (unified diff or search/replace edits with the sha256 from read_file) over rewriting it with write_file.\n"
     )
 
+LLM_LIST_FILES_LIMIT = int(os.environ.get("LLM_LIST_FILES_LIMIT", "300") or 300)
+LLM_LIST_FILES_MAX_DEPTH = 8
+
 def _llm_tools() -> List[Dict[str, Any]]:
     return [
         {
@@ -295,10 +1179,15 @@ def _llm_tools() -> List[Dict[str, Any]]:
             "type": "function",
             "function": {
                 "name": "list_files",
-                "description": "List files/directories at a relative path within the project root.",
+                "description": "List files/directories under a relative path within the project root, optionally several levels deep. Entries carry paths relative to the root; continue with next_cursor when present.",
                 "parameters": {
                     "type": "object",
-                    "properties": {"path": {"type": "string", "description": "Relative directory path ('' for root)."}},
+                    "properties": {
+                        "path": {"type": "string", "description": "Relative directory path ('' for root)."},
+                        "depth": {"type": "integer", "description": "Levels to descend (1 = direct children, max 8).", "default": 1},
+                        "glob": {"type": "string", "description": "Only return entries whose name (or relative path, if the pattern has '/') matches, e.g. '*.py'."},
+                        "cursor": {"type": "string", "description": "next_cursor from a previous call, to get the next page."},
+                    },
                     "required": ["path"],
                     "additionalProperties": False,
                 },
@@ -308,12 +1197,15 @@ def _llm_tools() -> List[Dict[str, Any]]:
             "type": "function",
             "function": {
                 "name": "read_file",
-                "description": "Read a UTF-8 text file at a relative path within the project root.",
+                "description": "Read a UTF-8 text file at a relative path within the project root. Large files can be read in windows via offset/next_offset.",
                 "parameters": {
                     "type": "object",
                     "properties": {
                         "path": {"type": "string", "description": "Relative file path."},
-                        "max_chars": {"type": "integer", "description": "Max characters to return.", "default": 50000},
+                        "max_chars": {"type": "integer", "description": "Max characters to return (capped by the server's read_file budget; continue with next_offset).", "default": 50000},
+                        "offset": {"type": "integer", "description": "Byte offset to start reading at (use next_offset from a previous read).", "default": 0},
+                        "etag": {"type": "string", "description": "ETag from a previous read; returns not_modified if the file is unchanged."},
+                        "sha256": {"type": "boolean", "description": "Also return the whole file's sha256 (for patch_file's base_sha256); always included when offset is 0."},
                     },
                     "required": ["path"],
                     "additionalProperties": False,
@@ -336,6 +1228,37 @@ def _llm_tools() -> List[Dict[str, Any]]:
                 },
             },
         },
+        {
+            "type": "function",
+            "function": {
+                "name": "patch_file",
+                "description": "Edit an existing UTF-8 text file without resending it: apply a unified diff or a list of search/replace edits. Returns the new sha256.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "path": {"type": "string", "description": "Relative file path."},
+                        "base_sha256": {"type": "string", "description": "sha256 of the content the edit was made against (from read_file); the patch is rejected if the file changed."},
+                        "patch": {"type": "string", "description": "Unified diff (@@ hunks) against the current file."},
+                        "edits": {
+                            "type": "array",
+                            "description": "Search/replace edits applied in order (alternative to patch).",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "search": {"type": "string", "description": "Exact text to find."},
+                                    "replace": {"type": "string", "description": "Replacement text."},
+                                    "count": {"type": "integer", "description": "Expected number of occurrences (default 1); 0 replaces all.", "default": 1},
+                                },
+                                "required": ["search", "replace"],
+                                "additionalProperties": False,
+                            },
+                        },
+                    },
+                    "required": ["path"],
+                    "additionalProperties": False,
+                },
+            },
+        },
         {
             "type": "function",
             "function": {
@@ -382,13 +1305,16 @@ def _llm_tools() -> List[Dict[str, Any]]:
             "type": "function",
             "function": {
                 "name": "search_text",
-                "description": "Search for a substring in UTF-8 text files under a relative directory.",
+                "description": "Search UTF-8 text files under a relative directory for a substring or regex. Returns every match with its line number.",
                 "parameters": {
                     "type": "object",
                     "properties": {
-                        "query": {"type": "string", "description": "Substring to search for."},
+                        "query": {"type": "string", "description": "Substring (or Python regex when regex=true) to search for."},
                         "path": {"type": "string", "description": "Relative directory path to search within.", "default": ""},
+                        "regex": {"type": "boolean", "description": "Treat query as a regular expression.", "default": False},
+                        "ignore_case": {"type": "boolean", "description": "Case-insensitive matching.", "default": False},
                         "max_results": {"type": "integer", "description": "Max matches to return.", "default": 50},
+                        "max_per_file": {"type": "integer", "description": "Max matches per file.", "default": 20},
                     },
                     "required": ["query"],
                     "additionalProperties": False,
@@ -441,7 +1367,7 @@ def _llm_execute_tool(pid: str, name: str, args: Dict[str, Any], context: Option
         return {
             "project_id": pid,
             "project_root": root,
-            "tools": ["list_files", "read_file", "write_file", "mkdir", "delete_path", "move_path", "search_text", "get_capabilities", "get_project_instructions", "set_project_instructions"],
+            "tools": ["list_files", "read_file", "write_file", "patch_file", "mkdir", "delete_path", "move_path", "search_text", "get_capabilities", "get_project_instructions", "set_project_instructions"],
             "allow_write": allow_write,
             "allow_delete": allow_delete,
             "allow_rename": allow_rename,
@@ -458,28 +1384,53 @@ def _llm_execute_tool(pid: str, name: str, args: Dict[str, Any], context: Option
     if name == "list_files":
         path = str(args.get("path", ""))
         _llm_assert_path_allowed(path)
-        data = api_files_list(pid, path=path)
-        entries = data.get("entries") or []
-        filtered = []
-        for e in entries:
-            n = (e or {}).get("name") or ""
-            relp = (path.rstrip("/\\") + "/" + n).lstrip("/") if path else str(n)
-            if _llm_denied_path(relp):
-                continue
-            filtered.append(e)
-        return {"entries": filtered}
+        depth = max(1, min(int(args.get("depth") or 1), LLM_LIST_FILES_MAX_DEPTH))
+        # The start path is checked above, so a per-name check prunes denied entries and subtrees.
+        data = walk_tree(
+            root,
+            path,
+            depth=depth,
+            glob=(str(args["glob"]) if args.get("glob") else None),
+            cursor=(str(args["cursor"]) if args.get("cursor") else None),
+            limit=LLM_LIST_FILES_LIMIT,
+            skip=_llm_denied_path,
+        )
+        entries = [
+            {k: e[k] for k in ("path", "type", "size") if k in e}
+            for e in data["entries"]
+        ]
+        return {"entries": entries, "next_cursor": data["next_cursor"]}
 
     if name == "read_file":
         path = str(args.get("path", ""))
-        max_chars = int(args.get("max_chars", 50000))
-        max_chars = max(1, min(max_chars, 200000))
+        # Clamped here, inside the guarded call, so a bad value comes back to the model as a tool error.
+        max_chars = max(1, min(int(args.get("max_chars") or 50000), 200000, llm_tool_budget("read_file")))
         _llm_assert_path_allowed(path)
         target = safe_join(root, path)
         if not os.path.isfile(target):
             raise HTTPException(404, "File not found")
-        with open(target, "r", encoding="utf-8", errors="replace") as f:
-            content = f.read(max_chars)
-        return {"path": path, "content": content}
+        etag = file_etag(os.stat(target))
+        if args.get("etag") and _etag_matches(str(args.get("etag")), etag):
+            return {"path": path, "not_modified": True, "etag": etag}
+        offset = int(args.get("offset") or 0)
+        # Hashing reads the whole file: do it on the first window (or on request), not on every page.
+        window = read_text_window(target, offset, max_chars * 4, sha256=(offset == 0 or bool(args.get("sha256"))))
+        content = window["content"][:max_chars]
+        if len(content) < len(window["content"]):
+            window["next_offset"] = window["offset"] + len(content.encode("utf-8"))
+            window["eof"] = False
+        out = {
+            "path": path,
+            "content": content,
+            "offset": window["offset"],
+            "next_offset": window["next_offset"],
+            "size": window["size"],
+            "eof": window["eof"],
+            "etag": window["etag"],
+        }
+        if window.get("sha256"):
+            out["sha256"] = window["sha256"]
+        return out
 
     if name == "write_file":
         if not allow_write:
@@ -491,6 +1442,19 @@ def _llm_execute_tool(pid: str, name: str, args: Dict[str, Any], context: Option
         _llm_assert_path_allowed(path)
         return api_files_write(pid, FileWrite(path=path, content=content))
 
+    if name == "patch_file":
+        if not allow_write:
+            raise HTTPException(403, "LLM write is disabled (set LLM_ALLOW_WRITE=1 to enable).")
+        path = str(args.get("path", ""))
+        _llm_assert_path_allowed(path)
+        edits = args.get("edits")
+        return api_files_patch(pid, FilePatch(
+            path=path,
+            base_sha256=(str(args["base_sha256"]) if args.get("base_sha256") else None),
+            patch=(str(args["patch"]) if args.get("patch") else None),
+            edits=[PatchEdit(**e) for e in edits] if isinstance(edits, list) else None,
+        ))
+
     if name == "mkdir":
         if not allow_write:
             raise HTTPException(403, "LLM write is disabled (set LLM_ALLOW_WRITE=1 to enable).")
@@ -519,39 +1483,23 @@ def _llm_execute_tool(pid: str, name: str, args: Dict[str, Any], context: Option
         path = str(args.get("path", ""))
         max_results = int(args.get("max_results", 50))
         max_results = max(1, min(max_results, 200))
+        max_per_file = max(1, min(int(args.get("max_per_file", 20)), 200))
         _llm_assert_path_allowed(path)
         start_dir = safe_join(root, path)
         if not os.path.isdir(start_dir):
             return {"matches": []}
-
-        matches = []
-        for dirpath, dirnames, filenames in os.walk(start_dir):
-            dirnames[:] = [d for d in dirnames if not _llm_denied_path(os.path.relpath(os.path.join(dirpath, d), root))]
-            for fn in filenames:
-                relp = os.path.relpath(os.path.join(dirpath, fn), root).replace("\\", "/")
-                if _llm_denied_path(relp):
-                    continue
-                fp = os.path.join(dirpath, fn)
-                try:
-                    if os.path.getsize(fp) > 500000:
-                        continue
-                    with open(fp, "r", encoding="utf-8", errors="ignore") as f:
-                        text = f.read()
-                    if query in text:
-                        idx = text.find(query)
-                        start = max(0, idx - 80)
-                        end = min(len(text), idx + len(query) + 80)
-                        matches.append({"path": relp, "preview": text[start:end]})
-                        if len(matches) >= max_results:
-                            return {"matches": matches, "truncated": True}
-                except Exception:
-                    continue
-        return {"matches": matches, "truncated": False}
+        return search_workspace(
+            root,
+            query,
+            path=path,
+            regex=bool(args.get("regex", False)),
+            ignore_case=bool(args.get("ignore_case", False)),
+            max_results=max_results,
+            max_per_file=max_per_file,
+        )
 
     if name == "get_project_instructions":
-        ensure_data_dirs()
-        data = read_json(PROJECTS_FILE, {"projects": []})
-        proj = next((p for p in data.get("projects") or [] if p.get("id") == pid), None)
+        proj = project_get(pid)
         if not proj:
             raise HTTPException(404, "Project not found")
         return {
@@ -572,16 +1520,14 @@ def _llm_execute_tool(pid: str, name: str, args: Dict[str, Any], context: Option
         new_prompt = str(args.get("system_prompt") or "")
         if len(new_prompt) > 20000:
             raise HTTPException(413, "System prompt too large")
-        ensure_data_dirs()
-        data = read_json(PROJECTS_FILE, {"projects": []})
-        projects = data.get("projects") or []
-        for p in projects:
-            if p.get("id") == pid:
-                p["system_prompt"] = new_prompt
-                p["updated_at"] = now_iso()
-                write_json(PROJECTS_FILE, {"projects": projects})
-                return {"status": "ok", "project": p}
-        raise HTTPException(404, "Project not found")
+        with project_lock(pid):
+            p = project_get(pid)
+            if not p:
+                raise HTTPException(404, "Project not found")
+            p["system_prompt"] = new_prompt
+            p["updated_at"] = now_iso()
+            project_save(p)
+        return {"status": "ok", "project": p}
 
     raise HTTPException(400, "Unknown tool")
 
@@ -589,7 +1535,7 @@ def _llm_execute_tool(pid: str, name: str, args: Dict[str, Any], context: Option
 # // ==================================================  
 # // ============ CHUNK: LLM CHAT FUNCTION =============  
 # // ==================================================
-def llm_chat(messages: List[Dict[str, str]], project: Dict[str, Any]) -> str:
+async def llm_chat(messages: List[Dict[str, str]], project: Dict[str, Any]) -> str:
     """
     Uses Chat Completions.
     If the project's system_prompt is non-empty, prepend it as a system message.
@@ -598,80 +1544,350 @@ def llm_chat(messages: List[Dict[str, str]], project: Dict[str, Any]) -> str:
         return _demo_reply()
     provider = resolve_provider(project)
 
-    sys_prompt = ((project or {}).get("system_prompt") or "").strip()
-    cleaned = _clean_chat_messages(messages)
-    if sys_prompt:
-        msgs = [{"role": "system", "content": sys_prompt}] + cleaned
-    else:
-        msgs = cleaned
-
-    payload = {
-        "model": provider["model"],
-        "messages": msgs,  # [{"role":"user"/"assistant"/"system","content":"..."}]
-    }
-    data = post_json(provider["url"], payload, provider["headers"])
+    msgs = _llm_system_segments(project) + _clean_chat_messages(messages)
+    payload = _llm_payload(provider, msgs, project)   # [{"role":"user"/"assistant"/"system","content":"..."}]
+    data = await llm_complete(provider, payload, project)
     return (_extract_from_chat_completions(data) or "").strip()
 
-def llm_chat_agent(messages: List[Dict[str, Any]], project: Dict[str, Any], pid: str, max_steps: int = 8) -> str:
+def _llm_system_segments(project: Dict[str, Any], pid: Optional[str] = None) -> List[Dict[str, Any]]:
     """
-    Chat-completions tool loop for local file read/write/search.
+    System messages, most stable first, so consecutive requests share the longest prefix
+    (after the tool schema) and the provider's prompt cache can serve it: capabilities
+    (fixed per project), project instructions (change only when edited), the rolling summary
+    of older turns (changes only when the history window slides), then the file context
+    gathered for this turn. The verbatim history window follows these.
     """
-    if _should_demo(project):
-        return _demo_reply()
-    sys_prompt = ((project or {}).get("system_prompt") or "").strip()
+    segments: List[Dict[str, Any]] = []
+    if pid:
+        segments.append({"role": "system", "content": _llm_capabilities_prompt(pid)})
+    instructions = ((project or {}).get("system_prompt") or "").strip()
+    if instructions:
+        segments.append({"role": "system", "content": instructions})
+    history_summary = ((project or {}).get("history_summary") or "").strip()
+    if history_summary:
+        segments.append({"role": "system", "content": "### Earlier Conversation (summary)\n" + history_summary})
+    files_context = ((project or {}).get("files_context") or "").strip()
+    if files_context:
+        segments.append({"role": "system", "content": "### Project Files Context\n" + files_context})
+    return segments
+
+def _llm_agent_convo(messages: List[Dict[str, Any]], project: Dict[str, Any], pid: str):
     cleaned = _clean_chat_messages(messages)
-    convo: List[Dict[str, Any]] = []
-    if sys_prompt:
-        convo.append({"role": "system", "content": sys_prompt})
-    convo.append({"role": "system", "content": _llm_capabilities_prompt(pid)})
-    convo.extend(cleaned)
+    convo: List[Dict[str, Any]] = _llm_system_segments(project, pid) + cleaned
     last_user_message = ""
     for m in reversed(cleaned):
         if m.get("role") == "user":
             last_user_message = str(m.get("content") or "")
             break
+    return convo, last_user_message
+
+def _llm_assistant_tool_msg(msg: Dict[str, Any]) -> Dict[str, Any]:
+    assistant_msg: Dict[str, Any] = {"role": "assistant", "tool_calls": msg.get("tool_calls") or []}
+    if msg.get("content") is not None:
+        assistant_msg["content"] = msg.get("content")
+    return assistant_msg
+
+def _llm_parse_tool_call(tc: Dict[str, Any]):
+    tc_id = tc.get("id") or ""
+    fn = (tc.get("function") or {})
+    name = fn.get("name") or ""
+    raw_args = fn.get("arguments") or "{}"
+    try:
+        args = json.loads(raw_args) if isinstance(raw_args, str) else (raw_args or {})
+    except Exception:
+        args = {}
+    return tc_id, name, (args if isinstance(args, dict) else {})
+
+_LLM_TOOL_NAMES: set = set()
+
+def _llm_execute_tool_timed(pid: str, name: str, args: Dict[str, Any], context: Dict[str, Any]) -> Any:
+    if not _LLM_TOOL_NAMES:
+        _LLM_TOOL_NAMES.update(t["function"]["name"] for t in _llm_tools())
+    label = (name if name in _LLM_TOOL_NAMES else "unknown",)   # names come from the model
+    t0 = time.perf_counter()
+    failed = True
+    try:
+        with trace_span("tool", tool=name, args_chars=len(json.dumps(args, ensure_ascii=False, default=str))) as sp:
+            out = _llm_execute_tool(pid, name, args, context=context)
+            failed = isinstance(out, dict) and bool(out.get("error"))
+            if failed:
+                sp["error"] = str(out.get("detail") or "error")[:200]
+            if trace_active():
+                sp["result_chars"] = len(json.dumps(out, ensure_ascii=False, default=str))
+        return out
+    finally:
+        metric_observe("llm_tool_duration_seconds", time.perf_counter() - t0, label)
+        if failed:
+            metric_inc("llm_tool_errors_total", label)
+
+async def _llm_run_tool(pid: str, name: str, args: Dict[str, Any], last_user_message: str) -> Any:
+    # Tools do blocking filesystem work, so they run on the threadpool, off the event loop.
+    try:
+        return await run_in_threadpool(_llm_execute_tool_timed, pid, name, args, {"last_user_message": last_user_message})
+    except HTTPException as e:
+        return {"error": True, "status_code": int(getattr(e, "status_code", 500)), "detail": str(getattr(e, "detail", "Tool error"))}
+    except Exception as e:
+        return {"error": True, "detail": str(e)}
+
+# Tools that only read state may run concurrently within one step; everything else
+# (write_file, patch_file, mkdir, delete_path, move_path, set_project_instructions, unknown
+# names) acts as a barrier and runs alone, in the order the model asked for it.
+# search_text is safe here because the workspace index serializes its own build and sync
+# walks (_SearchIndex.sync_lock) and guards its postings with _SearchIndex.lock.
+LLM_READ_ONLY_TOOLS = {"get_capabilities", "list_files", "read_file", "search_text", "get_project_instructions"}
+LLM_TOOL_PARALLELISM = int(os.environ.get("LLM_TOOL_PARALLELISM", "4") or 4)
+
+def _llm_tool_batches(parsed: List[Any]) -> List[List[int]]:
+    batches: List[List[int]] = []
+    for i, (_, name, _) in enumerate(parsed):
+        if name in LLM_READ_ONLY_TOOLS and batches and parsed[batches[-1][0]][1] in LLM_READ_ONLY_TOOLS:
+            batches[-1].append(i)
+        else:
+            batches.append([i])
+    return batches
+
+# --- Tool output size control ---
+# Every tool result is re-sent on each later step of the loop, so results are capped per
+# tool (LLM_TOOL_BUDGETS="read_file=32000,list_files=12000,..." in characters), outputs
+# older than LLM_TOOL_KEEP_STEPS steps are replaced by a short stub once the model has seen
+# them, and a repeated read_file/list_files of an unchanged path within one run returns a
+# reference to the earlier result instead of the content.
+def _llm_tool_budgets() -> Dict[str, int]:
+    budgets = {"read_file": 32000, "list_files": 12000, "search_text": 12000, "*": 8000}
+    for part in (os.environ.get("LLM_TOOL_BUDGETS", "") or "").split(","):
+        name, _, chars = part.partition("=")
+        if name.strip() and chars.strip().isdigit():
+            budgets[name.strip()] = int(chars)
+    return budgets
+
+LLM_TOOL_BUDGETS = _llm_tool_budgets()
+LLM_TOOL_KEEP_STEPS = int(os.environ.get("LLM_TOOL_KEEP_STEPS", "2") or 2)
+LLM_TOOL_ELIDE_MIN_CHARS = int(os.environ.get("LLM_TOOL_ELIDE_MIN_CHARS", "1000") or 1000)
+LLM_TOOL_RUN_CACHE = _env_flag("LLM_TOOL_RUN_CACHE", default=True)
+_LLM_TOOL_LIST_KEYS = {"list_files": "entries", "search_text": "matches"}
+
+def llm_tool_budget(name: str) -> int:
+    return LLM_TOOL_BUDGETS.get(name, LLM_TOOL_BUDGETS["*"])
+
+def _llm_tool_content(name: str, out: Any) -> str:
+    """Serialized tool result, cut to the tool's budget (lists lose their tail, not their shape)."""
+    text = json.dumps(out, ensure_ascii=False)
+    budget = llm_tool_budget(name)
+    if len(text) <= budget or name == "read_file":   # read_file is capped via max_chars, keeping next_offset exact
+        return text
+    key = _LLM_TOOL_LIST_KEYS.get(name)
+    if key and isinstance(out, dict) and isinstance(out.get(key), list):
+        items = out[key]
+        kept, used = [], len(text) - len(json.dumps(items, ensure_ascii=False)) + 200
+        for item in items:
+            used += len(json.dumps(item, ensure_ascii=False)) + 2
+            if used > budget:
+                break
+            kept.append(item)
+        hint = "Continue with next_cursor or list a subdirectory." if name == "list_files" else "Narrow the path or query to see more."
+        trimmed = {**out, key: kept, "truncated": True, "omitted": len(items) - len(kept), "hint": hint}
+        if name == "list_files" and kept and kept[-1].get("path"):
+            trimmed["next_cursor"] = tree_cursor(kept[-1]["path"])   # resume after what was kept
+        return json.dumps(trimmed, ensure_ascii=False)
+    return json.dumps({"truncated": True, "chars": len(text), "preview": text[:budget]}, ensure_ascii=False)
+
+def _llm_run_state() -> Dict[str, Any]:
+    """Per agent run: where each tool output sits in the convo, and the repeat-call cache."""
+    return {"outputs": [], "cache": {}}
+
+def _llm_tool_stamp(pid: str, name: str, args: Dict[str, Any]) -> Any:
+    """What must be unchanged for a cached read_file/list_files result to still hold."""
+    if name not in ("read_file", "list_files"):
+        return None
+    try:
+        if name == "list_files" and int(args.get("depth") or 1) != 1:
+            return None   # a directory's mtime says nothing about its subdirectories
+        target = safe_join(workspace_root(pid), str(args.get("path", "")))
+        st = os.stat(target)
+        if name == "list_files":
+            # The listing shows child sizes/mtimes, and editing a child in place leaves the directory's mtime alone.
+            with os.scandir(target) as it:
+                kids = sorted((e.name, e.stat().st_mtime_ns, e.stat().st_size) for e in it)
+            return (st.st_mtime_ns, st.st_ino, hash(tuple(kids)))
+    except Exception:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _llm_tool_cache_key(name: str, args: Dict[str, Any]) -> str:
+    return name + ":" + json.dumps(args, sort_keys=True, ensure_ascii=False)
+
+def _llm_elide_tool_outputs(convo: List[Dict[str, Any]], run: Dict[str, Any], step: int):
+    """Stub out large tool outputs the model already saw LLM_TOOL_KEEP_STEPS or more steps ago."""
+    for rec in run["outputs"]:
+        if rec["elided"] or step - rec["step"] <= LLM_TOOL_KEEP_STEPS:
+            continue
+        msg = convo[rec["index"]]
+        content = str(msg.get("content") or "")
+        if len(content) < LLM_TOOL_ELIDE_MIN_CHARS:
+            continue
+        try:
+            full = json.loads(content)
+        except Exception:
+            full = None
+        # Keep the small scalar fields (path, etag, sha256, size...) a later patch may need.
+        keep = {k: v for k, v in full.items() if isinstance(v, (int, float, bool)) or (isinstance(v, str) and len(v) <= 200)} if isinstance(full, dict) else {}
+        stub = {
+            **keep,
+            "elided": True,
+            "tool": rec["name"],
+            "chars": len(content),
+            "note": f"Output from step {rec['step']} was removed to save context; call the tool again if you need it.",
+        }
+        msg["content"] = json.dumps(stub, ensure_ascii=False)
+        rec["elided"] = True
+
+async def _llm_tool_step(
+    pid: str,
+    tool_calls: List[Dict[str, Any]],
+    last_user_message: str,
+    step: int,
+    results: List[Dict[str, Any]],
+    run_state: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Runs one step's tool calls and yields tool_start/tool_end events.
+    Tool messages are appended to `results` in the original tool_call order.
+    With `run_state` (see _llm_run_state), repeated reads are answered from the run cache.
+    """
+    parsed = [_llm_parse_tool_call(tc) for tc in tool_calls]
+    outs: List[Any] = [None] * len(parsed)
+    stamps: List[Any] = [None] * len(parsed)
+    sem = asyncio.Semaphore(max(1, LLM_TOOL_PARALLELISM))
+    cache = run_state["cache"] if run_state is not None and LLM_TOOL_RUN_CACHE else None
+
+    async def run(i: int):
+        tc_id, name, args = parsed[i]
+        if cache is not None and name in ("read_file", "list_files"):
+            stamps[i] = await run_in_threadpool(_llm_tool_stamp, pid, name, args)
+            hit = cache.get(_llm_tool_cache_key(name, args))
+            if hit and stamps[i] is not None and hit["stamp"] == stamps[i] and not hit["rec"]["elided"]:
+                hit["rec"]["step"] = step   # referenced again: keep it from being elided for now
+                outs[i] = {
+                    "unchanged": True,
+                    "same_as_tool_call": hit["rec"]["id"],
+                    "note": f"Same result as the earlier {name} call, still shown above.",
+                }
+                return i
+        async with sem:
+            outs[i] = await _llm_run_tool(pid, name, args, last_user_message)
+        if cache is not None and name not in LLM_READ_ONLY_TOOLS:
+            cache.clear()   # something may have changed on disk
+        return i
+
+    for batch in _llm_tool_batches(parsed):
+        for i in batch:
+            tc_id, name, args = parsed[i]
+            yield {"type": "tool_start", "step": step, "id": tc_id, "name": name, "args": args}
+        for fut in asyncio.as_completed([run(i) for i in batch]):
+            i = await fut
+            tc_id, name, _ = parsed[i]
+            failed = isinstance(outs[i], dict) and bool(outs[i].get("error"))
+            ev = {"type": "tool_end", "step": step, "id": tc_id, "name": name, "ok": not failed}
+            if failed:
+                ev["detail"] = outs[i].get("detail")
+            yield ev
+
+    for i, ((tc_id, name, args), out) in enumerate(zip(parsed, outs)):
+        results.append({"role": "tool", "tool_call_id": tc_id, "content": _llm_tool_content(name, out)})
+        if run_state is None:
+            continue
+        rec = {"index": len(results) - 1, "step": step, "name": name, "id": tc_id, "elided": False}
+        run_state["outputs"].append(rec)
+        # Only full results are worth pointing back to (not errors, references or not_modified).
+        partial = isinstance(out, dict) and (out.get("error") or out.get("unchanged") or out.get("not_modified"))
+        if cache is not None and stamps[i] is not None and not partial:
+            cache[_llm_tool_cache_key(name, args)] = {"stamp": stamps[i], "rec": rec}
+
+async def llm_chat_agent(
+    messages: List[Dict[str, Any]],
+    project: Dict[str, Any],
+    pid: str,
+    max_steps: int = 8,
+    on_event: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+) -> str:
+    """
+    Chat-completions tool loop for local file read/write/search.
+    `on_event` (optional) is awaited with {"type": "step"} before each LLM call and with every
+    tool_start/tool_end event; raising from a "step" event stops the run between steps.
+    """
+    if _should_demo(project):
+        return _demo_reply()
+    convo, last_user_message = await run_in_threadpool(_llm_agent_convo, messages, project, pid)
 
     tools_enabled = _env_flag("LLM_TOOLS", default=True)
     tools = _llm_tools() if tools_enabled else None
 
-    for _ in range(max(1, min(int(max_steps), 20))):
-        msg = _llm_call(convo, project, tools=tools)
-        tool_calls = msg.get("tool_calls") or []
-
+    run_state = _llm_run_state()
+    for step in range(max(1, min(int(max_steps), 20))):
+        if on_event is not None:
+            await on_event({"type": "step", "step": step})
+        with trace_span("step", step=step):
+            _llm_elide_tool_outputs(convo, run_state, step)
+            msg = await _llm_call(convo, project, tools=tools)
+            tool_calls = msg.get("tool_calls") or []
+
+            if tool_calls:
+                convo.append(_llm_assistant_tool_msg(msg))
+                async for ev in _llm_tool_step(pid, tool_calls, last_user_message, step, convo, run_state):
+                    if on_event is not None:
+                        await on_event(ev)
         if tool_calls:
-            assistant_msg: Dict[str, Any] = {"role": "assistant", "tool_calls": tool_calls}
-            if msg.get("content") is not None:
-                assistant_msg["content"] = msg.get("content")
-            convo.append(assistant_msg)
-
-            for tc in tool_calls:
-                tc_id = tc.get("id") or ""
-                fn = (tc.get("function") or {})
-                name = fn.get("name") or ""
-                raw_args = fn.get("arguments") or "{}"
-                try:
-                    args = json.loads(raw_args) if isinstance(raw_args, str) else (raw_args or {})
-                except Exception:
-                    args = {}
-                try:
-                    out = _llm_execute_tool(
-                        pid,
-                        name,
-                        args if isinstance(args, dict) else {},
-                        context={"last_user_message": last_user_message},
-                    )
-                except HTTPException as e:
-                    out = {"error": True, "status_code": int(getattr(e, "status_code", 500)), "detail": str(getattr(e, "detail", "Tool error"))}
-                except Exception as e:
-                    out = {"error": True, "detail": str(e)}
-
-                convo.append({"role": "tool", "tool_call_id": tc_id, "content": json.dumps(out, ensure_ascii=False)})
             continue
 
+        metric_observe("llm_agent_steps", step + 1, ("sync", "reply"))
         return str((msg.get("content") or "")).strip()
 
+    metric_observe("llm_agent_steps", step + 1, ("sync", "max_steps"))
     return "Error: tool loop exceeded maximum steps."
 
+async def llm_chat_agent_stream(messages: List[Dict[str, Any]], project: Dict[str, Any], pid: str, max_steps: int = 8) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Streaming twin of llm_chat_agent.
+    Yields delta / tool_start / tool_end events while the loop runs and a final {"type": "done", "reply": ...}.
+    """
+    if _should_demo(project):
+        reply = _demo_reply()
+        yield {"type": "delta", "content": reply}
+        yield {"type": "done", "reply": reply}
+        return
+    convo, last_user_message = await run_in_threadpool(_llm_agent_convo, messages, project, pid)
+
+    tools_enabled = _env_flag("LLM_TOOLS", default=True)
+    tools = _llm_tools() if tools_enabled else None
+
+    run_state = _llm_run_state()
+    for step in range(max(1, min(int(max_steps), 20))):
+        _llm_elide_tool_outputs(convo, run_state, step)
+        msg: Dict[str, Any] = {}
+        async for ev in _llm_call_stream(convo, project, tools=tools):
+            if ev["type"] == "message":
+                msg = ev["message"]
+            else:
+                yield ev
+        tool_calls = msg.get("tool_calls") or []
+
+        if tool_calls:
+            convo.append(_llm_assistant_tool_msg(msg))
+            with trace_span("tools", nest=False, step=step, calls=len(tool_calls)):
+                async for ev in _llm_tool_step(pid, tool_calls, last_user_message, step, convo, run_state):
+                    yield ev
+            continue
+
+        reply = str((msg.get("content") or "")).strip()
+        metric_observe("llm_agent_steps", step + 1, ("stream", "reply"))
+        yield {"type": "done", "reply": reply}
+        return
+
+    metric_observe("llm_agent_steps", step + 1, ("stream", "max_steps"))
+    reply = "Error: tool loop exceeded maximum steps."
+    yield {"type": "delta", "content": reply}
+    yield {"type": "done", "reply": reply}
+
 
 
 
@@ -682,15 +1898,27 @@ def llm_chat_agent(messages: List[Dict[str, Any]], project: Dict[str, Any], pid:
 ### // ==================================================
 DATA_DIR = os.path.abspath("data")
 PROJECTS_FILE = os.path.join(DATA_DIR, "projects.json")
+PROJECTS_DB = os.path.join(DATA_DIR, "projects.db")
+# "sqlite" (default) keeps projects in an indexed WAL database; "json" keeps the legacy projects.json.
+PROJECTS_BACKEND = (os.environ.get("PROJECTS_BACKEND", "sqlite") or "sqlite").strip().lower()
 
 def now_iso() -> str:
     return datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
+_DATA_DIRS_READY = {"ok": False}
+
 def ensure_data_dirs():
+    if _DATA_DIRS_READY["ok"]:
+        return
     os.makedirs(DATA_DIR, exist_ok=True)
-    if not os.path.exists(PROJECTS_FILE):
-        with open(PROJECTS_FILE, "w", encoding="utf-8") as f:
-            json.dump({"projects": []}, f, indent=2)
+    if PROJECTS_BACKEND == "json" and not os.path.exists(PROJECTS_FILE):
+        # Exclusive create: another worker may have created (and written) it meanwhile.
+        try:
+            with open(PROJECTS_FILE, "x", encoding="utf-8") as f:
+                json.dump({"projects": []}, f, indent=2)
+        except FileExistsError:
+            pass
+    _DATA_DIRS_READY["ok"] = True
 
 def read_json(path: str, default: Any=None) -> Any:
     try:
@@ -699,12 +1927,456 @@ def read_json(path: str, default: Any=None) -> Any:
     except FileNotFoundError:
         return default
 
-def write_json(path: str, data: Any):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+# --- Atomic writes: unique temp file -> fsync -> os.replace -> fsync the directory ---
+# Readers see either the old or the new file, never a torn one, and a crash after the call
+# returns cannot lose the rename. ATOMIC_WRITE_FSYNC=0 keeps the rename but skips both fsyncs.
+ATOMIC_WRITE_FSYNC = _env_flag("ATOMIC_WRITE_FSYNC", default=True)
+# Group commit: concurrent writers into the same directory share one directory fsync,
+# issued by a background thread after a short gathering window.
+ATOMIC_GROUP_COMMIT = _env_flag("ATOMIC_GROUP_COMMIT", default=False)
+ATOMIC_GROUP_WINDOW_MS = float(os.environ.get("ATOMIC_GROUP_WINDOW_MS", "2") or 2)
+
+def _fsync_dir(path: str):
+    # Directories cannot be opened for fsync on Windows; NTFS journals the rename itself.
+    if os.name != "posix":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class _GroupCommitter:
+    """Batches directory fsyncs: every writer waiting on a directory is released by one fsync."""
+
+    def __init__(self, window_s: float):
+        self.window_s = window_s
+        self.cond = threading.Condition()
+        self.pending: Dict[str, List[Dict[str, Any]]] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.pid = 0
+
+    def sync_dir(self, path: str):
+        waiter: Dict[str, Any] = {"done": threading.Event(), "error": None}
+        with self.cond:
+            if self.thread is None or not self.thread.is_alive() or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run, name="atomic-group-commit", daemon=True)
+                self.thread.start()
+            self.pending.setdefault(path, []).append(waiter)
+            self.cond.notify()
+        waiter["done"].wait()
+        if waiter["error"] is not None:
+            raise waiter["error"]
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            time.sleep(self.window_s)
+            with self.cond:
+                batch, self.pending = self.pending, {}
+            for path, waiters in batch.items():
+                error = None
+                try:
+                    _fsync_dir(path)
+                except OSError as e:
+                    error = e
+                for w in waiters:
+                    w["error"] = error
+                    w["done"].set()
+
+_GROUP_COMMITTER = _GroupCommitter(ATOMIC_GROUP_WINDOW_MS / 1000.0)
+
+def _sync_parent(path: str):
+    parent = os.path.dirname(os.path.abspath(path))
+    if ATOMIC_GROUP_COMMIT:
+        _GROUP_COMMITTER.sync_dir(parent)
+    else:
+        _fsync_dir(parent)
+
+def atomic_tmp_path(path: str, suffix: str = ".tmp") -> str:
+    """Unique hidden temp name next to `path` (same directory, so os.replace stays atomic)."""
+    head, tail = os.path.split(path)
+    return os.path.join(head, f".{tail}.{uuid.uuid4().hex[:12]}{suffix}")
+
+def atomic_commit(tmp: str, path: str, fsync: Optional[bool] = None):
+    """Rename a fully written (and, when fsync is on, already fsynced) temp file over `path`."""
+    if os.path.exists(path):
+        shutil.copymode(path, tmp)   # keep e.g. the executable bit of the file being replaced
     os.replace(tmp, path)
+    if ATOMIC_WRITE_FSYNC if fsync is None else fsync:
+        _sync_parent(path)
+
+def atomic_write(path: str, data: Any, fsync: Optional[bool] = None):
+    """Crash-safe replacement of `path` with `data` (bytes, str as UTF-8, or an iterable of bytes)."""
+    do_fsync = ATOMIC_WRITE_FSYNC if fsync is None else fsync
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = atomic_tmp_path(path)
+    try:
+        # "xb" instead of mkstemp: the new file gets the usual umask-derived mode, not 0600.
+        with open(tmp, "xb") as f:
+            if isinstance(data, str):
+                f.write(data.encode("utf-8"))
+            elif isinstance(data, (bytes, bytearray, memoryview)):
+                f.write(data)
+            else:
+                for part in data:
+                    f.write(part)
+            f.flush()
+            if do_fsync:
+                os.fsync(f.fileno())
+        atomic_commit(tmp, path, fsync=do_fsync)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def write_json(path: str, data: Any, fsync: Optional[bool] = None):
+    atomic_write(path, json.dumps(data, indent=2, ensure_ascii=False), fsync=fsync)
+
+# --- Named locks for read-modify-write sections (per project, per chat, per chat index) ---
+# Thread tier: a reentrant lock per name for the sync handlers running in the threadpool.
+# File tier (LOCKS_CROSS_PROCESS=1): an flock/msvcrt lock on data/locks/<hash>.lock taken
+# under the thread lock, so several uvicorn workers serialize too. On by default when
+# WEB_CONCURRENCY > 1 (the launcher's production mode sets it).
+# Async tier: lock_async() queues coroutines on the event loop, so waiting turns do not
+# each park a threadpool thread on the thread lock. named_lock_async() holds all tiers
+# across awaits (e.g. while a request body streams in).
+LOCKS_CROSS_PROCESS = _env_flag("LOCKS_CROSS_PROCESS", default=int(os.environ.get("WEB_CONCURRENCY", "1") or 1) > 1)
+LOCK_TIMEOUT_S = float(os.environ.get("LOCK_TIMEOUT_S", "30") or 30)
+LOCKS_DIR = os.path.join(DATA_DIR, "locks")
+
+class _NamedLock:
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.owner: Optional[int] = None
+        self.depth = 0
+        self.users = 0      # holders + waiters; the registry drops the entry at zero
+        self.fd: Optional[int] = None
+
+    def _file_lock(self, deadline: float):
+        os.makedirs(LOCKS_DIR, exist_ok=True)
+        path = os.path.join(LOCKS_DIR, hashlib.sha1(self.name.encode("utf-8")).hexdigest()[:24] + ".lock")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        delay = 0.001
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                self.fd = fd
+                return
+            except OSError:
+                if time.monotonic() >= deadline:
+                    os.close(fd)
+                    raise TimeoutError(f"Timed out waiting for lock {self.name!r}")
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+
+    def acquire(self, timeout: float, owner: Any = None):
+        me = threading.get_ident() if owner is None else owner
+        if self.owner == me:
+            self.depth += 1
+            return
+        deadline = time.monotonic() + timeout
+        if not self.lock.acquire(timeout=timeout):
+            raise TimeoutError(f"Timed out waiting for lock {self.name!r}")
+        try:
+            if LOCKS_CROSS_PROCESS and (fcntl is not None or msvcrt is not None):
+                self._file_lock(deadline)
+        except BaseException:
+            self.lock.release()
+            raise
+        self.owner, self.depth = me, 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth:
+            return
+        self.owner = None
+        if self.fd is not None:
+            fd, self.fd = self.fd, None
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                else:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            finally:
+                os.close(fd)
+        self.lock.release()
+
+_LOCKS: Dict[str, _NamedLock] = {}
+_LOCKS_GUARD = threading.Lock()
+_ASYNC_LOCKS: Dict[Any, Dict[str, List[Any]]] = {}   # event loop -> name -> [asyncio.Lock, users]
+
+@contextmanager
+def named_lock(name: str, timeout: Optional[float] = None, owner: Any = None):
+    """Hold the process-wide (and, if enabled, cross-process) lock `name`. Reentrant per thread
+    (or per `owner` token, for holders that are not tied to one thread)."""
+    with _LOCKS_GUARD:
+        lk = _LOCKS.get(name)
+        if lk is None:
+            lk = _LOCKS[name] = _NamedLock(name)
+        lk.users += 1
+    try:
+        try:
+            lk.acquire(LOCK_TIMEOUT_S if timeout is None else timeout, owner)
+        except TimeoutError as e:
+            raise HTTPException(503, str(e))
+        try:
+            yield
+        finally:
+            lk.release()
+    finally:
+        with _LOCKS_GUARD:
+            lk.users -= 1
+            if lk.users == 0:
+                _LOCKS.pop(name, None)
+
+@asynccontextmanager
+async def lock_async(name: str):
+    """Event-loop tier of `name`: at most one coroutine per loop proceeds to the thread/file tier."""
+    loop = asyncio.get_running_loop()
+    locks = _ASYNC_LOCKS.setdefault(loop, {})
+    entry = locks.get(name)
+    if entry is None:
+        entry = locks[name] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            locks.pop(name, None)
+            if not locks:
+                _ASYNC_LOCKS.pop(loop, None)
+
+@asynccontextmanager
+async def named_lock_async(name: str):
+    """named_lock held by a coroutine: taken and released in the threadpool, owned by a token
+    rather than by whichever pool thread happened to acquire it."""
+    async with lock_async(name):
+        cm = named_lock(name, owner=object())
+        await run_in_threadpool(cm.__enter__)
+        try:
+            yield
+        finally:
+            await run_in_threadpool(cm.__exit__, None, None, None)
+
+def project_lock_name(pid: str) -> str:
+    return f"project:{pid}"
+
+def chat_lock_name(pid: str, cid: str) -> str:
+    return f"chat:{pid}:{cid}"
+
+def project_lock(pid: str):
+    return named_lock(project_lock_name(pid))
+
+def chat_lock(pid: str, cid: str):
+    return named_lock(chat_lock_name(pid, cid))
+
+# --- Project store (backend behind the project CRUD routes) ---
+class _JsonProjectStore:
+    """Legacy layout: every project in one data/projects.json document."""
+
+    def _load(self) -> List[Dict[str, Any]]:
+        return read_json(PROJECTS_FILE, {"projects": []}).get("projects") or []
+
+    def stamp(self) -> Any:
+        try:
+            st = os.stat(PROJECTS_FILE)
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            return None
+
+    def list(self) -> List[Dict[str, Any]]:
+        return self._load()
+
+    def get(self, pid: str) -> Optional[Dict[str, Any]]:
+        return next((p for p in self._load() if p.get("id") == pid), None)
+
+    def put(self, project: Dict[str, Any]):
+        # Every project shares one document, so writers serialize on the whole file.
+        with named_lock("projects-store"):
+            projects = self._load()
+            for i, p in enumerate(projects):
+                if p.get("id") == project.get("id"):
+                    projects[i] = project
+                    break
+            else:
+                projects.append(project)
+            write_json(PROJECTS_FILE, {"projects": projects})
+
+    def delete(self, pid: str) -> bool:
+        with named_lock("projects-store"):
+            projects = self._load()
+            kept = [p for p in projects if p.get("id") != pid]
+            if len(kept) == len(projects):
+                return False
+            write_json(PROJECTS_FILE, {"projects": kept})
+            return True
+
+
+class _SqliteProjectStore:
+    """
+    Projects as JSON rows in SQLite (WAL), indexed by id.
+    `seq` preserves creation order so listings match the old projects.json order.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid = 0
+
+    def _db(self) -> sqlite3.Connection:
+        # Connections must not cross a fork (multi-worker uvicorn), so reopen per process.
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS projects ("
+                " id TEXT PRIMARY KEY,"
+                " seq INTEGER NOT NULL,"
+                " data TEXT NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn, self._conn_pid = conn, os.getpid()
+            self._migrate_from_json()
+        return self._conn
+
+    def _migrate_from_json(self):
+        """One-shot import of data/projects.json; the file is kept as projects.json.migrated."""
+        if not os.path.exists(PROJECTS_FILE):
+            return
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            done = conn.execute("SELECT value FROM meta WHERE key = 'migrated_projects_json'").fetchone()
+            if not done:
+                legacy = read_json(PROJECTS_FILE, {"projects": []}).get("projects") or []
+                for p in legacy:
+                    if not p.get("id"):
+                        continue
+                    conn.execute(
+                        "INSERT OR IGNORE INTO projects (id, seq, data)"
+                        " VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM projects), ?)",
+                        (p["id"], json.dumps(p, ensure_ascii=False)),
+                    )
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_projects_json', ?)", (now_iso(),))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        try:
+            os.replace(PROJECTS_FILE, PROJECTS_FILE + ".migrated")
+        except OSError:
+            pass
+
+    def stamp(self) -> Any:
+        # data_version changes whenever another connection (e.g. another worker) commits.
+        with self._lock:
+            return self._db().execute("PRAGMA data_version").fetchone()[0]
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._db().execute("SELECT data FROM projects ORDER BY seq").fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def get(self, pid: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db().execute("SELECT data FROM projects WHERE id = ?", (pid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, project: Dict[str, Any]):
+        with self._lock:
+            self._db().execute(
+                "INSERT INTO projects (id, seq, data)"
+                " VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM projects), ?)"
+                " ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                (project["id"], json.dumps(project, ensure_ascii=False)),
+            )
+
+    def delete(self, pid: str) -> bool:
+        with self._lock:
+            cur = self._db().execute("DELETE FROM projects WHERE id = ?", (pid,))
+        return cur.rowcount > 0
+
+
+_PROJECT_STORE: Dict[str, Any] = {"store": None}
+
+def projects_store():
+    store = _PROJECT_STORE["store"]
+    if store is None:
+        ensure_data_dirs()
+        store = _JsonProjectStore() if PROJECTS_BACKEND == "json" else _SqliteProjectStore(PROJECTS_DB)
+        _PROJECT_STORE["store"] = store
+    return store
+
+# --- Project registry cache ---
+# Reads are served from memory and revalidated with one cheap stamp check (projects.json
+# mtime/size, or SQLite data_version). Local writes bump the generation counter.
+_PROJECT_CACHE: Dict[str, Any] = {"gen": -1, "stamp": None, "order": [], "by_id": {}}
+_PROJECT_CACHE_LOCK = threading.Lock()
+_PROJECT_GENERATION = {"value": 0}
+_KNOWN_ROOTS: set = set()   # workspace roots already created on disk
+_KNOWN_ROOTS_LOCK = threading.Lock()
+
+def project_cache_bump():
+    with _PROJECT_CACHE_LOCK:
+        _PROJECT_GENERATION["value"] += 1
+
+def _project_registry() -> Dict[str, Any]:
+    store = projects_store()
+    stamp = store.stamp()
+    with _PROJECT_CACHE_LOCK:
+        gen = _PROJECT_GENERATION["value"]
+        if _PROJECT_CACHE["gen"] == gen and _PROJECT_CACHE["stamp"] == stamp:
+            return _PROJECT_CACHE
+    projects = store.list()
+    with _PROJECT_CACHE_LOCK:
+        _PROJECT_CACHE.update(
+            gen=gen,
+            stamp=stamp,
+            order=[p.get("id") for p in projects],
+            by_id={p.get("id"): p for p in projects},
+        )
+        return _PROJECT_CACHE
+
+def projects_list() -> List[Dict[str, Any]]:
+    reg = _project_registry()
+    return [dict(reg["by_id"][pid]) for pid in reg["order"]]
+
+def project_get(pid: str) -> Optional[Dict[str, Any]]:
+    p = _project_registry()["by_id"].get(pid)
+    return dict(p) if p else None
+
+def project_save(project: Dict[str, Any]):
+    try:
+        projects_store().put(project)
+    finally:
+        project_cache_bump()
+
+def project_remove(pid: str) -> bool:
+    try:
+        return projects_store().delete(pid)
+    finally:
+        project_cache_bump()
+
+def _forget_workspace_roots(path: str):
+    """Drop remembered roots at or below `path` after it was removed from disk."""
+    base = os.path.abspath(path)
+    with _KNOWN_ROOTS_LOCK:
+        _KNOWN_ROOTS.difference_update([r for r in _KNOWN_ROOTS if r == base or r.startswith(base + os.sep)])
+    _watch_drop(base)
 
 def project_dir(pid: str) -> str:
     return os.path.join(DATA_DIR, "projects", pid)
@@ -713,8 +2385,18 @@ def chats_dir(pid: str) -> str:
     return os.path.join(project_dir(pid), "chats")
 
 def chat_path(pid: str, cid: str) -> str:
+    # Legacy whole-document chat file; new chats use chat_log_path.
     return os.path.join(chats_dir(pid), f"{cid}.json")
 
+def chat_log_path(pid: str, cid: str) -> str:
+    return os.path.join(chats_dir(pid), f"{cid}.jsonl")
+
+def chat_index_path(pid: str) -> str:
+    return os.path.join(chats_dir(pid), "_index.json")
+
+def chat_index_log_path(pid: str) -> str:
+    return os.path.join(chats_dir(pid), "_index.log")
+
 def sanitize_name(name: str) -> str:
     s = re.sub(r"[^A-Za-z0-9._ -]+", "", (name or "").strip())
     s = re.sub(r"\s+", "_", s)
@@ -727,12 +2409,14 @@ def default_workspace_root_by_id(pid: str) -> str:
     return os.path.abspath(os.path.join(DATA_DIR, "workspaces", pid))
 
 def workspace_root(pid: str) -> str:
-    ensure_data_dirs()
-    data = read_json(PROJECTS_FILE, {"projects": []})
-    p = next((x for x in data["projects"] if x.get("id") == pid), None)
-    root = (p or {}).get("root") or default_workspace_root_by_id(pid)
-    os.makedirs(root, exist_ok=True)
-    return os.path.abspath(root)
+    p = project_get(pid)
+    root = os.path.abspath((p or {}).get("root") or default_workspace_root_by_id(pid))
+    with _KNOWN_ROOTS_LOCK:
+        # makedirs under the lock too: a root forgotten after an rmtree must not be re-added without its directory.
+        if root not in _KNOWN_ROOTS:
+            os.makedirs(root, exist_ok=True)
+            _KNOWN_ROOTS.add(root)
+    return root
 
 def safe_join(root: str, rel: str) -> str:
     target = os.path.abspath(os.path.join(root, rel or ""))
@@ -741,6 +2425,340 @@ def safe_join(root: str, rel: str) -> str:
     return target
 
 
+###  ==================================================
+###  =============== CHUNK: CHAT LOG ==================
+###  ==================================================
+# One append-only JSONL file per chat:
+#   line 1   {"kind": "header", "id", "project_id", "title", "created_at", "updated_at"}
+#   then     {"kind": "message", "role", "content", "ts", ...}
+#   and      {"kind": "meta", "title"?, "updated_at"}   (header changes without a rewrite)
+# A turn appends a couple of compact lines instead of re-serialising the whole history.
+# Compaction folds meta records (and any torn last line) back into the header.
+CHAT_LOG_FSYNC = _env_flag("CHAT_LOG_FSYNC", default=True)
+CHAT_COMPACT_META = int(os.environ.get("CHAT_COMPACT_META", "32") or 32)
+_CHAT_TAIL_BLOCK = 64 * 1024
+
+def _chat_line(rec: Dict[str, Any]) -> bytes:
+    return (json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+def _chat_msg_record(m: Dict[str, Any]) -> Dict[str, Any]:
+    rec = {"kind": "message"}
+    rec.update({k: v for k, v in (m or {}).items() if k != "kind"})
+    return rec
+
+def _chat_from_records(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    header = dict(records[0]) if records and records[0].get("kind") == "header" else {}
+    header.pop("kind", None)
+    chat: Dict[str, Any] = dict(header)
+    messages = []
+    for rec in records[1:] if header else records:
+        kind = rec.get("kind")
+        if kind == "message":
+            m = dict(rec)
+            m.pop("kind", None)
+            messages.append(m)
+            if m.get("ts"):
+                chat["updated_at"] = m["ts"]
+        elif kind == "meta":
+            chat.update({k: v for k, v in rec.items() if k != "kind"})
+    chat["messages"] = messages
+    return chat
+
+def _chat_read_log(path: str):
+    """Returns (records, meta_count, torn) for a .jsonl chat log."""
+    records: List[Dict[str, Any]] = []
+    meta_count = 0
+    torn = False
+    with open(path, "rb") as f:
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                torn = True
+            try:
+                rec = json.loads(raw)
+            except Exception:
+                torn = True
+                continue
+            if rec.get("kind") == "meta":
+                meta_count += 1
+            records.append(rec)
+    return records, meta_count, torn
+
+def _chat_write_log(path: str, chat: Dict[str, Any]):
+    header = {"kind": "header", **{k: v for k, v in chat.items() if k not in ("messages", "kind")}}
+    lines = [_chat_line(header)] + [_chat_line(_chat_msg_record(m)) for m in chat.get("messages") or []]
+    atomic_write(path, lines, fsync=CHAT_LOG_FSYNC)
+
+def _chat_append_records(path: str, records: List[Dict[str, Any]]):
+    with open(path, "ab+") as f:
+        # A crash mid-append can leave a torn last line; never glue a record onto it.
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+        f.write(b"".join(_chat_line(r) for r in records))
+        f.flush()
+        if CHAT_LOG_FSYNC:
+            os.fsync(f.fileno())
+
+# --- Per-project chat summary index (chats/_index.json + chats/_index.log) ---
+# Lets the sidebar list chats without opening any chat log. An update appends one
+# {"id", "summary"} line to _index.log (summary null = dropped) instead of rewriting the
+# whole index; past CHAT_INDEX_COMPACT lines the log is folded into _index.json. Each process
+# caches the merged index and only reads what other workers appended since.
+CHAT_SNIPPET_CHARS = 160
+CHAT_INDEX_COMPACT = int(os.environ.get("CHAT_INDEX_COMPACT", "500") or 500)
+_CHAT_INDEX_CACHE: Dict[str, Dict[str, Any]] = {}   # pid -> {"base", "pos", "lines", "chats"}
+
+def _chat_index_lock(pid: str):
+    return named_lock(f"chat-index:{pid}")
+
+def _chat_snippet(m: Optional[Dict[str, Any]]) -> str:
+    text = str((m or {}).get("content") or "")
+    return re.sub(r"\s+", " ", text).strip()[:CHAT_SNIPPET_CHARS]
+
+def _chat_summary(chat: Dict[str, Any]) -> Dict[str, Any]:
+    messages = chat.get("messages") or []
+    return {
+        "id": chat.get("id"),
+        "project_id": chat.get("project_id"),
+        "title": chat.get("title"),
+        "created_at": chat.get("created_at"),
+        "updated_at": chat.get("updated_at"),
+        "message_count": len(messages),
+        "last_snippet": _chat_snippet(messages[-1] if messages else None),
+    }
+
+def _chat_index_stamp(path: str) -> Optional[tuple]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _chat_index_replay(path: str, pos: int, chats: Dict[str, Dict[str, Any]]):
+    """Applies _index.log from byte `pos`; returns (new pos, lines applied)."""
+    applied = 0
+    try:
+        with open(path, "rb") as f:
+            f.seek(pos)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break   # torn or still being written: re-read it next time
+                pos += len(raw)
+                try:
+                    rec = json.loads(raw)
+                except Exception:
+                    continue
+                if rec.get("summary") is None:
+                    chats.pop(rec.get("id"), None)
+                else:
+                    chats[rec["id"]] = rec["summary"]
+                applied += 1
+    except OSError:
+        pass
+    return pos, applied
+
+def _chat_index_rebuild(pid: str) -> Dict[str, Dict[str, Any]]:
+    chats: Dict[str, Dict[str, Any]] = {}
+    for cid in chat_ids(pid):
+        chat = chat_load(pid, cid, compact=False)   # compaction takes the chat lock: never under this one
+        if chat is not None:
+            chats[cid] = _chat_summary({"id": cid, "project_id": pid, **chat})
+    if os.path.isdir(chats_dir(pid)):
+        write_json(chat_index_path(pid), {"version": 1, "chats": chats})
+        try:
+            os.remove(chat_index_log_path(pid))
+        except OSError:
+            pass
+    return chats
+
+def _chat_index_load(pid: str) -> Dict[str, Dict[str, Any]]:
+    """The merged index (callers hold the index lock and must not mutate the summaries)."""
+    base = _chat_index_stamp(chat_index_path(pid))
+    cached = _CHAT_INDEX_CACHE.get(pid)
+    if cached is None or base is None or cached["base"] != base:
+        data = read_json(chat_index_path(pid), None)
+        if isinstance(data, dict) and isinstance(data.get("chats"), dict):
+            chats = data["chats"]
+        else:
+            # Missing or unreadable: rebuild once from the chat files themselves.
+            chats = _chat_index_rebuild(pid)
+        cached = _CHAT_INDEX_CACHE[pid] = {"base": _chat_index_stamp(chat_index_path(pid)), "pos": 0, "lines": 0, "chats": chats}
+    pos, applied = _chat_index_replay(chat_index_log_path(pid), cached["pos"], cached["chats"])
+    cached["pos"] = pos
+    cached["lines"] += applied
+    return cached["chats"]
+
+def _chat_index_update(pid: str, cid: str, fn: Callable[[Optional[Dict[str, Any]]], Optional[Dict[str, Any]]]):
+    """Read-modify-write one summary; `fn` returns the new summary or None to drop it."""
+    with _chat_index_lock(pid):
+        chats = _chat_index_load(pid)
+        new = fn(chats.get(cid))
+        if new is None:
+            chats.pop(cid, None)
+        else:
+            chats[cid] = new
+        cached = _CHAT_INDEX_CACHE[pid]
+        if cached["lines"] + 1 >= CHAT_INDEX_COMPACT:
+            # Base first, then drop the log: a crash in between only replays summaries already in it.
+            write_json(chat_index_path(pid), {"version": 1, "chats": chats})
+            try:
+                os.remove(chat_index_log_path(pid))
+            except OSError:
+                pass
+            cached.update(base=_chat_index_stamp(chat_index_path(pid)), pos=0, lines=0)
+            return
+        log = chat_index_log_path(pid)
+        _chat_append_records(log, [{"id": cid, "summary": new}])
+        cached["pos"] = os.path.getsize(log)
+        cached["lines"] += 1
+
+def chat_summaries(pid: str) -> List[Dict[str, Any]]:
+    with _chat_index_lock(pid):
+        return list(_chat_index_load(pid).values())
+
+def chat_summary(pid: str, cid: str) -> Optional[Dict[str, Any]]:
+    with _chat_index_lock(pid):
+        return _chat_index_load(pid).get(cid)
+
+def chat_exists(pid: str, cid: str) -> bool:
+    return os.path.exists(chat_log_path(pid, cid)) or os.path.exists(chat_path(pid, cid))
+
+def chat_ids(pid: str) -> List[str]:
+    cdir = chats_dir(pid)
+    if not os.path.isdir(cdir):
+        return []
+    ids = set()
+    for f in os.listdir(cdir):
+        if f.endswith(".jsonl"):
+            ids.add(f[: -len(".jsonl")])
+        elif f.endswith(".json") and not f.startswith("_"):
+            ids.add(f[: -len(".json")])
+    return sorted(ids)
+
+def chat_create(pid: str, cid: str, title: Optional[str] = None) -> Dict[str, Any]:
+    chat = {
+        "id": cid,
+        "project_id": pid,
+        "title": title,
+        "messages": [],
+        "created_at": now_iso(),
+        "updated_at": now_iso(),
+    }
+    with chat_lock(pid, cid):
+        _chat_write_log(chat_log_path(pid, cid), chat)
+        _chat_index_update(pid, cid, lambda _old: _chat_summary(chat))
+    return chat
+
+def chat_compact(pid: str, cid: str) -> Optional[Dict[str, Any]]:
+    """Rewrites the log as header + messages; also converts a legacy .json chat."""
+    with chat_lock(pid, cid):
+        chat = chat_load(pid, cid, compact=False)
+        if chat is None:
+            return None
+        _chat_write_log(chat_log_path(pid, cid), chat)
+        legacy = chat_path(pid, cid)
+        if os.path.exists(legacy):
+            os.remove(legacy)
+            _chat_index_update(pid, cid, lambda _old: _chat_summary({"id": cid, "project_id": pid, **chat}))
+    return chat
+
+def chat_load(pid: str, cid: str, compact: bool = True) -> Optional[Dict[str, Any]]:
+    log = chat_log_path(pid, cid)
+    if os.path.exists(log):
+        records, meta_count, torn = _chat_read_log(log)
+        chat = _chat_from_records(records)
+        if compact and (torn or meta_count > CHAT_COMPACT_META):
+            # Re-read under the lock so an append that raced this read is not rewritten away.
+            return chat_compact(pid, cid)
+        return chat
+    # Legacy whole-document chats keep loading until their next append converts them.
+    return read_json(chat_path(pid, cid), None)
+
+def chat_append(pid: str, cid: str, messages: List[Dict[str, Any]], meta: Optional[Dict[str, Any]] = None):
+    with chat_lock(pid, cid):
+        _chat_append_locked(pid, cid, messages, meta)
+
+def _chat_append_locked(pid: str, cid: str, messages: List[Dict[str, Any]], meta: Optional[Dict[str, Any]]):
+    log = chat_log_path(pid, cid)
+    if not os.path.exists(log):
+        if os.path.exists(chat_path(pid, cid)):
+            chat_compact(pid, cid)
+        else:
+            chat_create(pid, cid)
+    records = [_chat_msg_record(m) for m in messages or []]
+    if meta:
+        records.append({"kind": "meta", **meta})
+    if not records:
+        return
+    _chat_append_records(log, records)
+
+    def bump(old: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        if old is None:
+            return _chat_summary(chat_load(pid, cid, compact=False) or {"id": cid, "project_id": pid})
+        new = dict(old)
+        if messages:
+            new["message_count"] = int(new.get("message_count") or 0) + len(messages)
+            new["last_snippet"] = _chat_snippet(messages[-1])
+            new["updated_at"] = messages[-1].get("ts") or now_iso()
+        new.update({k: v for k, v in (meta or {}).items() if k in ("title", "updated_at")})
+        return new
+
+    _chat_index_update(pid, cid, bump)
+
+def chat_tail(pid: str, cid: str, n: int) -> List[Dict[str, Any]]:
+    """Last `n` messages, read backwards from the end of the log without parsing the full history."""
+    n = max(0, int(n))
+    log = chat_log_path(pid, cid)
+    if not os.path.exists(log):
+        chat = chat_load(pid, cid) or {}
+        return (chat.get("messages") or [])[-n:] if n else []
+    found: List[Dict[str, Any]] = []
+    with open(log, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        buf = b""
+        while pos > 0 and len(found) < n:
+            step = min(_CHAT_TAIL_BLOCK, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+            lines = buf.split(b"\n")
+            # The first piece may be a partial line unless we reached the start of the file.
+            buf = lines.pop(0) if pos > 0 else b""
+            for raw in reversed(lines):
+                if len(found) >= n:
+                    break
+                if not raw.strip():
+                    continue
+                try:
+                    rec = json.loads(raw)
+                except Exception:
+                    continue
+                if rec.get("kind") == "message":
+                    m = dict(rec)
+                    m.pop("kind", None)
+                    found.append(m)
+    found.reverse()
+    return found
+
+def chat_delete(pid: str, cid: str) -> bool:
+    removed = False
+    with chat_lock(pid, cid):
+        for path in (chat_log_path(pid, cid), chat_path(pid, cid)):
+            if os.path.exists(path):
+                os.remove(path)
+                removed = True
+        if removed:
+            try:
+                os.remove(history_summary_path(pid, cid))
+            except OSError:
+                pass
+            trace_forget(pid, cid)
+            _chat_index_update(pid, cid, lambda _old: None)
+    return removed
+
+
 ###  ==================================================
 ###  =============== CHUNK: MODELS ====================
 ###  ==================================================
@@ -749,18 +2767,27 @@ class ProjectCreate(BaseModel):
     system_prompt: Optional[str] = ""
     model: Optional[str] = None
     root: Optional[str] = None
+    context_token_budget: Optional[int] = None   # None => CONTEXT_TOKEN_BUDGET, 0 => no file context
+    llm_cache: Optional[bool] = None             # None => LLM_CACHE
+    quota_bytes: Optional[int] = None            # None => PROJECT_QUOTA_BYTES, 0 => unlimited
+    history_token_budget: Optional[int] = None   # None => HISTORY_TOKEN_BUDGET, 0 => whole history
 
 class ProjectUpdate(BaseModel):
     name: Optional[str] = None
     system_prompt: Optional[str] = None
     model: Optional[str] = None
     root: Optional[str] = None
+    context_token_budget: Optional[int] = None   # negative => back to the server default
+    llm_cache: Optional[bool] = None
+    quota_bytes: Optional[int] = None            # negative => back to the server default
+    history_token_budget: Optional[int] = None   # negative => back to the server default
 
 class ChatCreate(BaseModel):
     title: Optional[str] = None
 
 class MessageIn(BaseModel):
     content: str
+    background: bool = False   # true => enqueue as a job and return 202 with its id (see JOBS)
 
 
 ###  ==================================================
@@ -768,8 +2795,7 @@ class MessageIn(BaseModel):
 ###  ==================================================
 @app.get("/projects")
 def api_list_projects():
-    ensure_data_dirs()
-    return {"projects": read_json(PROJECTS_FILE, {"projects": []})["projects"]}
+    return {"projects": projects_list()}
 
 @app.post("/projects")
 def api_create_project(body: ProjectCreate):
@@ -799,21 +2825,27 @@ def api_create_project(body: ProjectCreate):
         "system_prompt": body.system_prompt or DEFAULT_SYSTEM_PROMPT,
         "model": body.model,
         "root": root,
+        "context_token_budget": body.context_token_budget,
+        "llm_cache": body.llm_cache,
+        "quota_bytes": body.quota_bytes,
+        "history_token_budget": body.history_token_budget,
         "created_at": now_iso(),
         "updated_at": now_iso(),
     }
 
-    data = read_json(PROJECTS_FILE, {"projects": []})
-    data["projects"].append(p)
-    write_json(PROJECTS_FILE, data)
+    project_save(p)
     os.makedirs(chats_dir(pid), exist_ok=True)
     return {"project": p}
 
 @app.put("/projects/{pid}")
 def api_update_project(pid: str, body: ProjectUpdate):
-    ensure_data_dirs()
-    data = read_json(PROJECTS_FILE, {"projects": []})
-    proj = next((p for p in data["projects"] if p.get("id") == pid), None)
+    # Re-read under the project lock so concurrent updates (or the agent's
+    # set_project_instructions) are applied on top of each other, not lost.
+    with project_lock(pid):
+        return _update_project_locked(pid, body)
+
+def _update_project_locked(pid: str, body: ProjectUpdate):
+    proj = project_get(pid)
     if not proj:
         raise HTTPException(404, "Project not found")
 
@@ -828,23 +2860,33 @@ def api_update_project(pid: str, body: ProjectUpdate):
         new_root = (body.root or "").strip()
         proj["root"] = new_root if new_root else default_workspace_root_by_id(pid)
         os.makedirs(proj["root"], exist_ok=True)
+    if body.context_token_budget is not None:
+        proj["context_token_budget"] = body.context_token_budget if body.context_token_budget >= 0 else None
+    if body.llm_cache is not None:
+        proj["llm_cache"] = body.llm_cache
+    if body.quota_bytes is not None:
+        proj["quota_bytes"] = body.quota_bytes if body.quota_bytes >= 0 else None
+    if body.history_token_budget is not None:
+        proj["history_token_budget"] = body.history_token_budget if body.history_token_budget >= 0 else None
 
     proj["updated_at"] = now_iso()
-    write_json(PROJECTS_FILE, data)
+    project_save(proj)
     return {"project": proj}
 
 @app.delete("/projects/{pid}")
 def api_delete_project(pid: str):
-    ensure_data_dirs()
-    data = read_json(PROJECTS_FILE, {"projects": []})
-    if not any(p.get("id") == pid for p in data["projects"]):
+    with project_lock(pid):
+        removed = project_remove(pid)
+    if not removed:
         raise HTTPException(404, "Project not found")
-    data["projects"] = [p for p in data["projects"] if p.get("id") != pid]
-    write_json(PROJECTS_FILE, data)
     shutil.rmtree(project_dir(pid), ignore_errors=True)
+    _CHAT_INDEX_CACHE.pop(pid, None)
     shutil.rmtree(default_workspace_root_by_id(pid), ignore_errors=True)
+    _forget_workspace_roots(default_workspace_root_by_id(pid))
     try:
-        shutil.rmtree(workspace_root(pid), ignore_errors=True)
+        root = workspace_root(pid)
+        shutil.rmtree(root, ignore_errors=True)
+        _forget_workspace_roots(root)
     except Exception:
         pass
     return {"status": "ok"}
@@ -855,95 +2897,1534 @@ def api_delete_project(pid: str):
 ###  ==================================================
 ###  =============== CHUNK: CHATS API =================
 ###  ==================================================
+CHAT_SORT_KEYS = ("updated_at", "created_at", "title", "message_count")
+
 @app.get("/projects/{pid}/chats")
-def api_list_chats(pid: str):
-    cdir = chats_dir(pid)
-    os.makedirs(cdir, exist_ok=True)
-    chats = []
-    for f in os.listdir(cdir):
-        if f.endswith(".json"):
-            chats.append(read_json(os.path.join(cdir, f), {}))
-    chats.sort(key=lambda c: c.get("updated_at") or "", reverse=True)
-    return {"chats": chats}
+def api_list_chats(
+    pid: str,
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=100, ge=1, le=1000),
+    sort: str = Query(default="updated_at"),
+    order: str = Query(default="desc"),
+):
+    """Chat summaries (no message bodies), sorted and paginated from the per-project index."""
+    if sort not in CHAT_SORT_KEYS:
+        raise HTTPException(400, f"sort must be one of {', '.join(CHAT_SORT_KEYS)}")
+    os.makedirs(chats_dir(pid), exist_ok=True)
+    chats = chat_summaries(pid)
+    if sort == "message_count":
+        chats.sort(key=lambda c: int(c.get("message_count") or 0), reverse=(order != "asc"))
+    else:
+        chats.sort(key=lambda c: str(c.get(sort) or ""), reverse=(order != "asc"))
+    page = chats[offset: offset + limit]
+    next_offset = offset + len(page) if offset + len(page) < len(chats) else None
+    return {"chats": page, "total": len(chats), "offset": offset, "limit": limit, "next_offset": next_offset}
+
+
+@app.get("/projects/{pid}/chats/{cid}")
+def api_get_chat(pid: str, cid: str, last: Optional[int] = Query(default=None, ge=1)):
+    """One chat with its messages; `last=N` returns only the most recent N."""
+    if not chat_exists(pid, cid):
+        raise HTTPException(404, "Chat not found")
+    if last is not None:
+        summary = chat_summary(pid, cid) or {"id": cid, "project_id": pid}
+        chat = {k: v for k, v in summary.items() if k not in ("message_count", "last_snippet")}
+        chat["messages"] = chat_tail(pid, cid, last)
+        chat["message_count"] = summary.get("message_count")
+        return {"chat": chat}
+    return {"chat": chat_load(pid, cid)}
 
 
 @app.post("/projects/{pid}/chats")
 def api_create_chat(pid: str, body: ChatCreate):
     cid = str(uuid.uuid4())[:8]
-    chat = {
-        "id": cid,
-        "project_id": pid,
-        "title": body.title or f"Chat {cid}",
-        "messages": [],
-        "created_at": now_iso(),
-        "updated_at": now_iso(),
-    }
-    os.makedirs(chats_dir(pid), exist_ok=True)
-    write_json(chat_path(pid, cid), chat)
+    chat = chat_create(pid, cid, title=body.title or f"Chat {cid}")
     return {"chat": chat}
 
 
 @app.delete("/projects/{pid}/chats/{cid}")
 def api_delete_chat(pid: str, cid: str):
-    path = chat_path(pid, cid)
-    if not os.path.exists(path):
+    if not chat_delete(pid, cid):
         raise HTTPException(404, "Chat not found")
-    os.remove(path)
     return {"status": "ok"}
 
 
-def gather_project_files(pid: str, max_chars: int = 10000) -> str:
-    """Collects small text snippets from files in the project's workspace."""
+###  ==================================================
+###  ============== CHUNK: WORKSPACE WATCH =============
+###  ==================================================
+# One watcher thread per active workspace root. On Linux it uses inotify through ctypes
+# (one watch per directory, denied dirs skipped); elsewhere, or once the kernel's watch
+# limit is hit, it polls with _walk_workspace. Changes are debounced, coalesced into
+# batches of relative paths and published on an in-process bus (watch_subscribe) and to
+# /projects/{pid}/files/events (SSE). Caches that trust a live inotify watcher (context
+# digests, search index) skip their re-stat walks. Unused watchers stop after WATCH_IDLE_S.
+WORKSPACE_WATCH = _env_flag("WORKSPACE_WATCH", default=True)
+WATCH_DEBOUNCE_MS = int(os.environ.get("WATCH_DEBOUNCE_MS", "200") or 200)     # quiet time before a batch is sent
+WATCH_MAX_DELAY_MS = int(os.environ.get("WATCH_MAX_DELAY_MS", "1000") or 1000)  # ...but never hold changes longer
+WATCH_POLL_S = float(os.environ.get("WATCH_POLL_S", "2") or 2)
+WATCH_IDLE_S = float(os.environ.get("WATCH_IDLE_S", "300") or 300)
+WATCH_MAX_ROOTS = int(os.environ.get("WATCH_MAX_ROOTS", "16") or 16)
+WATCH_MAX_BATCH = 500          # larger batches are sent as "full" (re-scan everything)
+WATCH_SSE_PING_S = 15.0
+
+# inotify(7)
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_DELETE_SELF, IN_MOVE_SELF, IN_Q_OVERFLOW, IN_IGNORED = 0x400, 0x800, 0x4000, 0x8000
+IN_ONLYDIR, IN_DONT_FOLLOW, IN_EXCL_UNLINK, IN_ISDIR = 0x01000000, 0x02000000, 0x04000000, 0x40000000
+_IN_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+)
+_IN_EVENT = struct.Struct("iIII")   # wd, mask, cookie, len (+ name, NUL padded)
+_INOTIFY: Dict[str, Any] = {"checked": False, "libc": None}
+
+def _inotify_libc() -> Any:
+    """libc with the inotify calls, or None (not Linux / not available)."""
+    if not _INOTIFY["checked"]:
+        _INOTIFY["checked"] = True
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+                libc.inotify_init1.argtypes = [ctypes.c_int]
+                libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+                libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+                _INOTIFY["libc"] = libc
+            except (OSError, AttributeError):
+                pass
+    return _INOTIFY["libc"]
+
+def _coalesce_paths(paths: set) -> List[str]:
+    """Drops paths whose ancestor directory is also listed (consumers rescan that subtree)."""
+    kept: set = set()
+    for p in sorted(paths, key=lambda s: s.count("/")):
+        parts = p.split("/")
+        if not any("/".join(parts[:i]) in kept for i in range(1, len(parts))):
+            kept.add(p)
+    return sorted(kept)
+
+
+class _WorkspaceWatcher:
+    def __init__(self, root: str, mode: str):
+        self.root = root
+        self.mode = mode                  # "inotify" | "poll"
+        self.refs = 0                     # open /files/events streams
+        self.last_used = time.time()
+        self.ready = threading.Event()
+        self.stopping = threading.Event()
+        self.fd = -1
+        self.wds: Dict[int, str] = {}     # watch descriptor -> relative dir
+        self.pending: set = set()
+        self.full = False
+        self.first_change = self.last_change = 0.0
+        self.thread = threading.Thread(target=self._run, name="workspace-watch", daemon=True)
+
+    def live(self) -> bool:
+        """True when every change is being reported promptly (inotify, fully set up)."""
+        return self.mode == "inotify" and self.ready.is_set() and not self.stopping.is_set()
+
+    def stop(self):
+        self.stopping.set()
+
+    def _run(self):
+        try:
+            if self.mode == "inotify" and not self._inotify_open():
+                self.mode = "poll"
+            if self.mode == "inotify":
+                self._inotify_loop()
+            if self.mode == "poll" and not self.stopping.is_set():
+                self._poll_loop()
+        except Exception:
+            pass
+        finally:
+            self._close()
+            self.stopping.set()
+            _watch_forget(self)
+
+    # --- change batching ---
+    def _changed(self, rel: Optional[str]):
+        """Records a changed path; None means "rescan everything" (overflow, root moved)."""
+        now = time.monotonic()
+        if not self.pending and not self.full:
+            self.first_change = now
+        self.last_change = now
+        if rel is None or rel == "":
+            self.full = True
+            self.pending.clear()
+        elif not self.full:
+            self.pending.add(rel)
+
+    def _flush(self, force: bool = False):
+        if not self.pending and not self.full:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_change < WATCH_DEBOUNCE_MS / 1000.0 and now - self.first_change < WATCH_MAX_DELAY_MS / 1000.0:
+            return
+        paths, full = _coalesce_paths(self.pending), self.full
+        self.pending, self.full = set(), False
+        if len(paths) > WATCH_MAX_BATCH:
+            paths, full = [], True
+        watch_publish(self.root, paths, full=full, source=self.mode)
+
+    def _idle(self) -> bool:
+        with _WATCH_LOCK:
+            if self.refs > 0 or time.time() - self.last_used < WATCH_IDLE_S:
+                return False
+            self.stopping.set()
+            if _WATCHERS.get(self.root) is self:
+                _WATCHERS.pop(self.root, None)
+            return True
+
+    # --- inotify ---
+    def _inotify_open(self) -> bool:
+        libc = _inotify_libc()
+        if libc is None:
+            return False
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return False
+        self.fd = fd
+        if not self._add_tree(""):
+            self._close()
+            return False
+        return True
+
+    def _add_tree(self, rel: str) -> bool:
+        """Watches `rel` and its subdirectories; False once the kernel's watch limit is reached."""
+        libc = _inotify_libc()
+        stack = [rel]
+        while stack:
+            d = stack.pop()
+            path = os.path.join(self.root, d) if d else self.root
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(path), _IN_MASK)
+            if wd < 0:
+                if ctypes.get_errno() in (errno.ENOSPC, errno.ENOMEM):
+                    return False
+                continue   # vanished, not a directory, or unreadable
+            self.wds[wd] = d
+            try:
+                with os.scandir(path) as it:
+                    for e in it:
+                        sub = f"{d}/{e.name}" if d else e.name
+                        if e.is_dir(follow_symlinks=False) and not _llm_denied_path(sub):
+                            stack.append(sub)
+            except OSError:
+                continue
+        return True
+
+    def _unwatch(self, rel: str):
+        libc = _inotify_libc()
+        for wd, d in list(self.wds.items()):
+            if d == rel or d.startswith(rel + "/"):
+                libc.inotify_rm_watch(self.fd, wd)
+                self.wds.pop(wd, None)
+
+    def _close(self):
+        if self.fd >= 0:
+            try:
+                os.close(self.fd)   # drops every watch
+            except OSError:
+                pass
+        self.fd = -1
+        self.wds.clear()
+
+    def _inotify_loop(self):
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        self.ready.set()
+        while not self.stopping.is_set():
+            timeout_ms = max(10, WATCH_DEBOUNCE_MS // 2) if (self.pending or self.full) else 1000
+            if poller.poll(timeout_ms):
+                try:
+                    data = os.read(self.fd, 64 * 1024)
+                except BlockingIOError:
+                    data = b""
+                if not self._inotify_events(data):
+                    # Watch limit reached: degrade to polling, and make consumers rescan.
+                    self._close()
+                    self.mode = "poll"
+                    self._changed(None)
+                    self._flush(force=True)
+                    return
+            self._flush()
+            if self._idle():
+                return
+
+    def _inotify_events(self, data: bytes) -> bool:
+        off = 0
+        while off + _IN_EVENT.size <= len(data):
+            wd, mask, _, ln = _IN_EVENT.unpack_from(data, off)
+            off += _IN_EVENT.size
+            name = os.fsdecode(data[off: off + ln].rstrip(b"\0"))
+            off += ln
+            if mask & IN_Q_OVERFLOW:
+                self._changed(None)
+                continue
+            if mask & IN_IGNORED:
+                self.wds.pop(wd, None)
+                continue
+            d = self.wds.get(wd)
+            if d is None:
+                continue
+            if not name:
+                # Events on a watched directory itself; its parent reports the same change.
+                if d == "" and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    self._changed(None)
+                continue
+            rel = f"{d}/{name}" if d else name
+            if _llm_denied_path(rel):
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    if not self._add_tree(rel):
+                        return False
+                elif mask & (IN_MOVED_FROM | IN_DELETE):
+                    self._unwatch(rel)
+            self._changed(rel)
+        return True
+
+    # --- polling fallback ---
+    def _snapshot(self) -> Dict[str, Any]:
+        return {rel: (mtime_ns, size) for rel, mtime_ns, size in _walk_workspace(self.root)}
+
+    def _poll_loop(self):
+        snap = self._snapshot()
+        self.ready.set()
+        while not self.stopping.wait(WATCH_POLL_S):
+            new = self._snapshot()
+            for rel in new.keys() ^ snap.keys():
+                self._changed(rel)
+            for rel, stamp in new.items():
+                if rel in snap and snap[rel] != stamp:
+                    self._changed(rel)
+            snap = new
+            self._flush(force=True)
+            if self._idle():
+                return
+
+
+_WATCHERS: Dict[str, _WorkspaceWatcher] = {}
+_WATCH_LOCK = threading.Lock()
+_WATCH_SUBSCRIBERS: List[Callable[[Dict[str, Any]], None]] = []
+
+def watch_subscribe(fn: Callable[[Dict[str, Any]], None]) -> Callable[[], None]:
+    """
+    Calls fn({"root", "paths", "full", "source", "ts"}) for every change batch, from the
+    watcher's thread (or the request thread for source="app"). `paths` are relative to
+    `root`; full=True means "anything may have changed". Returns an unsubscribe function.
+    """
+    _WATCH_SUBSCRIBERS.append(fn)
+
+    def unsubscribe():
+        try:
+            _WATCH_SUBSCRIBERS.remove(fn)
+        except ValueError:
+            pass
+    return unsubscribe
+
+def watch_publish(root: str, paths: List[str], full: bool = False, source: str = "app"):
+    ev = {"root": root, "paths": list(paths), "full": bool(full), "source": source, "ts": time.time()}
+    for fn in list(_WATCH_SUBSCRIBERS):
+        try:
+            fn(ev)
+        except Exception:
+            pass
+
+def workspace_watch(root: str, poll: bool = False, hold: bool = False) -> Optional[_WorkspaceWatcher]:
+    """
+    Starts (or keeps alive) the watcher for `root`. Without `poll` only an inotify watcher is
+    started: a polling one costs a workspace walk every WATCH_POLL_S and only pays off for
+    live listeners. `hold` takes a reference to be returned with workspace_unwatch.
+    """
+    if not WORKSPACE_WATCH:
+        return None
+    mode = "inotify" if _inotify_libc() is not None else "poll"
+    with _WATCH_LOCK:
+        w = _WATCHERS.get(root)
+        if w is None:
+            if mode == "poll" and not poll:
+                return None
+            if len(_WATCHERS) >= WATCH_MAX_ROOTS:
+                idle = [x for x in _WATCHERS.values() if x.refs <= 0]
+                if not idle:
+                    return None
+                victim = min(idle, key=lambda x: x.last_used)
+                victim.stop()
+                _WATCHERS.pop(victim.root, None)
+            w = _WATCHERS[root] = _WorkspaceWatcher(root, mode)
+            w.thread.start()
+        w.last_used = time.time()
+        if hold:
+            w.refs += 1
+        return w
+
+def workspace_unwatch(w: _WorkspaceWatcher):
+    with _WATCH_LOCK:
+        w.refs = max(0, w.refs - 1)
+        w.last_used = time.time()
+
+def watch_live(root: str) -> Optional[_WorkspaceWatcher]:
+    """The watcher for `root` if it currently reports every change, else None."""
+    w = _WATCHERS.get(root)
+    return w if w is not None and w.live() else None
+
+def _watch_forget(w: _WorkspaceWatcher):
+    with _WATCH_LOCK:
+        if _WATCHERS.get(w.root) is w:
+            _WATCHERS.pop(w.root, None)
+
+def _watch_drop(path: str):
+    """Stops watchers for roots at or below `path` (the directory was removed)."""
+    base = os.path.abspath(path)
+    with _WATCH_LOCK:
+        for root in [r for r in _WATCHERS if r == base or r.startswith(base + os.sep)]:
+            _WATCHERS.pop(root).stop()
+
+async def _watch_stop_all():
+    with _WATCH_LOCK:
+        watchers = list(_WATCHERS.values())
+        _WATCHERS.clear()
+    for w in watchers:
+        w.stop()
+
+_SHUTDOWN_HOOKS.append(_watch_stop_all)
+
+@app.get("/projects/{pid}/files/events")
+async def api_files_events(pid: str, request: Request):
+    """
+    Server-sent events for workspace changes: "ready" once, then "change" with
+    {"paths": [...], "full": bool, "source": ...}. Comment lines keep idle connections open.
+    """
     root = workspace_root(pid)
-    snippets = []
-    for dirpath, _, filenames in os.walk(root):
-        for fn in filenames:
+    w = await run_in_threadpool(workspace_watch, root, True, True)
+    if w is None:
+        raise HTTPException(503, "File watching is disabled or at capacity")
+    loop = asyncio.get_running_loop()
+    queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=256)
+
+    def put(ev: Dict[str, Any]):
+        if queue.full():
+            # A slow client gets one "rescan everything" instead of an unbounded backlog.
+            while not queue.empty():
+                queue.get_nowait()
+            ev = {**ev, "paths": [], "full": True}
+        queue.put_nowait(ev)
+
+    def deliver(ev: Dict[str, Any]):
+        if ev["root"] == root:
             try:
-                p = os.path.join(dirpath, fn)
-                with open(p, "r", encoding="utf-8") as f:
-                    text = f.read(max_chars)
-                    rel = os.path.relpath(p, root)
-                    snippets.append(f"### {rel}\n{text}\n")
-            except Exception:
+                loop.call_soon_threadsafe(put, ev)
+            except RuntimeError:
+                pass   # loop closed
+
+    unsubscribe = watch_subscribe(deliver)
+
+    async def events():
+        try:
+            await run_in_threadpool(w.ready.wait, 30)
+            yield "event: ready\ndata: " + json.dumps({"mode": w.mode}) + "\n\n"
+            while not await request.is_disconnected():
+                try:
+                    ev = await asyncio.wait_for(queue.get(), timeout=WATCH_SSE_PING_S)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                data = {"paths": ev["paths"], "full": ev["full"], "source": ev["source"]}
+                yield "event: change\ndata: " + json.dumps(data, ensure_ascii=False) + "\n\n"
+        finally:
+            unsubscribe()
+            workspace_unwatch(w)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+###  ==================================================
+###  =========== CHUNK: PROJECT FILES CONTEXT ==========
+###  ==================================================
+# Per-workspace digest cache keyed by (relpath -> (mtime_ns, size)); only changed files are re-read.
+# Each turn ranks files against the latest user message and fills a token budget.
+# While an inotify watcher is live for the root, only the paths it reported are re-stat'ed.
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "6000") or 6000)
+CONTEXT_FILE_MAX_CHARS = int(os.environ.get("CONTEXT_FILE_MAX_CHARS", "10000") or 10000)
+CONTEXT_MAX_FILE_BYTES = int(os.environ.get("CONTEXT_MAX_FILE_BYTES", "1000000") or 1000000)
+CONTEXT_MAX_FILES = int(os.environ.get("CONTEXT_MAX_FILES", "20000") or 20000)
+_BINARY_EXTS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".bmp", ".ico", ".webp", ".pdf", ".zip", ".gz", ".tgz", ".bz2", ".xz",
+    ".7z", ".rar", ".tar", ".exe", ".dll", ".so", ".dylib", ".bin", ".o", ".a", ".class", ".jar", ".pyc",
+    ".whl", ".mp3", ".mp4", ".wav", ".ogg", ".webm", ".mov", ".avi", ".woff", ".woff2", ".ttf", ".otf",
+    ".sqlite", ".db", ".parquet", ".npy", ".npz", ".pt", ".pth", ".ckpt", ".safetensors", ".onnx", ".h5",
+}
+_TERM_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]{2,}")
+
+_CONTEXT_DIGESTS: Dict[str, Dict[str, Dict[str, Any]]] = {}
+_CONTEXT_LOCKS: Dict[str, threading.Lock] = {}
+_CONTEXT_LOCKS_GUARD = threading.Lock()
+_CONTEXT_DIRTY: Dict[str, set] = {}   # root -> paths changed since the last refresh ("" = everything)
+_CONTEXT_BASIS: Dict[str, Any] = {}   # root -> watcher that was live when the digests were last walked
+_CONTEXT_LINKS: Dict[str, set] = {}   # root -> symlinked files (re-stated on every refresh: inotify misses target edits)
+
+def _approx_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+def _terms(text: str) -> set:
+    return {t.lower() for t in _TERM_RE.findall(text or "")}
+
+def _read_text_head(path: str, max_chars: int) -> Optional[str]:
+    """First `max_chars` of a UTF-8 file, or None when the file looks binary."""
+    with open(path, "rb") as f:
+        data = f.read(max_chars * 4)
+    if b"\0" in data[:8192]:
+        return None
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut by the read limit is fine; anything else is not text.
+        if e.start < len(data) - 3:
+            return None
+        text = data[: e.start].decode("utf-8", errors="ignore")
+    return text[:max_chars]
+
+def _walk_workspace(root: str, links: Optional[set] = None):
+    """Yields (relpath, mtime_ns, size) for allowed files, pruning denied dirs via _llm_denied_path.
+
+    Symlinked files are followed; their relpaths are also added to `links` when given.
+    """
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            it = os.scandir(os.path.join(root, rel_dir) if rel_dir else root)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                if _llm_denied_path(rel):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(rel)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        if links is not None and entry.is_symlink():
+                            links.add(rel)
+                        yield rel, st.st_mtime_ns, st.st_size
+                except OSError:
+                    continue
+
+def _digest_file(root: str, rel: str, mtime_ns: int, size: int) -> Dict[str, Any]:
+    digest: Dict[str, Any] = {"stamp": (mtime_ns, size), "mtime_ns": mtime_ns, "binary": True, "text": "", "terms": frozenset(), "truncated": False}
+    _, ext = os.path.splitext(rel.lower())
+    if ext in _BINARY_EXTS or size > CONTEXT_MAX_FILE_BYTES:
+        return digest
+    try:
+        text = _read_text_head(os.path.join(root, rel), CONTEXT_FILE_MAX_CHARS)
+    except OSError:
+        text = None
+    if text is None:
+        return digest
+    digest.update(binary=False, text=text, terms=frozenset(_terms(text)), truncated=size > len(text.encode("utf-8")))
+    return digest
+
+def _context_on_change(ev: Dict[str, Any]):
+    with _CONTEXT_LOCKS_GUARD:
+        if ev["root"] not in _CONTEXT_BASIS:
+            return
+        dirty = _CONTEXT_DIRTY.setdefault(ev["root"], set())
+        if ev["full"] or "" in ev["paths"] or len(dirty) + len(ev["paths"]) > CONTEXT_MAX_FILES:
+            dirty.clear()
+            dirty.add("")
+        elif "" not in dirty:
+            dirty.update(ev["paths"])
+
+watch_subscribe(_context_on_change)
+
+def _context_apply(root: str, digests: Dict[str, Dict[str, Any]], rel: str, links: set):
+    """Re-stats one changed path (a file, or a directory's whole subtree) into `digests` and `links`."""
+    prefix = rel + "/"
+    prev = {r: digests.pop(r) for r in [r for r in digests if r == rel or r.startswith(prefix)]}
+    links.difference_update([r for r in links if r == rel or r.startswith(prefix)])
+    if _llm_denied_path(rel):
+        return
+    target = os.path.join(root, rel)
+    if os.path.isdir(target) and not os.path.islink(target):
+        sub_links: set = set()
+        items: Any = list(_walk_workspace(target, sub_links))
+        items = [(f"{rel}/{sub}", mtime_ns, size) for sub, mtime_ns, size in items]
+        links.update(f"{rel}/{sub}" for sub in sub_links)
+    elif os.path.isfile(target):
+        try:
+            st = os.stat(target)
+        except OSError:
+            return
+        items = [(rel, st.st_mtime_ns, st.st_size)]
+        if os.path.islink(target):
+            links.add(rel)
+    else:
+        return
+    for r, mtime_ns, size in items:
+        if len(digests) >= CONTEXT_MAX_FILES:
+            break
+        if _llm_denied_path(r):
+            continue
+        d = prev.get(r)
+        if d is None or d["stamp"] != (mtime_ns, size):
+            d = _digest_file(root, r, mtime_ns, size)
+        digests[r] = d
+
+def _context_refresh(root: str) -> Dict[str, Dict[str, Any]]:
+    with _CONTEXT_LOCKS_GUARD:
+        lock = _CONTEXT_LOCKS.setdefault(root, threading.Lock())
+    with lock:
+        w = watch_live(root)
+        with _CONTEXT_LOCKS_GUARD:
+            dirty = _CONTEXT_DIRTY.pop(root, set())
+            basis = _CONTEXT_BASIS.get(root)
+            _CONTEXT_BASIS[root] = w
+        old = _CONTEXT_DIGESTS.get(root)
+        if old is not None and w is not None and basis is w and "" not in dirty:
+            # The same live watcher has seen every change since the last walk, except edits
+            # behind symlinks (inotify watches the link's directory, not the target's).
+            fresh = dict(old)
+            links = _CONTEXT_LINKS.setdefault(root, set())
+            for rel in dirty | links:
+                _context_apply(root, fresh, rel, links)
+        else:
+            old = old or {}
+            fresh = {}
+            links = _CONTEXT_LINKS[root] = set()
+            for rel, mtime_ns, size in _walk_workspace(root, links):
+                if len(fresh) >= CONTEXT_MAX_FILES:
+                    break
+                d = old.get(rel)
+                if d is None or d["stamp"] != (mtime_ns, size):
+                    d = _digest_file(root, rel, mtime_ns, size)
+                fresh[rel] = d
+        _CONTEXT_DIGESTS[root] = fresh
+        return fresh
+
+def _rank_context_files(digests: Dict[str, Dict[str, Any]], query: str) -> List[str]:
+    texts = [rel for rel, d in digests.items() if not d["binary"] and d["text"].strip()]
+    q = _terms(query)
+    n = max(1, len(texts))
+    idf = {t: math.log(1 + n / (1 + sum(1 for rel in texts if t in digests[rel]["terms"]))) for t in q}
+
+    def score(rel: str) -> float:
+        d = digests[rel]
+        path_terms = _terms(rel.replace("/", " ").replace(".", " "))
+        s = sum(w for t, w in idf.items() if t in d["terms"])
+        s += sum(2.0 * w for t, w in idf.items() if t in path_terms)
+        return s
+
+    # Relevance first, then most recently modified, then shortest (cheapest) files.
+    return sorted(texts, key=lambda rel: (-score(rel), -digests[rel]["mtime_ns"], len(digests[rel]["text"])))
+
+def gather_project_files(pid: str, query: str = "", token_budget: Optional[int] = None) -> str:
+    """Builds the project files context: the most relevant text files, within a token budget."""
+    budget = CONTEXT_TOKEN_BUDGET if token_budget is None else int(token_budget)
+    if budget <= 0:
+        return ""
+    t0 = time.perf_counter()
+    out = _gather_project_files(pid, query, budget)
+    metric_observe("context_gather_duration_seconds", time.perf_counter() - t0)
+    metric_observe("context_gather_bytes", len(out.encode("utf-8")))
+    return out
+
+def _gather_project_files(pid: str, query: str, budget: int) -> str:
+    root = workspace_root(pid)
+    digests = _context_refresh(root)
+    snippets = []
+    remaining = budget
+    for rel in _rank_context_files(digests, query):
+        d = digests[rel]
+        block = f"### {rel}\n{d['text']}\n"
+        cost = _approx_tokens(block)
+        if cost > remaining:
+            # Only trim a file when a meaningful slice still fits; otherwise try smaller files.
+            if remaining < 200:
                 continue
-    return "\n".join(snippets[: max_chars])
+            block = block[: remaining * 4 - 20] + "\n...(truncated)\n"
+            cost = _approx_tokens(block)
+        elif d["truncated"]:
+            block += "...(truncated)\n"
+            cost = _approx_tokens(block)
+        snippets.append(block)
+        remaining -= cost
+        if remaining <= 0:
+            break
+    return "\n".join(snippets)
 
 
-@app.post("/projects/{pid}/chats/{cid}/message")
-def api_send_message(pid: str, cid: str, body: MessageIn):
-    path = chat_path(pid, cid)
-    chat = read_json(
-        path,
-        {"id": cid, "project_id": pid, "messages": [], "created_at": now_iso(), "updated_at": now_iso()},
+###  ==================================================
+###  =============== CHUNK: SEARCH INDEX ==============
+###  ==================================================
+# Per-workspace trigram inverted index behind the search_text tool.
+# Postings map a lowercased 3-char gram to an array of file ids; removed files are
+# tombstoned and the postings are compacted once enough of them pile up.
+# Freshness: a throttled mtime/size sync before queries, plus hooks from the file routes;
+# while an inotify watcher is live for the root its change batches replace the sync walk.
+SEARCH_MAX_FILE_BYTES = int(os.environ.get("SEARCH_MAX_FILE_BYTES", "500000") or 500000)
+SEARCH_INDEX_SYNC_SECONDS = float(os.environ.get("SEARCH_INDEX_SYNC_SECONDS", "2") or 2)
+SEARCH_INDEX_MAX_ROOTS = int(os.environ.get("SEARCH_INDEX_MAX_ROOTS", "8") or 8)
+
+try:
+    import re._parser as _re_parser  # Python 3.11+
+except ImportError:  # pragma: no cover
+    import sre_parse as _re_parser
+
+def _grams(text: str) -> set:
+    t = text.lower()
+    return {t[i:i + 3] for i in range(len(t) - 2)}
+
+def _regex_required_literals(pattern: str) -> List[str]:
+    """Literal runs every match must contain (top-level only; alternations give nothing)."""
+    try:
+        parsed = _re_parser.parse(pattern)
+    except Exception:
+        return []
+    runs, cur = [], []
+    for op, arg in parsed:
+        if op is _re_parser.LITERAL:
+            cur.append(chr(arg))
+            continue
+        if cur:
+            runs.append("".join(cur))
+        cur = []
+    if cur:
+        runs.append("".join(cur))
+    return [r for r in runs if len(r) >= 3]
+
+def _read_search_text(path: str) -> Optional[str]:
+    with open(path, "rb") as f:
+        data = f.read(SEARCH_MAX_FILE_BYTES + 1)
+    if len(data) > SEARCH_MAX_FILE_BYTES or b"\0" in data[:8192]:
+        return None
+    return data.decode("utf-8", errors="ignore")
+
+
+class _SearchIndex:
+    def __init__(self, root: str):
+        self.root = root
+        self.lock = threading.RLock()
+        self.sync_lock = threading.Lock()   # one build/sync walk at a time; held outside `lock`
+        self.ready = threading.Event()
+        self.ids: Dict[str, int] = {}
+        self.paths: List[Optional[str]] = []
+        self.stamps: Dict[str, Any] = {}
+        self.postings: Dict[str, array] = {}
+        self.dead = 0
+        self.last_sync = 0.0
+        self.last_used = time.time()
+        self.watch: Any = None   # watcher that was live at the last full sync
+        self.links: set = set()  # symlinked files; inotify misses edits to their targets
+
+    # --- maintenance ---
+    def _index_file(self, rel: str, stamp: Any):
+        self._drop(rel)
+        self.stamps[rel] = stamp
+        _, ext = os.path.splitext(rel.lower())
+        if ext in _BINARY_EXTS or stamp[1] > SEARCH_MAX_FILE_BYTES:
+            return
+        try:
+            text = _read_search_text(os.path.join(self.root, rel))
+        except OSError:
+            text = None
+        if text is None:
+            return
+        fid = len(self.paths)
+        self.paths.append(rel)
+        self.ids[rel] = fid
+        for g in _grams(text):
+            arr = self.postings.get(g)
+            if arr is None:
+                arr = self.postings[g] = array("I")
+            arr.append(fid)
+
+    def _drop(self, rel: str):
+        self.stamps.pop(rel, None)
+        fid = self.ids.pop(rel, None)
+        if fid is not None:
+            self.paths[fid] = None
+            self.dead += 1
+
+    def _maybe_compact(self):
+        if self.dead < 1000 or self.dead * 3 < len(self.paths):
+            return
+        remap, paths = {}, []
+        for fid, rel in enumerate(self.paths):
+            if rel is not None:
+                remap[fid] = len(paths)
+                paths.append(rel)
+        postings = {}
+        for g, arr in self.postings.items():
+            kept = array("I", (remap[f] for f in arr if f in remap))
+            if kept:
+                postings[g] = kept
+        self.paths, self.postings, self.dead = paths, postings, 0
+        self.ids = {rel: i for i, rel in enumerate(paths)}
+
+    def sync(self, force: bool = False):
+        """Re-stat the workspace and reindex changed files (throttled, one walk at a time)."""
+        called = time.time()
+        with self.sync_lock:
+            if not force and self.last_sync >= called:
+                return   # a walk that started after this call finished while we waited
+            self._sync(force)
+
+    def _sync(self, force: bool):
+        w = watch_live(self.root)
+        if not force and w is not None and w is self.watch:
+            # The watcher feeds refresh_path (see _search_on_change); symlinks are re-stated here.
+            for rel in list(self.links):
+                try:
+                    st = os.stat(os.path.join(self.root, rel))
+                    if self.stamps.get(rel) == (st.st_mtime_ns, st.st_size):
+                        continue
+                except OSError:
+                    pass
+                self.refresh_path(rel)
+            return
+        now = time.time()
+        if not force and now - self.last_sync < SEARCH_INDEX_SYNC_SECONDS:
+            return
+        self.watch = w
+        seen = {}
+        links: set = set()
+        for rel, mtime_ns, size in _walk_workspace(self.root, links):
+            seen[rel] = (mtime_ns, size)
+        with self.lock:
+            self.links = links
+            for rel in [r for r in self.stamps if r not in seen]:
+                self._drop(rel)
+            for rel, stamp in seen.items():
+                if self.stamps.get(rel) != stamp:
+                    self._index_file(rel, stamp)
+            self._maybe_compact()
+            self.last_sync = now   # when the walk started: later changes need another one
+
+    def build(self):
+        try:
+            self.sync(force=True)
+        finally:
+            self.ready.set()
+
+    def refresh_path(self, rel: str):
+        """Hook for file routes: reindex `rel` (file or directory) or drop it if gone."""
+        rel = rel.replace("\\", "/").strip("/")
+        target = os.path.join(self.root, rel) if rel else self.root
+        with self.lock:
+            prefix = rel + "/" if rel else ""
+            for r in [r for r in self.stamps if r == rel or r.startswith(prefix)]:
+                self._drop(r)
+            self.links.difference_update([r for r in self.links if r == rel or r.startswith(prefix)])
+            if os.path.isfile(target):
+                if not _llm_denied_path(rel):
+                    st = os.stat(target)
+                    self._index_file(rel, (st.st_mtime_ns, st.st_size))
+                    if os.path.islink(target):
+                        self.links.add(rel)
+            elif os.path.isdir(target):
+                sub_links: set = set()
+                for sub, mtime_ns, size in _walk_workspace(target, sub_links):
+                    full = f"{rel}/{sub}" if rel else sub
+                    if not _llm_denied_path(full):
+                        self._index_file(full, (mtime_ns, size))
+                self.links.update(f"{rel}/{sub}" if rel else sub for sub in sub_links)
+            self._maybe_compact()
+
+    # --- queries ---
+    def candidates(self, literals: List[str]) -> List[str]:
+        with self.lock:
+            grams = set()
+            for lit in literals:
+                grams |= _grams(lit)
+            if not grams:
+                return sorted(r for r in self.paths if r is not None)
+            arrays = []
+            for g in grams:
+                arr = self.postings.get(g)
+                if not arr:
+                    return []
+                arrays.append(arr)
+            arrays.sort(key=len)
+            ids = set(arrays[0])
+            for arr in arrays[1:]:
+                ids.intersection_update(arr)
+                if not ids:
+                    return []
+            return sorted(self.paths[f] for f in ids if self.paths[f] is not None)
+
+
+_SEARCH_INDEXES: Dict[str, _SearchIndex] = {}
+_SEARCH_INDEXES_LOCK = threading.Lock()
+
+def search_index_for(root: str, start: bool = True) -> Optional[_SearchIndex]:
+    """Returns the workspace index, starting a background build on first use."""
+    with _SEARCH_INDEXES_LOCK:
+        idx = _SEARCH_INDEXES.get(root)
+        if idx is None and start:
+            if len(_SEARCH_INDEXES) >= SEARCH_INDEX_MAX_ROOTS:
+                oldest = min(_SEARCH_INDEXES.values(), key=lambda i: i.last_used)
+                _SEARCH_INDEXES.pop(oldest.root, None)
+            idx = _SEARCH_INDEXES[root] = _SearchIndex(root)
+            threading.Thread(target=idx.build, name="search-index", daemon=True).start()
+        if idx is not None:
+            idx.last_used = time.time()
+        return idx
+
+def _search_index_touch(pid: str, *abs_paths: str):
+    root = workspace_root(pid)
+    rels = []
+    for p in abs_paths:
+        rel = os.path.relpath(p, root)
+        if rel == "." or not rel.startswith(".."):
+            rels.append("" if rel == "." else rel.replace(os.sep, "/"))
+    idx = search_index_for(root, start=False)
+    if idx is not None:
+        for rel in rels:
+            idx.refresh_path(rel)
+    # Context digests and /files/events listeners hear about the app's own writes right away.
+    watch_publish(root, rels, source="app")
+
+def _search_on_change(ev: Dict[str, Any]):
+    if ev["source"] == "app":
+        return   # already applied by _search_index_touch
+    idx = _SEARCH_INDEXES.get(ev["root"])
+    if idx is None:
+        return
+    if ev["full"] or "" in ev["paths"]:
+        idx.watch = None   # the next query walks again
+        return
+    for rel in ev["paths"]:
+        target = os.path.join(idx.root, rel)
+        try:
+            st = os.stat(target)
+            if os.path.isfile(target) and idx.stamps.get(rel) == (st.st_mtime_ns, st.st_size):
+                continue   # e.g. the watcher echoing a write the file routes already indexed
+        except OSError:
+            pass
+        idx.refresh_path(rel)
+
+watch_subscribe(_search_on_change)
+
+def _search_file_matches(root: str, rel: str, matcher: Callable[[str], Any], max_per_file: int) -> List[Dict[str, Any]]:
+    try:
+        text = _read_search_text(os.path.join(root, rel))
+    except OSError:
+        return []
+    if not text:
+        return []
+    out = []
+    line_starts = None
+    for start, end in matcher(text):
+        if line_starts is None:
+            line_starts = [0] + [m.end() for m in re.finditer("\n", text)]
+        line_no = bisect.bisect_right(line_starts, start)
+        ls = line_starts[line_no - 1]
+        le = text.find("\n", ls)
+        line = text[ls: le if le >= 0 else len(text)]
+        out.append({
+            "path": rel,
+            "line": line_no,
+            "column": start - ls + 1,
+            "preview": line.strip()[:240],
+        })
+        if len(out) >= max_per_file:
+            break
+    return out
+
+def search_workspace(
+    root: str,
+    query: str,
+    path: str = "",
+    regex: bool = False,
+    ignore_case: bool = False,
+    max_results: int = 50,
+    max_per_file: int = 20,
+) -> Dict[str, Any]:
+    if not query:
+        return {"matches": [], "truncated": False}
+    flags = re.IGNORECASE if ignore_case else 0
+    if regex:
+        try:
+            rx = re.compile(query, flags | re.MULTILINE)
+        except re.error as e:
+            raise HTTPException(400, f"Invalid regex: {e}")
+        literals = _regex_required_literals(query)
+    else:
+        rx = re.compile(re.escape(query), flags)
+        literals = [query]
+
+    def matcher(text: str):
+        for m in rx.finditer(text):
+            if m.end() > m.start():
+                yield m.start(), m.end()
+
+    idx = search_index_for(root)
+    if idx is not None and idx.ready.is_set():
+        idx.sync()
+        files = idx.candidates(literals)
+        indexed = True
+    else:
+        # Index still building: fall back to a plain walk for this query.
+        files = sorted(rel for rel, _, size in _walk_workspace(root) if size <= SEARCH_MAX_FILE_BYTES)
+        indexed = False
+
+    prefix = path.replace("\\", "/").strip("/")
+    matches: List[Dict[str, Any]] = []
+    for rel in files:
+        if prefix and not (rel == prefix or rel.startswith(prefix + "/")):
+            continue
+        for m in _search_file_matches(root, rel, matcher, max_per_file):
+            matches.append(m)
+            if len(matches) >= max_results:
+                return {"matches": matches, "truncated": True, "indexed": indexed}
+    return {"matches": matches, "truncated": False, "indexed": indexed}
+
+
+###  ==================================================
+###  =============== CHUNK: CHAT HISTORY ==============
+###  ==================================================
+# Keeps prompts bounded on long chats. The newest messages are sent verbatim within a
+# token budget; older ones are folded into a rolling summary stored beside the chat
+# (chats/_summaries/<cid>.json). Folding only runs when the verbatim tail overflows the
+# budget and then shrinks it to HISTORY_KEEP_RATIO of the budget, so the summary (and the
+# prompt prefix it is part of) stays unchanged for several turns.
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "8000") or 0)     # 0 => send the whole history
+HISTORY_KEEP_RATIO = float(os.environ.get("HISTORY_KEEP_RATIO", "0.5") or 0.5)
+HISTORY_MIN_RECENT = int(os.environ.get("HISTORY_MIN_RECENT", "4") or 4)           # always verbatim, budget or not
+HISTORY_SUMMARY_TOKENS = int(os.environ.get("HISTORY_SUMMARY_TOKENS", "800") or 800)
+HISTORY_FOLD_MSG_CHARS = 4000   # per folded message, in the summarization request
+
+HISTORY_SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an assistant working on a "
+    "software project. Merge the previous summary with the new messages into one updated summary. "
+    "Keep requirements, decisions, file names, code facts, open questions and anything the assistant "
+    "will need later; drop pleasantries and repetition. Plain prose or short bullets, at most about "
+    "{tokens} tokens. Reply with the summary only."
+)
+
+def history_summary_path(pid: str, cid: str) -> str:
+    return os.path.join(chats_dir(pid), "_summaries", f"{cid}.json")
+
+def history_summary_load(pid: str, cid: str) -> Dict[str, Any]:
+    state = read_json(history_summary_path(pid, cid), None)
+    return state if isinstance(state, dict) else {"upto": 0, "summary": ""}
+
+def _history_msg_tokens(m: Dict[str, Any]) -> int:
+    return _approx_tokens(str(m.get("content") or "")) + 4   # + role/framing overhead
+
+def _history_fold_point(messages: List[Dict[str, Any]], start: int, budget: int) -> int:
+    """First message to keep verbatim so that the kept tail fits `budget` (bounded by HISTORY_MIN_RECENT)."""
+    n = len(messages)
+    limit = max(start, n - max(1, HISTORY_MIN_RECENT))
+    cut, total = n, 0
+    while cut > start:
+        cost = _history_msg_tokens(messages[cut - 1])
+        if total + cost > budget:
+            break
+        total += cost
+        cut -= 1
+    cut = min(max(cut, start), limit)
+    # Start the verbatim part on a user message so no reply appears without its question.
+    while cut < limit and messages[cut].get("role") != "user":
+        cut += 1
+    return cut
+
+def _history_fallback_summary(previous: str, messages: List[Dict[str, Any]]) -> str:
+    """Extractive stand-in when no model is available: the first line of each folded message."""
+    lines = [previous] if previous else []
+    for m in messages:
+        first = str(m.get("content") or "").strip().split("\n", 1)[0]
+        lines.append(f"- {m.get('role')}: {first[:200]}")
+    return "\n".join(lines)[-HISTORY_SUMMARY_TOKENS * 4:]
+
+async def _history_summarize(project: Dict[str, Any], previous: str, messages: List[Dict[str, Any]]) -> str:
+    if _should_demo(project):
+        return _history_fallback_summary(previous, messages)
+    transcript = "\n\n".join(
+        f"{m.get('role')}: {str(m.get('content') or '')[:HISTORY_FOLD_MSG_CHARS]}" for m in messages
     )
+    request = [
+        {"role": "system", "content": HISTORY_SUMMARY_PROMPT.format(tokens=HISTORY_SUMMARY_TOKENS)},
+        {"role": "user", "content": f"Previous summary:\n{previous or '(none)'}\n\nNew messages:\n{transcript}"},
+    ]
+    try:
+        msg = await _llm_call(request, {k: project.get(k) for k in ("id", "model", "llm_cache")})
+        text = str(msg.get("content") or "").strip()
+        if text:
+            return text[: HISTORY_SUMMARY_TOKENS * 4 * 2]
+    except Exception:
+        pass
+    return _history_fallback_summary(previous, messages)
+
+async def history_window(turn: Dict[str, Any]):
+    """
+    Sits between the chat log and the agent: trims turn["model_messages"] to the verbatim
+    window and puts the rolling summary of everything before it in turn["project"].
+    """
+    budget = HISTORY_TOKEN_BUDGET if turn.get("history_budget") is None else int(turn["history_budget"])
+    if budget <= 0:
+        return
+    pid, cid = turn["pid"], turn["cid"]
+    history = turn["history"]          # stored messages (with ts) + the new user message
+    msgs = turn["model_messages"]
+    state = await run_in_threadpool(history_summary_load, pid, cid)
+    upto = int(state.get("upto") or 0)
+    # The log is append-only; if it does not line up any more (e.g. rewritten), start over.
+    if upto > len(history) - 1 or (upto and history[upto - 1].get("ts") != state.get("upto_ts")):
+        state, upto = {"upto": 0, "summary": ""}, 0
+
+    if sum(_history_msg_tokens(m) for m in msgs[upto:]) > budget:
+        new_upto = _history_fold_point(msgs, upto, int(budget * HISTORY_KEEP_RATIO))
+        if new_upto > upto:
+            summary = await _history_summarize(turn["project"], state.get("summary") or "", history[upto:new_upto])
+            state = {
+                "upto": new_upto,
+                "upto_ts": history[new_upto - 1].get("ts"),
+                "summary": summary,
+                "updated_at": now_iso(),
+            }
+            await run_in_threadpool(write_json, history_summary_path(pid, cid), state)
+            upto = new_upto
+
+    turn["model_messages"] = msgs[upto:]
+    if upto:
+        turn["project"]["history_summary"] = state.get("summary") or ""
+
+
+###  ==================================================
+###  =============== CHUNK: SEND MESSAGE ==============
+###  ==================================================
+def _chat_version(pid: str, cid: str) -> Any:
+    """Changes whenever the log is appended to (size) or rewritten (inode)."""
+    try:
+        st = os.stat(chat_log_path(pid, cid))
+        return (st.st_ino, st.st_size)
+    except FileNotFoundError:
+        return None
 
-    user_msg = {"role": "user", "content": body.content, "ts": now_iso()}
-    chat["messages"].append(user_msg)
+def _prepare_turn(pid: str, cid: str, content: str) -> Dict[str, Any]:
+    with trace_span("load_chat") as sp, chat_lock(pid, cid):
+        chat = chat_load(pid, cid) or {"messages": []}
+        base = {"count": len(chat.get("messages") or []), "version": _chat_version(pid, cid)}
+        sp["messages"] = base["count"]
+    user_msg = {"role": "user", "content": content, "ts": now_iso()}
+    history = (chat.get("messages") or []) + [user_msg]
 
     # lookup project, model, and system prompt
-    data = read_json(PROJECTS_FILE, {"projects": []})
-    proj = next((p for p in data["projects"] if p.get("id") == pid), {})
+    proj = project_get(pid) or {}
     model = proj.get("model") or "gpt-5-instant"
     system_prompt = proj.get("system_prompt") or ""
 
-    # add project files context
-    files_context = gather_project_files(pid)
-    if files_context.strip():
-        system_prompt = (system_prompt + "\n\n" + "### Project Files Context\n" + files_context).strip()
+    # the agent usually searches soon; make sure the workspace index is (being) built,
+    # and keep the workspace watcher alive while the project is in use
+    root = workspace_root(pid)
+    search_index_for(root)
+    workspace_watch(root)
+
+    # project files context (ranked against this message); kept apart from the instructions
+    # so the prompt prefix stays stable while files change (see _llm_system_segments)
+    with trace_span("gather_project_files") as sp:
+        files_context = gather_project_files(pid, query=content, token_budget=proj.get("context_token_budget"))
+        sp["chars"] = len(files_context)
+
+    model_messages = [{"role": m.get("role"), "content": m.get("content")} for m in history]
+    return {
+        "pid": pid,
+        "cid": cid,
+        "user_msg": user_msg,
+        "base": base,
+        "history": history,
+        "history_budget": proj.get("history_token_budget"),
+        "model_messages": model_messages,
+        "project": {
+            "id": pid,
+            "model": model,
+            "system_prompt": system_prompt,
+            "files_context": files_context,
+            "llm_cache": proj.get("llm_cache"),
+        },
+    }
+
+async def prepare_turn(pid: str, cid: str, content: str) -> Dict[str, Any]:
+    with trace_span("prepare_turn"):
+        turn = await run_in_threadpool(_prepare_turn, pid, cid, content)
+        with trace_span("history_window") as sp:
+            await history_window(turn)
+            sp["messages"] = len(turn["model_messages"])
+    return turn
 
-    model_messages = [{"role": m.get("role"), "content": m.get("content")} for m in (chat.get("messages") or [])]
-    assistant = llm_chat_agent(model_messages, {"model": model, "system_prompt": system_prompt}, pid=pid)
+def _commit_turn(turn: Dict[str, Any], assistant: str) -> int:
+    """
+    Compare-and-append. The LLM ran without the chat lock, so another turn may have been
+    committed meanwhile; both are kept (user + assistant land together), and the reply is
+    tagged with how many messages it did not see. Returns that count.
+    """
+    pid, cid, base = turn["pid"], turn["cid"], turn["base"]
+    assistant_msg = {"role": "assistant", "content": assistant, "ts": now_iso()}
+    with chat_lock(pid, cid):
+        interleaved = 0
+        if _chat_version(pid, cid) != base["version"]:
+            current = chat_load(pid, cid, compact=False) or {}
+            interleaved = max(0, len(current.get("messages") or []) - base["count"])
+        if interleaved:
+            assistant_msg["interleaved"] = interleaved
+        chat_append(pid, cid, [turn["user_msg"], assistant_msg])
+    return interleaved
+
+async def _commit_turn_async(turn: Dict[str, Any], assistant: str) -> int:
+    with trace_span("commit_turn", reply_chars=len(assistant)):
+        async with lock_async(chat_lock_name(turn["pid"], turn["cid"])):
+            return await run_in_threadpool(_commit_turn, turn, assistant)
+
+@app.post("/projects/{pid}/chats/{cid}/message")
+async def api_send_message(pid: str, cid: str, body: MessageIn):
+    if body.background:
+        job = await run_in_threadpool(job_create, pid, cid, body.content)
+        await job_enqueue(job["id"])
+        return JSONResponse(_job_public(job), status_code=202)
+    async with trace_turn(pid, cid, "message"):
+        turn = await prepare_turn(pid, cid, body.content)
+        assistant = await llm_chat_agent(turn["model_messages"], turn["project"], pid=pid)
+        interleaved = await _commit_turn_async(turn, assistant)
+    out: Dict[str, Any] = {"reply": assistant}
+    if interleaved:
+        out["interleaved"] = interleaved
+    return out
+
+@app.post("/projects/{pid}/chats/{cid}/message/stream")
+async def api_send_message_stream(pid: str, cid: str, body: MessageIn):
+    """
+    Same turn as /message, streamed as NDJSON events (one JSON object per line).
+    The assistant message is persisted once the final "done" event is produced.
+    """
+    async with trace_turn(pid, cid, "stream", finish=False) as tr:
+        turn = await prepare_turn(pid, cid, body.content)
+
+    async def events():
+        try:
+            async with trace_turn(pid, cid, "stream", trace=tr):
+                async for ev in llm_chat_agent_stream(turn["model_messages"], turn["project"], pid=pid):
+                    if ev["type"] == "done":
+                        interleaved = await _commit_turn_async(turn, ev["reply"])
+                        if interleaved:
+                            ev["interleaved"] = interleaved
+                    yield json.dumps(ev, ensure_ascii=False) + "\n"
+        except HTTPException as e:
+            yield json.dumps({"type": "error", "status_code": int(e.status_code), "detail": str(e.detail)}, ensure_ascii=False) + "\n"
+        except Exception as e:
+            yield json.dumps({"type": "error", "detail": str(e)}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+###  ==================================================
+###  =============== CHUNK: JOBS ======================
+###  ==================================================
+# Opt-in background agent runs: POST .../message {"background": true} returns a job id.
+# Each job is one JSON file in data/jobs (atomic writes), so queued work survives restarts.
+# Every process runs JOBS_CONCURRENCY workers; a job is claimed under its lock, so with
+# several uvicorn workers each job still runs once. Running jobs heartbeat; a janitor
+# re-queues jobs whose owner stopped heartbeating and drops finished jobs after retention.
+JOBS_DIR = os.path.join(DATA_DIR, "jobs")
+JOBS_CONCURRENCY = int(os.environ.get("JOBS_CONCURRENCY", "2") or 2)
+JOBS_HEARTBEAT_S = float(os.environ.get("JOBS_HEARTBEAT_S", "10") or 10)
+JOBS_RETENTION_S = float(os.environ.get("JOBS_RETENTION_S", str(7 * 86400)) or 7 * 86400)
+JOB_TRACE_MAX = int(os.environ.get("JOB_TRACE_MAX", "500") or 500)
+JOB_TRACE_ARG_CHARS = 400
+JOB_FINAL_STATES = ("succeeded", "failed", "cancelled")
+
+_JOBS: Dict[str, Any] = {"loop": None, "queue": None, "tasks": [], "pending": set(), "running": set()}
+
+class _JobCancelled(Exception):
+    pass
+
+def job_path(job_id: str) -> str:
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id or ""):
+        raise HTTPException(404, "Job not found")
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+def job_load(job_id: str) -> Dict[str, Any]:
+    job = read_json(job_path(job_id), None)
+    if not job:
+        raise HTTPException(404, "Job not found")
+    return job
+
+def _job_update(job_id: str, fn: Callable[[Dict[str, Any]], Any], fsync: Optional[bool] = None) -> Dict[str, Any]:
+    """Read-modify-write of one job record under its lock; `fn` mutates the record in place."""
+    with named_lock(f"job:{job_id}"):
+        job = job_load(job_id)
+        fn(job)
+        write_json(job_path(job_id), job, fsync=fsync)
+        return job
+
+def _job_public(job: Dict[str, Any], trace: bool = True) -> Dict[str, Any]:
+    out = {k: v for k, v in job.items() if k not in ("content", "owner")}
+    if not trace:
+        out.pop("trace", None)
+    return out
+
+def job_create(pid: str, cid: str, content: str) -> Dict[str, Any]:
+    if not project_get(pid):
+        raise HTTPException(404, "Project not found")
+    job = {
+        "id": uuid.uuid4().hex,
+        "project_id": pid,
+        "chat_id": cid,
+        "content": content,
+        "status": "queued",
+        "created_at": now_iso(),
+        "started_at": None,
+        "finished_at": None,
+        "heartbeat": None,
+        "owner": None,
+        "steps": 0,
+        "trace": [],
+        "result": None,
+        "error": None,
+        "cancel_requested": False,
+    }
+    write_json(job_path(job["id"]), job)
+    return job
+
+def _job_trace_event(ev: Dict[str, Any]) -> Dict[str, Any]:
+    ev = dict(ev, at=now_iso())
+    if isinstance(ev.get("args"), dict):
+        # write_file content and the like: keep the trace small.
+        ev["args"] = {
+            k: (v[:JOB_TRACE_ARG_CHARS] + f"... ({len(v)} chars)" if isinstance(v, str) and len(v) > JOB_TRACE_ARG_CHARS else v)
+            for k, v in ev["args"].items()
+        }
+    return ev
+
+def _job_owner() -> str:
+    return str(os.getpid())
+
+def _job_claim(job_id: str) -> Optional[Dict[str, Any]]:
+    """queued -> running for this process; None if it is gone, finished, or owned elsewhere."""
+    claimed: Dict[str, Any] = {}
+
+    def claim(job: Dict[str, Any]):
+        if job.get("status") != "queued":
+            return
+        if job.get("cancel_requested"):
+            job.update(status="cancelled", finished_at=now_iso())
+            return
+        job.update(status="running", owner=_job_owner(), started_at=now_iso(), heartbeat=time.time())
+        claimed["ok"] = True
+
+    try:
+        job = _job_update(job_id, claim)
+    except HTTPException:
+        return None
+    return job if claimed else None
+
+def _job_requeue(job_id: str):
+    def requeue(job: Dict[str, Any]):
+        if job.get("status") == "running" and job.get("owner") == _job_owner():
+            job.update(status="queued", owner=None, heartbeat=None, steps=0, trace=[])
+    try:
+        _job_update(job_id, requeue)
+    except HTTPException:
+        pass
+
+async def _job_run(job_id: str):
+    try:
+        job = await run_in_threadpool(_job_claim, job_id)
+    except asyncio.CancelledError:
+        # Shutdown landed while the claim was being written: it may have gone through.
+        await asyncio.shield(run_in_threadpool(_job_requeue, job_id))
+        raise
+    if job is None:
+        return
+    pid, cid = job["project_id"], job["chat_id"]
+    trace: List[Dict[str, Any]] = []
+
+    def progress(job: Dict[str, Any], step: Optional[int]):
+        job["heartbeat"] = time.time()
+        job["trace"] = trace[-JOB_TRACE_MAX:]
+        if step is not None:
+            job["steps"] = step + 1
+
+    async def on_event(ev: Dict[str, Any]):
+        if ev["type"] == "step":
+            # Step boundary: persist progress and honour a cancel request (possibly from another worker).
+            cur = await run_in_threadpool(_job_update, job_id, lambda j: progress(j, ev["step"]), False)
+            if cur.get("cancel_requested"):
+                raise _JobCancelled()
+        else:
+            trace.append(_job_trace_event(ev))
+            if ev["type"] == "tool_end":
+                await run_in_threadpool(_job_update, job_id, lambda j: progress(j, None), False)
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(JOBS_HEARTBEAT_S)
+            await run_in_threadpool(_job_update, job_id, lambda j: j.update(heartbeat=time.time()), False)
+
+    beat = asyncio.create_task(heartbeat())
+    _JOBS["running"].add(job_id)
+    try:
+        async with trace_turn(pid, cid, "job", job_id=job_id):
+            turn = await prepare_turn(pid, cid, job["content"])
+            reply = await llm_chat_agent(turn["model_messages"], turn["project"], pid=pid, on_event=on_event)
+            interleaved = await _commit_turn_async(turn, reply)
+        final = {"status": "succeeded", "result": {"reply": reply, "interleaved": interleaved}}
+    except _JobCancelled:
+        final = {"status": "cancelled"}
+    except asyncio.CancelledError:
+        # Process shutting down: hand the job back to the queue for the next start.
+        await asyncio.shield(run_in_threadpool(_job_requeue, job_id))
+        raise
+    except HTTPException as e:
+        final = {"status": "failed", "error": {"status_code": int(e.status_code), "detail": str(e.detail)}}
+    except Exception as e:
+        final = {"status": "failed", "error": {"detail": str(e)}}
+    finally:
+        beat.cancel()
+        _JOBS["running"].discard(job_id)
+
+    def finish(j: Dict[str, Any]):
+        progress(j, None)
+        j.update(final, finished_at=now_iso(), heartbeat=None)
+    await run_in_threadpool(_job_update, job_id, finish)
+
+async def _job_worker(queue: "asyncio.Queue[str]"):
+    while True:
+        job_id = await queue.get()
+        _JOBS["pending"].discard(job_id)
+        try:
+            await _job_run(job_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        finally:
+            queue.task_done()
+
+def _jobs_queue() -> "asyncio.Queue[str]":
+    loop = asyncio.get_running_loop()
+    if _JOBS["loop"] is not loop:
+        queue: "asyncio.Queue[str]" = asyncio.Queue()
+        _JOBS.update(
+            loop=loop,
+            queue=queue,
+            tasks=[asyncio.create_task(_job_worker(queue)) for _ in range(max(1, JOBS_CONCURRENCY))],
+        )
+    return _JOBS["queue"]
+
+async def job_enqueue(job_id: str):
+    queue = _jobs_queue()
+    if job_id not in _JOBS["pending"]:
+        _JOBS["pending"].add(job_id)
+        queue.put_nowait(job_id)
+
+def _jobs_scan() -> List[str]:
+    """Job ids to (re)enqueue: queued ones and running ones whose owner stopped heartbeating."""
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    due: List[str] = []
+    stale_after = 3 * JOBS_HEARTBEAT_S
+    for name in os.listdir(JOBS_DIR):
+        if not name.endswith(".json"):
+            continue
+        job_id = name[: -len(".json")]
+        job = read_json(os.path.join(JOBS_DIR, name), None)
+        if not isinstance(job, dict):
+            continue
+        status = job.get("status")
+        if status in JOB_FINAL_STATES:
+            try:
+                if time.time() - os.path.getmtime(os.path.join(JOBS_DIR, name)) > JOBS_RETENTION_S:
+                    os.remove(os.path.join(JOBS_DIR, name))
+            except OSError:
+                pass
+        elif status == "queued":
+            due.append(job_id)
+        elif status == "running" and job_id not in _JOBS["running"]:
+            if time.time() - float(job.get("heartbeat") or 0) > stale_after:
+                def orphan(j: Dict[str, Any]):
+                    if j.get("status") == "running" and time.time() - float(j.get("heartbeat") or 0) > stale_after:
+                        j.update(status="queued", owner=None, heartbeat=None, steps=0, trace=[])
+                if _job_update(job_id, orphan).get("status") == "queued":
+                    due.append(job_id)
+    return due
+
+async def _jobs_janitor():
+    while True:
+        try:
+            # job_enqueue skips ids this process already holds; claiming dedupes across workers.
+            for job_id in await run_in_threadpool(_jobs_scan):
+                await job_enqueue(job_id)
+        except Exception:
+            pass
+        await asyncio.sleep(3 * JOBS_HEARTBEAT_S)
+
+async def _jobs_start():
+    _JOBS["janitor"] = asyncio.create_task(_jobs_janitor())
+
+async def _jobs_stop():
+    tasks = list(_JOBS.get("tasks") or []) + [t for t in [_JOBS.get("janitor")] if t]
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _JOBS.update(loop=None, queue=None, tasks=[], janitor=None)
+    _JOBS["pending"].clear()
+
+_STARTUP_HOOKS.append(_jobs_start)
+_SHUTDOWN_HOOKS.append(_jobs_stop)
+
+@app.get("/projects/{pid}/jobs")
+def api_list_jobs(pid: str, status: Optional[str] = Query(default=None), limit: int = Query(default=50, ge=1, le=500)):
+    """This project's jobs, newest first, without traces."""
+    jobs = []
+    if os.path.isdir(JOBS_DIR):
+        for name in os.listdir(JOBS_DIR):
+            job = read_json(os.path.join(JOBS_DIR, name), None) if name.endswith(".json") else None
+            if isinstance(job, dict) and job.get("project_id") == pid and (status is None or job.get("status") == status):
+                jobs.append(_job_public(job, trace=False))
+    jobs.sort(key=lambda j: j.get("created_at") or "", reverse=True)
+    return {"jobs": jobs[:limit]}
+
+def _project_job(pid: str, job_id: str) -> Dict[str, Any]:
+    job = job_load(job_id)
+    if job.get("project_id") != pid:
+        raise HTTPException(404, "Job not found")
+    return job
+
+@app.get("/projects/{pid}/jobs/{job_id}")
+def api_get_job(pid: str, job_id: str, trace: bool = Query(default=True)):
+    """Status, partial tool trace (while running) and result of one job."""
+    return _job_public(_project_job(pid, job_id), trace=trace)
+
+@app.post("/projects/{pid}/jobs/{job_id}/cancel")
+def api_cancel_job(pid: str, job_id: str):
+    """Queued jobs are cancelled at once; running ones stop before their next agent step."""
+    _project_job(pid, job_id)
+
+    def cancel(job: Dict[str, Any]):
+        if job.get("status") == "queued":
+            job.update(status="cancelled", finished_at=now_iso(), cancel_requested=True)
+        elif job.get("status") == "running":
+            job["cancel_requested"] = True
+    return _job_public(_job_update(job_id, cancel), trace=False)
 
-    chat["messages"].append({"role": "assistant", "content": assistant, "ts": now_iso()})
-    chat["updated_at"] = now_iso()
-    write_json(path, chat)
-    return {"reply": assistant}
 
 ###  ==================================================
 ###  =============== CHUNK: FILE OPS ==================
 ###  ==================================================
 class FileRead(BaseModel):
     path: str
+    offset: Optional[int] = None          # byte offset; set offset/length for a windowed read
+    length: Optional[int] = None          # max bytes to return (capped at READ_WINDOW_MAX_BYTES)
+    if_none_match: Optional[str] = None   # ETag from a previous read; unchanged files return 304
 
 class FileWrite(BaseModel):
     path: str
@@ -956,6 +4437,161 @@ class RenameMoveBody(BaseModel):
     src: str
     dst: str
 
+class PatchEdit(BaseModel):
+    search: str
+    replace: str
+    count: Optional[int] = 1      # expected occurrences; 0 => replace all
+
+class FilePatch(BaseModel):
+    path: str
+    base_sha256: Optional[str] = None
+    patch: Optional[str] = None                 # unified diff
+    edits: Optional[List[PatchEdit]] = None     # or search/replace edits
+
+# --- Directory listings: os.scandir, file type from the DirEntry, one stat per returned entry ---
+# Listings of large directories are kept (names and types only) while the directory's
+# mtime is unchanged, so paging through 100k entries does not rescan and re-sort each time.
+TREE_MAX_LIMIT = 10000
+TREE_MAX_DEPTH = 64
+TREE_CACHE_MIN_ENTRIES = 1000
+_TREE_DIR_CACHE: "OrderedDict[str, Any]" = OrderedDict()   # abs dir -> (mtime_ns, listing)
+_TREE_DIR_CACHE_MAX = 16
+_TREE_DIR_CACHE_LOCK = threading.Lock()
+
+def _tree_dir_listing(path: str) -> List[Any]:
+    """Sorted [(name, is_dir, is_link, DirEntry or None)] for one directory."""
+    mtime_ns = os.stat(path).st_mtime_ns
+    with _TREE_DIR_CACHE_LOCK:
+        hit = _TREE_DIR_CACHE.get(path)
+        if hit and hit[0] == mtime_ns:
+            _TREE_DIR_CACHE.move_to_end(path)
+            return hit[1]
+    listing = []
+    with os.scandir(path) as it:
+        for e in it:
+            try:
+                listing.append((e.name, e.is_dir(), e.is_symlink(), e))
+            except OSError:
+                continue
+    listing.sort(key=lambda t: t[0])
+    if len(listing) >= TREE_CACHE_MIN_ENTRIES:
+        # Cached copies drop the DirEntry: its stat would go stale when a file changes in place.
+        with _TREE_DIR_CACHE_LOCK:
+            _TREE_DIR_CACHE[path] = (mtime_ns, [(n, d, l, None) for n, d, l, _ in listing])
+            while len(_TREE_DIR_CACHE) > _TREE_DIR_CACHE_MAX:
+                _TREE_DIR_CACHE.popitem(last=False)
+    return listing
+
+def _tree_stat(parent: str, name: str, entry: Any) -> Optional[os.stat_result]:
+    try:
+        return entry.stat() if entry is not None else os.stat(os.path.join(parent, name))
+    except OSError:
+        return None
+
+def tree_cursor(rel: str) -> str:
+    return base64.urlsafe_b64encode(rel.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _tree_cursor_parts(cursor: str) -> List[str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+    except Exception:
+        raise HTTPException(400, "Invalid cursor")
+    return [p for p in raw.split("/") if p]
+
+def walk_tree(
+    root: str,
+    path: str = "",
+    depth: int = 1,
+    glob: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 1000,
+    skip: Optional[Callable[[str], bool]] = None,
+) -> Dict[str, Any]:
+    """
+    Depth-first listing under `path`, children sorted by name, parents before children.
+    depth=1 lists one level, 0 means unlimited. `glob` filters returned entries (matched
+    against the name, or the relative path if it contains "/"); traversal is unaffected.
+    `skip(name)` prunes an entry and its subtree. The cursor is the last returned path,
+    so pages stay valid across requests and workers.
+    """
+    base_parts = [p for p in (path or "").replace("\\", "/").split("/") if p not in ("", ".")]
+    base = safe_join(root, "/".join(base_parts))
+    if not os.path.isdir(base):
+        return {"entries": [], "next_cursor": None}
+    max_depth = TREE_MAX_DEPTH if depth <= 0 else min(depth, TREE_MAX_DEPTH)
+    resume: Optional[List[str]] = None
+    if cursor:
+        parts = _tree_cursor_parts(cursor)
+        if parts[: len(base_parts)] != base_parts or len(parts) == len(base_parts):
+            raise HTTPException(400, "Cursor does not belong to this path")
+        resume = parts[len(base_parts):]
+
+    def wanted(name: str, rel: str) -> bool:
+        if not glob:
+            return True
+        return fnmatch.fnmatchcase(rel if "/" in glob else name, glob)
+
+    def visit(abs_dir: str, rel_dir: str, level: int, resume: Optional[List[str]]):
+        try:
+            listing = _tree_dir_listing(abs_dir)
+        except OSError:
+            return
+        start = 0
+        if resume:
+            start = _tree_bisect(listing, resume[0])
+            if start < len(listing) and listing[start][0] == resume[0]:
+                name, is_dir, is_link, _ = listing[start]
+                # The cursor entry itself was already returned; only its subtree may remain.
+                if is_dir and not is_link and level < max_depth:
+                    rel = f"{rel_dir}/{name}" if rel_dir else name
+                    yield from visit(os.path.join(abs_dir, name), rel, level + 1, resume[1:] or None)
+                start += 1
+        for name, is_dir, is_link, entry in listing[start:]:
+            if skip is not None and skip(name):
+                continue
+            rel = f"{rel_dir}/{name}" if rel_dir else name
+            if wanted(name, rel):
+                st = _tree_stat(abs_dir, name, entry)
+                item: Dict[str, Any] = {"path": rel, "name": name, "type": "dir" if is_dir else "file", "depth": level}
+                if not is_dir:
+                    item["size"] = st.st_size if st else None
+                item["mtime"] = st.st_mtime if st else None
+                yield item
+            if is_dir and not is_link and level < max_depth:
+                yield from visit(os.path.join(abs_dir, name), rel, level + 1, None)
+
+    base_rel = "/".join(base_parts)
+    entries: List[Dict[str, Any]] = []
+    gen = visit(base, base_rel, 1, resume)
+    for item in gen:
+        if len(entries) >= limit:
+            gen.close()
+            return {"entries": entries, "next_cursor": tree_cursor(entries[-1]["path"])}
+        entries.append(item)
+    return {"entries": entries, "next_cursor": None}
+
+def _tree_bisect(listing: List[Any], name: str) -> int:
+    lo, hi = 0, len(listing)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if listing[mid][0] < name:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+@app.get("/projects/{pid}/files/tree")
+def api_files_tree(
+    pid: str,
+    path: str = Query(default=""),
+    depth: int = Query(default=1, ge=0, le=TREE_MAX_DEPTH),
+    glob: Optional[str] = Query(default=None),
+    cursor: Optional[str] = Query(default=None),
+    limit: int = Query(default=1000, ge=1, le=TREE_MAX_LIMIT),
+):
+    """Recursive listing with path, type, size and mtime; depth=0 for the whole subtree, paged by cursor."""
+    return walk_tree(workspace_root(pid), path, depth=depth, glob=glob, cursor=cursor, limit=limit)
+
 @app.get("/projects/{pid}/files/list")
 def api_files_list(pid: str, path: Optional[str] = Query(default="")):
     root = workspace_root(pid)
@@ -963,33 +4599,256 @@ def api_files_list(pid: str, path: Optional[str] = Query(default="")):
     if not os.path.isdir(target):
         return {"entries": []}
     entries = []
-    for name in sorted(os.listdir(target)):
-        p = os.path.join(target, name)
+    for name, is_dir, _, entry in _tree_dir_listing(target):
+        st = _tree_stat(target, name, entry)
         entries.append({
             "name": name,
-            "type": "dir" if os.path.isdir(p) else "file",
-            "size": os.path.getsize(p) if os.path.isfile(p) else None,
+            "type": "dir" if is_dir else "file",
+            "size": None if is_dir or st is None else st.st_size,
+            "mtime": st.st_mtime if st else None,
         })
     return {"entries": entries}
 
+# --- ETags, conditional requests and byte windows ---
+READ_WINDOW_MAX_BYTES = int(os.environ.get("READ_WINDOW_MAX_BYTES", str(4 * 1024 * 1024)) or 4 * 1024 * 1024)
+_RANGE_RE = re.compile(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$")
+
+def file_etag(st: os.stat_result) -> str:
+    """Strong validator: changes whenever the inode, size or mtime changes."""
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(",")]
+    # If-None-Match uses weak comparison, so W/"x" matches "x".
+    return "*" in tags or any((t[2:] if t.startswith("W/") else t) == etag for t in tags)
+
+def _parse_range(header: Optional[str], size: int):
+    """(start, end) inclusive for a single satisfiable byte range, None for no/unsupported range, or 'unsatisfiable'."""
+    if not header or "," in header:
+        return None
+    m = _RANGE_RE.match(header)
+    if not m or (m.group(1) == "" and m.group(2) == ""):
+        return None
+    if m.group(1) == "":
+        n = int(m.group(2))
+        if n == 0 or size == 0:
+            return "unsatisfiable"
+        return max(0, size - n), size - 1
+    start = int(m.group(1))
+    end = int(m.group(2)) if m.group(2) else size - 1
+    if start >= size or end < start:
+        return "unsatisfiable"
+    return start, min(end, size - 1)
+
+def _utf8_window(data: bytes, at_start: bool, at_eof: bool):
+    """Trims a byte slice to whole UTF-8 characters; returns (data, skipped_head)."""
+    head = 0
+    if not at_start:
+        while head < min(3, len(data)) and (data[head] & 0xC0) == 0x80:
+            head += 1
+    end = len(data)
+    if not at_eof:
+        for back in range(1, min(4, end - head) + 1):
+            b = data[end - back]
+            if (b & 0xC0) == 0x80:
+                continue
+            need = 1 if b < 0x80 else 2 if (b & 0xE0) == 0xC0 else 3 if (b & 0xF0) == 0xE0 else 4
+            if need > back:
+                end -= back
+            break
+    return data[head:end], head
+
+def read_text_window(path: str, offset: int, max_bytes: int, sha256: bool = False) -> Dict[str, Any]:
+    """With sha256 (and a file up to PATCH_MAX_BYTES), the window, hash and etag come from one read."""
+    digest = None
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        offset = max(0, min(int(offset), st.st_size))
+        if sha256 and st.st_size <= PATCH_MAX_BYTES:
+            whole = f.read()
+            digest = hashlib.sha256(whole).hexdigest()
+            data = whole[offset:offset + max(0, int(max_bytes))]
+        else:
+            f.seek(offset)
+            data = f.read(max(0, int(max_bytes)))
+    raw_end = offset + len(data)
+    data, skipped = _utf8_window(data, offset == 0, raw_end >= st.st_size)
+    start = offset + skipped
+    next_offset = start + len(data)
+    return {
+        "content": data.decode("utf-8", errors="replace"),
+        "offset": start,
+        "length": len(data),
+        "next_offset": next_offset,
+        "size": st.st_size,
+        "eof": next_offset >= st.st_size,
+        "etag": file_etag(st),
+        **({"sha256": digest} if digest else {}),
+    }
+
 @app.post("/projects/{pid}/files/read")
 def api_files_read(pid: str, body: FileRead):
     root = workspace_root(pid)
     target = safe_join(root, body.path)
     if not os.path.isfile(target):
         raise HTTPException(404, "File not found")
-    with open(target, "r", encoding="utf-8") as f:
-        return {"content": f.read()}
+    st = os.stat(target)
+    etag = file_etag(st)
+    if _etag_matches(body.if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    if body.offset is not None or body.length is not None:
+        length = READ_WINDOW_MAX_BYTES if body.length is None else max(0, min(int(body.length), READ_WINDOW_MAX_BYTES))
+        return read_text_window(target, body.offset or 0, length)
+    with open(target, "rb") as f:
+        data = f.read()
+    return {"content": data.decode("utf-8"), "size": st.st_size, "etag": etag, "sha256": hashlib.sha256(data).hexdigest()}
+
+def file_lock(pid: str, root: str, target: str):
+    """Per-file lock for read-check-write sequences (patch's base_sha256), keyed on the normalized path."""
+    return named_lock(f"file:{pid}:{os.path.relpath(target, root)}")
 
 @app.post("/projects/{pid}/files/write")
 def api_files_write(pid: str, body: FileWrite):
     root = workspace_root(pid)
     target = safe_join(root, body.path)
-    os.makedirs(os.path.dirname(target), exist_ok=True)
-    with open(target, "w", encoding="utf-8") as f:
-        f.write(body.content)
+    with file_lock(pid, root, target):   # so a write cannot land between a patch's check and its write
+        atomic_write(target, body.content)
+    _search_index_touch(pid, target)
     return {"status": "ok"}
 
+# --- Patch-based writes: unified diffs or search/replace edits against a base hash ---
+PATCH_MAX_BYTES = int(os.environ.get("PATCH_MAX_BYTES", str(8 * 1024 * 1024)) or 8 * 1024 * 1024)
+_HUNK_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+_LINE_SPLIT_RE = re.compile(r"(?<=\n)|(?<=\r)(?!\n)")
+
+def _split_lines(text: str) -> List[str]:
+    """Lines with their endings kept; only \n, \r\n and \r end a line (unlike str.splitlines)."""
+    return [l for l in _LINE_SPLIT_RE.split(text) if l]
+
+def _line_ending(line: str) -> str:
+    if line.endswith("\r\n"):
+        return "\r\n"
+    return line[-1:] if line.endswith(("\n", "\r")) else ""
+
+def _parse_unified_diff(patch: str) -> List[Dict[str, Any]]:
+    hunks: List[Dict[str, Any]] = []
+    cur = None
+    for raw in _split_lines(patch):
+        line = raw[:len(raw) - len(_line_ending(raw))]
+        m = _HUNK_RE.match(line)
+        if m:
+            cur = {"old_start": int(m.group(1)), "lines": []}
+            hunks.append(cur)
+            continue
+        if cur is None or line.startswith(("--- ", "+++ ", "diff ", "index ")):
+            continue
+        if line.startswith("\\"):
+            continue  # "\ No newline at end of file"
+        tag, text = (line[:1], line[1:]) if line else (" ", "")
+        if tag in (" ", "-", "+"):
+            cur["lines"].append((tag, text))
+    if not hunks:
+        raise HTTPException(400, "Patch contains no @@ hunks.")
+    return hunks
+
+def _apply_unified_diff(text: str, patch: str) -> str:
+    # Lines keep their own endings so untouched lines (and mixed LF/CRLF files) come back byte for byte.
+    lines = _split_lines(text)
+    trailing_nl = not lines or bool(_line_ending(lines[-1]))
+    crlf = sum(1 for l in lines if l.endswith("\r\n"))
+    default_nl = "\r\n" if crlf * 2 > len(lines) else "\n"
+    body = lambda l: l[:len(l) - len(_line_ending(l))].rstrip()
+    delta = 0
+    for n, hunk in enumerate(_parse_unified_diff(patch), 1):
+        old = [t for tag, t in hunk["lines"] if tag in (" ", "-")]
+        expected = max(0, hunk["old_start"] - 1 + delta) if old else max(0, hunk["old_start"] + delta)
+        want = [l.rstrip() for l in old]
+        # Look for the hunk at its expected line first, then progressively further away.
+        found = None
+        for dist in range(0, len(lines) + 1):
+            for pos in ((expected - dist, expected + dist) if dist else (expected,)):
+                if 0 <= pos <= len(lines) - len(old) and [body(l) for l in lines[pos:pos + len(old)]] == want:
+                    found = pos
+                    break
+            if found is not None:
+                break
+        if found is None:
+            raise HTTPException(409, f"Hunk {n} does not apply (context not found).")
+        new: List[str] = []
+        i, removed = found, ""
+        for tag, t in hunk["lines"]:
+            if tag == " ":
+                new.append(lines[i])
+                i += 1
+            elif tag == "-":
+                removed = lines[i]
+                i += 1
+            else:
+                # Added lines take the ending of the line they replace, else of their neighbours.
+                near = removed or (new[-1] if new else "") or (lines[i] if i < len(lines) else "")
+                new.append(t + (_line_ending(near) or default_nl))
+        lines[found:found + len(old)] = new
+        delta += len(new) - len(old)
+    for k in range(len(lines) - 1):
+        if not _line_ending(lines[k]):
+            lines[k] += default_nl
+    if lines:
+        last = lines[-1][:len(lines[-1]) - len(_line_ending(lines[-1]))]
+        lines[-1] = last + (_line_ending(lines[-1]) or default_nl if trailing_nl else "")
+    return "".join(lines)
+
+def _apply_search_replace(text: str, edits: List[PatchEdit]) -> str:
+    for n, e in enumerate(edits, 1):
+        if not e.search:
+            raise HTTPException(400, f"Edit {n}: empty search text.")
+        found = text.count(e.search)
+        want = 1 if e.count is None else int(e.count)
+        if found == 0:
+            raise HTTPException(409, f"Edit {n}: search text not found.")
+        if want > 0 and found != want:
+            raise HTTPException(409, f"Edit {n}: expected {want} occurrence(s), found {found}.")
+        text = text.replace(e.search, e.replace)
+    return text
+
+@app.post("/projects/{pid}/files/patch")
+def api_files_patch(pid: str, body: FilePatch):
+    if not body.patch and not body.edits:
+        raise HTTPException(400, "Provide 'patch' (unified diff) or 'edits'.")
+    root = workspace_root(pid)
+    target = safe_join(root, body.path)
+    # Held from the read to the write: two patches against one base must not both pass the check.
+    with file_lock(pid, root, target):
+        out, base = _files_patch_locked(target, body)
+    _search_index_touch(pid, target)
+    return {"status": "ok", "path": body.path, "base_sha256": base, "sha256": hashlib.sha256(out).hexdigest(), "size": len(out)}
+
+def _files_patch_locked(target: str, body: FilePatch):
+    if not os.path.isfile(target):
+        raise HTTPException(404, "File not found")
+    if os.path.getsize(target) > PATCH_MAX_BYTES:
+        raise HTTPException(413, "File too large to patch")
+    with open(target, "rb") as f:
+        data = f.read()
+    base = hashlib.sha256(data).hexdigest()
+    if body.base_sha256 and body.base_sha256.lower() != base:
+        raise HTTPException(409, f"File changed since base_sha256 (current sha256 {base}).")
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        raise HTTPException(415, "Only UTF-8 text files can be patched.")
+
+    if body.patch:
+        text = _apply_unified_diff(text, body.patch)
+    if body.edits:
+        text = _apply_search_replace(text, body.edits)
+
+    out = text.encode("utf-8")
+    atomic_write(target, out)
+    return out, base
+
 @app.post("/projects/{pid}/files/mkdir")
 def api_files_mkdir(pid: str, body: PathBody):
     root = workspace_root(pid)
@@ -1003,7 +4862,8 @@ def api_files_create(pid: str, body: PathBody):
     target = safe_join(root, body.path)
     os.makedirs(os.path.dirname(target), exist_ok=True)
     if not os.path.exists(target):
-        open(target, "a").close()
+        atomic_write(target, b"")
+        _search_index_touch(pid, target)
     return {"status": "ok"}
 
 @app.post("/projects/{pid}/files/delete")
@@ -1014,8 +4874,10 @@ def api_files_delete(pid: str, body: PathBody):
         return {"status": "ok"}
     if os.path.isdir(target):
         shutil.rmtree(target)
+        _forget_workspace_roots(target)
     else:
         os.remove(target)
+    _search_index_touch(pid, target)
     return {"status": "ok"}
 
 @app.post("/projects/{pid}/files/rename")
@@ -1025,30 +4887,331 @@ def api_files_rename(pid: str, body: RenameMoveBody):
     dst = safe_join(root, body.dst)
     os.makedirs(os.path.dirname(dst), exist_ok=True)
     os.replace(src, dst)
+    _forget_workspace_roots(src)
+    _search_index_touch(pid, src, dst)
     return {"status": "ok"}
 
 @app.post("/projects/{pid}/files/move")
 def api_files_move(pid: str, body: RenameMoveBody):
     return api_files_rename(pid, body)
 
+# --- Uploads: streamed in fixed-size chunks, hashed on the fly, size/quota checked per chunk ---
+UPLOAD_CHUNK_BYTES = int(os.environ.get("UPLOAD_CHUNK_BYTES", str(1024 * 1024)) or 1024 * 1024)
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(20 * 1024 ** 3)) or 0)        # 0 => unlimited
+PROJECT_QUOTA_BYTES = int(os.environ.get("PROJECT_QUOTA_BYTES", "0") or 0)                  # 0 => unlimited
+WORKSPACE_USAGE_TTL = float(os.environ.get("WORKSPACE_USAGE_TTL", "30") or 30)
+
+_WORKSPACE_USAGE: Dict[str, Any] = {}   # root -> (computed_at, bytes)
+_UPLOAD_HASHERS: Dict[str, Any] = {}    # upload_id -> (offset, sha256 object) for this process
+
+def uploads_dir(pid: str) -> str:
+    return os.path.join(DATA_DIR, "uploads", pid)
+
+def workspace_usage(root: str, refresh: bool = False) -> int:
+    hit = _WORKSPACE_USAGE.get(root)
+    if hit and not refresh and time.time() - hit[0] < WORKSPACE_USAGE_TTL:
+        return hit[1]
+    total = 0
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    _WORKSPACE_USAGE[root] = (time.time(), total)
+    return total
+
+def _workspace_usage_add(root: str, delta: int):
+    hit = _WORKSPACE_USAGE.get(root)
+    if hit:
+        _WORKSPACE_USAGE[root] = (hit[0], max(0, hit[1] + delta))
+
+def _file_size(path: str) -> int:
+    """Size of a regular file, 0 when missing (what replacing it frees)."""
+    try:
+        return os.path.getsize(path) if os.path.isfile(path) else 0
+    except OSError:
+        return 0
+
+def project_quota(pid: str) -> int:
+    q = (project_get(pid) or {}).get("quota_bytes")
+    return PROJECT_QUOTA_BYTES if q is None else int(q)
+
+def _pending_upload_bytes(pid: str, exclude: Optional[str] = None) -> int:
+    """Bytes already received by the project's unfinished resumable uploads (other than `exclude`)."""
+    total = 0
+    try:
+        with os.scandir(uploads_dir(pid)) as it:
+            for entry in it:
+                if entry.name.endswith(".part") and entry.name != f"{exclude}.part":
+                    try:
+                        total += entry.stat().st_size
+                    except OSError:
+                        continue
+    except OSError:
+        pass
+    return total
+
+def _upload_limits(pid: str, root: str, replacing: str, upload_id: Optional[str] = None) -> Optional[int]:
+    """Max bytes for this upload (None => unlimited) given UPLOAD_MAX_BYTES and the remaining quota."""
+    limits = []
+    if UPLOAD_MAX_BYTES > 0:
+        limits.append(UPLOAD_MAX_BYTES)
+    quota = project_quota(pid)
+    if quota > 0:
+        # Overwriting a file frees its current size; parallel resumable uploads hold theirs until complete/abort.
+        freed = _file_size(replacing)
+        used = workspace_usage(root) + _pending_upload_bytes(pid, exclude=upload_id)
+        limits.append(max(0, quota - used + freed))
+    return min(limits) if limits else None   # 0 means the quota is used up, not "unlimited"
+
+def _raise_too_large(limit: int):
+    raise HTTPException(413, f"Upload exceeds the allowed size ({limit} bytes: max upload size or project quota).")
+
 @app.post("/projects/{pid}/files/upload")
 async def api_files_upload(pid: str, path: str = Form(""), file: UploadFile = File(...)):
-    root = workspace_root(pid)
+    # Stat-heavy steps (project lookup, quota walk) stay off the event loop, like the writes below.
+    root = await run_in_threadpool(workspace_root, pid)
     dir_target = safe_join(root, path)
-    os.makedirs(dir_target, exist_ok=True)
-    out_path = safe_join(root, os.path.join(path, file.filename))
-    with open(out_path, "wb") as f:
-        f.write(await file.read())
-    return {"status": "ok", "name": file.filename}
+    await run_in_threadpool(os.makedirs, dir_target, exist_ok=True)
+    name = os.path.basename(file.filename or "") or "upload.bin"
+    out_path = safe_join(root, os.path.join(path, name))
+    limit = await run_in_threadpool(_upload_limits, pid, root, out_path)
+    old_size = await run_in_threadpool(_file_size, out_path)
+
+    tmp = atomic_tmp_path(out_path, ".upload")
+    hasher = hashlib.sha256()
+    size = 0
+    f = open(tmp, "wb")
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if limit is not None and size > limit:
+                _raise_too_large(limit)
+            hasher.update(chunk)
+            await run_in_threadpool(f.write, chunk)
+        await run_in_threadpool(f.flush)
+        if ATOMIC_WRITE_FSYNC:
+            await run_in_threadpool(os.fsync, f.fileno())
+        f.close()
+        await run_in_threadpool(atomic_commit, tmp, out_path)
+    except BaseException:
+        f.close()
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    _workspace_usage_add(root, size - old_size)   # an overwrite frees the old file's bytes
+    await run_in_threadpool(_search_index_touch, pid, out_path)
+    return {"status": "ok", "name": name, "size": size, "sha256": hasher.hexdigest()}
+
+# --- Resumable uploads: init -> PUT ?offset=N (raw body, repeatable) -> complete ---
+class UploadInit(BaseModel):
+    path: str                      # destination file path, relative to the workspace
+    size: Optional[int] = None     # expected total size (checked against limits up front and on complete)
+    sha256: Optional[str] = None   # expected digest, verified on complete
+
+def _upload_meta_path(pid: str, upload_id: str) -> str:
+    if not re.fullmatch(r"[0-9a-f]{32}", upload_id or ""):
+        raise HTTPException(404, "Upload not found")
+    return os.path.join(uploads_dir(pid), f"{upload_id}.json")
+
+def _upload_lock_name(pid: str, upload_id: str) -> str:
+    return f"upload:{pid}:{upload_id}"
+
+def _upload_load(pid: str, upload_id: str) -> Dict[str, Any]:
+    meta = read_json(_upload_meta_path(pid, upload_id), None)
+    if not meta:
+        raise HTTPException(404, "Upload not found")
+    part = meta["part"]
+    meta["offset"] = os.path.getsize(part) if os.path.exists(part) else 0
+    return meta
+
+def _upload_status(meta: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: meta.get(k) for k in ("upload_id", "path", "size", "offset", "created_at")}
+
+@app.post("/projects/{pid}/files/uploads")
+def api_upload_init(pid: str, body: UploadInit):
+    root = workspace_root(pid)
+    target = safe_join(root, body.path)
+    if os.path.isdir(target):
+        raise HTTPException(400, "Upload target is a directory.")
+    limit = _upload_limits(pid, root, target)
+    if body.size is not None and limit is not None and body.size > limit:
+        _raise_too_large(limit)
+    upload_id = uuid.uuid4().hex
+    os.makedirs(uploads_dir(pid), exist_ok=True)
+    part = os.path.join(uploads_dir(pid), f"{upload_id}.part")
+    open(part, "wb").close()
+    meta = {
+        "upload_id": upload_id,
+        "path": body.path,
+        "size": body.size,
+        "sha256": (body.sha256 or "").lower() or None,
+        "part": part,
+        "created_at": now_iso(),
+    }
+    write_json(_upload_meta_path(pid, upload_id), meta)
+    meta["offset"] = 0
+    return _upload_status(meta)
+
+@app.get("/projects/{pid}/files/uploads/{upload_id}")
+def api_upload_status(pid: str, upload_id: str):
+    return _upload_status(_upload_load(pid, upload_id))
+
+@app.put("/projects/{pid}/files/uploads/{upload_id}")
+async def api_upload_chunk(pid: str, upload_id: str, request: Request, offset: int = Query(..., ge=0)):
+    _upload_meta_path(pid, upload_id)   # validates the id before it names a lock
+    # One request per upload at a time: the offset check, the append and the cached hash
+    # must describe the same bytes.
+    async with named_lock_async(_upload_lock_name(pid, upload_id)):
+        meta = await run_in_threadpool(_upload_load, pid, upload_id)
+        if offset != meta["offset"]:
+            raise HTTPException(409, f"Offset mismatch: upload is at {meta['offset']}.")
+        root = await run_in_threadpool(workspace_root, pid)
+        limit = await run_in_threadpool(_upload_limits, pid, root, safe_join(root, meta["path"]), upload_id)
+        if meta.get("size") is not None:
+            limit = meta["size"] if limit is None else min(limit, meta["size"])
+
+        hashed = _UPLOAD_HASHERS.get(upload_id)
+        # Work on a copy: the cached state must still describe `offset` if this request is rejected.
+        hasher = hashed[1].copy() if hashed and hashed[0] == offset else None
+        if hasher is None and offset == 0:
+            hasher = hashlib.sha256()
+        size = offset
+        with open(meta["part"], "ab") as f:
+            async for chunk in request.stream():
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if limit is not None and size > limit:
+                    await run_in_threadpool(f.truncate, offset)
+                    _raise_too_large(limit)
+                if hasher is not None:
+                    hasher.update(chunk)
+                await run_in_threadpool(f.write, chunk)
+            await run_in_threadpool(f.flush)
+            if ATOMIC_WRITE_FSYNC:
+                await run_in_threadpool(os.fsync, f.fileno())
+        if hasher is not None:
+            _UPLOAD_HASHERS[upload_id] = (size, hasher)
+        meta["offset"] = size
+        return _upload_status(meta)
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+@app.post("/projects/{pid}/files/uploads/{upload_id}/complete")
+def api_upload_complete(pid: str, upload_id: str):
+    _upload_meta_path(pid, upload_id)
+    with named_lock(_upload_lock_name(pid, upload_id)):
+        return _upload_complete_locked(pid, upload_id)
+
+def _upload_complete_locked(pid: str, upload_id: str) -> Dict[str, Any]:
+    meta = _upload_load(pid, upload_id)
+    if meta.get("size") is not None and meta["offset"] != meta["size"]:
+        raise HTTPException(409, f"Upload incomplete: {meta['offset']} of {meta['size']} bytes received.")
+    hashed = _UPLOAD_HASHERS.pop(upload_id, None)
+    # The running hash only exists in the process that received every chunk; otherwise re-hash.
+    digest = hashed[1].hexdigest() if hashed and hashed[0] == meta["offset"] else _sha256_file(meta["part"])
+    if meta.get("sha256") and digest != meta["sha256"]:
+        raise HTTPException(422, f"sha256 mismatch: got {digest}.")
+
+    root = workspace_root(pid)
+    target = safe_join(root, meta["path"])
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    old_size = _file_size(target)
+    try:
+        atomic_commit(meta["part"], target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Workspace on another filesystem: copy next to the target, then rename atomically.
+        with open(meta["part"], "rb") as src:
+            atomic_write(target, iter(lambda: src.read(UPLOAD_CHUNK_BYTES), b""))
+        os.remove(meta["part"])
+    os.remove(_upload_meta_path(pid, upload_id))
+    _workspace_usage_add(root, meta["offset"] - old_size)
+    _search_index_touch(pid, target)
+    return {"status": "ok", "path": meta["path"], "size": meta["offset"], "sha256": digest}
+
+@app.delete("/projects/{pid}/files/uploads/{upload_id}")
+def api_upload_abort(pid: str, upload_id: str):
+    _upload_meta_path(pid, upload_id)
+    with named_lock(_upload_lock_name(pid, upload_id)):
+        meta = _upload_load(pid, upload_id)
+        _UPLOAD_HASHERS.pop(upload_id, None)
+        for path in (meta["part"], _upload_meta_path(pid, upload_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return {"status": "ok"}
+
+def _content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+def _iter_file_range(path: str, start: int, end: int, chunk: int = 256 * 1024):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = f.read(min(chunk, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
 
 @app.get("/projects/{pid}/files/download")
-def api_files_download(pid: str, path: str):
+def api_files_download(pid: str, path: str, request: Request):
     root = workspace_root(pid)
     target = safe_join(root, path)
     if not os.path.isfile(target):
         raise HTTPException(404, "File not found")
     filename = os.path.basename(target)
-    return FileResponse(target, filename=filename, media_type=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    st = os.stat(target)
+    etag = file_etag(st)
+    headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    rng = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if rng and if_range and if_range.strip() != etag:
+        rng = None  # representation changed since the client's partial copy: send it whole
+    parsed = _parse_range(rng, st.st_size)
+    if parsed == "unsatisfiable":
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{st.st_size}"})
+    if parsed:
+        start, end = parsed
+        headers.update({
+            "Content-Range": f"bytes {start}-{end}/{st.st_size}",
+            "Content-Length": str(end - start + 1),
+            "Content-Disposition": _content_disposition(filename),
+        })
+        return StreamingResponse(_iter_file_range(target, start, end), status_code=206, media_type=media_type, headers=headers)
+    return FileResponse(target, filename=filename, media_type=media_type, headers=headers, stat_result=st)
 
 
 # main.py
@@ -1063,12 +5226,14 @@ async def voice_stt(file: UploadFile = File(...), model: str = Form("whisper-1")
         raise HTTPException(500, "No API key for STT")
     url = "https://api.openai.com/v1/audio/transcriptions"
     headers = {"Authorization": f"Bearer {api_key}"}
-    files = {
-        "file": (file.filename, await file.read(), file.content_type or "audio/webm"),
-        "model": (None, model),
-    }
-    r = requests.post(url, headers=headers, files=files, timeout=120)
-    r.raise_for_status()
+    files = {"file": (file.filename, await file.read(), file.content_type or "audio/webm")}
+    try:
+        async with _llm_http_slot(url):
+            r = await llm_http_client().post(url, headers=headers, files=files, data={"model": model})
+    except httpx.HTTPError as e:
+        raise HTTPException(502, f"Upstream request failed: {e}"[:800])
+    if r.status_code >= 400:
+        raise _upstream_error(r)
     return {"text": r.json().get("text", "")}
 
 class TTSBody(BaseModel):
@@ -1078,7 +5243,7 @@ class TTSBody(BaseModel):
     format: Optional[str] = "mp3"
 
 @app.post("/voice/tts")
-def voice_tts(body: TTSBody):
+async def voice_tts(body: TTSBody):
     if PUBLIC_DEMO:
         raise HTTPException(403, "CV demo: voice disabled.")
     if not api_key:
@@ -1086,8 +5251,13 @@ def voice_tts(body: TTSBody):
     url = "https://api.openai.com/v1/audio/speech"
     headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
     payload = {"model": body.model, "voice": body.voice, "input": body.text, "format": body.format}
-    r = requests.post(url, headers=headers, json=payload, timeout=120)
-    r.raise_for_status()
+    try:
+        async with _llm_http_slot(url):
+            r = await llm_http_client().post(url, headers=headers, json=payload)
+    except httpx.HTTPError as e:
+        raise HTTPException(502, f"Upstream request failed: {e}"[:800])
+    if r.status_code >= 400:
+        raise _upstream_error(r)
     ext = body.format or "mp3"
     fname = f"speech.{ext}"
     tmp_path = os.path.join(DATA_DIR, fname)
@@ -0,0 +1,22 @@
+import os, sys, tempfile
+
+import pytest
+
+# main.py resolves DATA_DIR from the working directory at import time, so move to a scratch dir first.
+os.chdir(tempfile.mkdtemp(prefix="sandbox-tests-"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    with TestClient(main.app) as c:
+        yield c
+
+
+@pytest.fixture
+def project(client, tmp_path):
+    r = client.post("/projects", json={"name": "test", "root": str(tmp_path / "ws")})
+    assert r.status_code == 200
+    return r.json()["project"]
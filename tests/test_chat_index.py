@@ -0,0 +1,61 @@
+import json, os
+
+import main
+
+
+def _titles(client, pid, **params):
+    r = client.get(f"/projects/{pid}/chats", params=params)
+    assert r.status_code == 200
+    return [c["title"] for c in r.json()["chats"]]
+
+
+def test_updates_append_to_the_log_and_list_replays_them(client, project):
+    pid = project["id"]
+    for t in ("a", "b", "c"):
+        client.post(f"/projects/{pid}/chats", json={"title": t})
+    with open(main.chat_index_log_path(pid), "rb") as f:
+        assert len(f.read().splitlines()) >= 3
+    assert sorted(_titles(client, pid)) == ["a", "b", "c"]
+    assert _titles(client, pid, sort="title", order="asc", limit=2) == ["a", "b"]
+
+    # Another worker's append is picked up from the log without a reload of _index.json.
+    summary = {"id": "ext", "project_id": pid, "title": "external", "message_count": 0}
+    with open(main.chat_index_log_path(pid), "ab") as f:
+        f.write((json.dumps({"id": "ext", "summary": summary}) + "\n").encode())
+        f.write(b'{"id": "torn", "summary": {"title": "half')   # not applied until complete
+    assert sorted(_titles(client, pid)) == ["a", "b", "c", "external"]
+
+
+def test_delete_drops_the_summary(client, project):
+    pid = project["id"]
+    cid = client.post(f"/projects/{pid}/chats", json={"title": "gone"}).json()["chat"]["id"]
+    assert client.delete(f"/projects/{pid}/chats/{cid}").status_code == 200
+    assert _titles(client, pid) == []
+
+
+def test_log_is_folded_into_the_index(client, project, monkeypatch):
+    monkeypatch.setattr(main, "CHAT_INDEX_COMPACT", 3)
+    pid = project["id"]
+    for t in ("a", "b", "c", "d"):
+        client.post(f"/projects/{pid}/chats", json={"title": t})
+    with open(main.chat_index_path(pid), encoding="utf-8") as f:
+        base = json.load(f)["chats"]
+    assert len(base) >= 3
+    main._CHAT_INDEX_CACHE.pop(pid, None)   # a fresh process reads base + log
+    assert sorted(_titles(client, pid)) == ["a", "b", "c", "d"]
+
+
+def test_missing_index_is_rebuilt_from_chat_logs(client, project):
+    pid = project["id"]
+    cid = client.post(f"/projects/{pid}/chats", json={"title": "x"}).json()["chat"]["id"]
+    main.chat_append(pid, cid, [{"role": "user", "content": "hello  there"}])
+    for path in (main.chat_index_path(pid), main.chat_index_log_path(pid)):
+        if os.path.exists(path):
+            os.remove(path)
+    main._CHAT_INDEX_CACHE.pop(pid, None)
+    chats = client.get(f"/projects/{pid}/chats").json()["chats"]
+    assert [(c["title"], c["message_count"], c["last_snippet"]) for c in chats] == [("x", 1, "hello there")]
+
+
+def test_bad_sort_key(client, project):
+    assert client.get(f"/projects/{project['id']}/chats", params={"sort": "nope"}).status_code == 400
@@ -0,0 +1,78 @@
+import json, os
+
+import main
+
+
+def _new_chat(client, pid, title="t"):
+    return client.post(f"/projects/{pid}/chats", json={"title": title}).json()["chat"]["id"]
+
+
+def test_appends_replay_messages_and_meta(client, project):
+    pid = project["id"]
+    cid = _new_chat(client, pid)
+    main.chat_append(pid, cid, [{"role": "user", "content": "hi", "ts": "2024-01-01T00:00:00Z"}])
+    main.chat_append(pid, cid, [{"role": "assistant", "content": "hello", "ts": "2024-01-01T00:00:01Z"}],
+                     meta={"title": "renamed"})
+
+    chat = client.get(f"/projects/{pid}/chats/{cid}").json()["chat"]
+    assert [m["content"] for m in chat["messages"]] == ["hi", "hello"]
+    assert chat["title"] == "renamed"
+    assert chat["updated_at"] == "2024-01-01T00:00:01Z"
+
+    tail = client.get(f"/projects/{pid}/chats/{cid}", params={"last": 1}).json()["chat"]
+    assert [m["content"] for m in tail["messages"]] == ["hello"]
+    assert tail["message_count"] == 2
+
+
+def test_torn_last_line_is_dropped_and_compacted(client, project):
+    pid = project["id"]
+    cid = _new_chat(client, pid)
+    main.chat_append(pid, cid, [{"role": "user", "content": "kept"}])
+    log = main.chat_log_path(pid, cid)
+    with open(log, "ab") as f:
+        f.write(b'{"kind":"message","role":"assistant","content":"cut')
+
+    # The next append must not glue its record onto the torn line.
+    main.chat_append(pid, cid, [{"role": "assistant", "content": "after"}])
+    chat = client.get(f"/projects/{pid}/chats/{cid}").json()["chat"]
+    assert [m["content"] for m in chat["messages"]] == ["kept", "after"]
+
+    # Loading with a torn line compacted the log back to header + messages.
+    with open(log, "rb") as f:
+        lines = f.read().splitlines()
+    assert [json.loads(l)["kind"] for l in lines] == ["header", "message", "message"]
+
+
+def test_meta_records_are_folded_into_the_header(client, project, monkeypatch):
+    monkeypatch.setattr(main, "CHAT_COMPACT_META", 2)
+    pid = project["id"]
+    cid = _new_chat(client, pid)
+    for i in range(3):
+        main.chat_append(pid, cid, [], meta={"title": f"t{i}"})
+    assert client.get(f"/projects/{pid}/chats/{cid}").json()["chat"]["title"] == "t2"
+    with open(main.chat_log_path(pid, cid), "rb") as f:
+        header, *rest = [json.loads(l) for l in f.read().splitlines()]
+    assert header["kind"] == "header" and header["title"] == "t2"
+    assert rest == []
+
+
+def test_legacy_json_chat_is_converted_on_append(client, project):
+    pid = project["id"]
+    cid = "legacy01"
+    main.write_json(main.chat_path(pid, cid), {
+        "id": cid, "project_id": pid, "title": "old",
+        "messages": [{"role": "user", "content": "from json"}],
+        "created_at": "2023-01-01T00:00:00Z", "updated_at": "2023-01-01T00:00:00Z",
+    })
+    assert client.get(f"/projects/{pid}/chats/{cid}").json()["chat"]["title"] == "old"
+
+    main.chat_append(pid, cid, [{"role": "assistant", "content": "to jsonl"}])
+    chat = client.get(f"/projects/{pid}/chats/{cid}").json()["chat"]
+    assert [m["content"] for m in chat["messages"]] == ["from json", "to jsonl"]
+    assert not os.path.exists(main.chat_path(pid, cid))
+
+
+def test_missing_chat(client, project):
+    pid = project["id"]
+    assert client.get(f"/projects/{pid}/chats/nope").status_code == 404
+    assert client.delete(f"/projects/{pid}/chats/nope").status_code == 404
@@ -0,0 +1,78 @@
+import asyncio, threading
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def chat(client, project):
+    pid = project["id"]
+    cid = client.post(f"/projects/{pid}/chats", json={"title": "t"}).json()["chat"]["id"]
+    return pid, cid
+
+
+def _messages(client, pid, cid):
+    return client.get(f"/projects/{pid}/chats/{cid}").json()["chat"]["messages"]
+
+
+def test_overlapping_turns_are_both_kept(client, chat, monkeypatch):
+    pid, cid = chat
+    started = {"n": 0}
+
+    async def agent(messages, project, pid=None):
+        # Neither turn replies until both have loaded the (empty) history.
+        started["n"] += 1
+        for _ in range(500):
+            if started["n"] >= 2:
+                break
+            await asyncio.sleep(0.01)
+        return "re: " + messages[-1]["content"]
+
+    monkeypatch.setattr(main, "llm_chat_agent", agent)
+    results = {}
+
+    def send(text):
+        results[text] = client.post(f"/projects/{pid}/chats/{cid}/message", json={"content": text}).json()
+
+    threads = [threading.Thread(target=send, args=(t,)) for t in ("one", "two")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+
+    msgs = _messages(client, pid, cid)
+    assert len(msgs) == 4
+    # Each user message is followed by its own reply; the later commit says what it missed.
+    for user, reply in (msgs[0:2], msgs[2:4]):
+        assert reply["content"] == "re: " + user["content"]
+    assert "interleaved" not in msgs[1]
+    assert msgs[3]["interleaved"] == 2
+    assert sorted(r.get("interleaved", 0) for r in results.values()) == [0, 2]
+
+
+def test_commits_on_one_base_serialize(chat):
+    pid, cid = chat
+    turns = [main._prepare_turn(pid, cid, f"m{i}") for i in range(8)]
+    seen = []
+    threads = [threading.Thread(target=lambda t=t: seen.append(main._commit_turn(t, "ok"))) for t in turns]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+    assert sorted(seen) == list(range(0, 16, 2))
+    msgs = main.chat_load(pid, cid)["messages"]
+    assert [m["role"] for m in msgs] == ["user", "assistant"] * 8
+    assert main.chat_summary(pid, cid)["message_count"] == 16
+
+
+def test_failed_turn_commits_nothing(client, chat, monkeypatch):
+    pid, cid = chat
+
+    async def agent(messages, project, pid=None):
+        raise main.HTTPException(502, "upstream down")
+
+    monkeypatch.setattr(main, "llm_chat_agent", agent)
+    r = client.post(f"/projects/{pid}/chats/{cid}/message", json={"content": "hi"})
+    assert r.status_code == 502
+    assert _messages(client, pid, cid) == []
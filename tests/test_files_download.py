@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+import main
+
+DATA = b"0123456789"
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("bytes=2-5", (2, 5)),
+    ("bytes=7-", (7, 9)),
+    ("bytes=-3", (7, 9)),
+    ("bytes=-30", (0, 9)),
+    ("bytes=5-100", (5, 9)),
+    ("bytes = 1 - 2", (1, 2)),
+    ("bytes=10-", "unsatisfiable"),
+    ("bytes=5-4", "unsatisfiable"),
+    ("bytes=-0", "unsatisfiable"),
+    ("bytes=-", None),
+    ("bytes=0-1,4-5", None),   # multipart ranges are not supported: whole file
+    ("items=0-1", None),
+])
+def test_parse_range(header, expected):
+    assert main._parse_range(header, len(DATA)) == expected
+
+
+def test_etag_matching():
+    assert main._etag_matches('"a", W/"b"', '"b"')
+    assert main._etag_matches("*", '"b"')
+    assert not main._etag_matches('"a"', '"b"')
+    assert not main._etag_matches(None, '"b"')
+
+
+@pytest.fixture
+def url(client, project):
+    with open(os.path.join(project["root"], "f.bin"), "wb") as f:
+        f.write(DATA)
+    return f"/projects/{project['id']}/files/download?path=f.bin"
+
+
+def test_full_download_and_not_modified(client, url):
+    r = client.get(url)
+    assert r.status_code == 200 and r.content == DATA
+    assert r.headers["accept-ranges"] == "bytes"
+    etag = r.headers["etag"]
+
+    r = client.get(url, headers={"If-None-Match": etag})
+    assert r.status_code == 304 and r.content == b""
+    assert client.get(url, headers={"If-None-Match": "W/" + etag}).status_code == 304
+    assert client.get(url, headers={"If-None-Match": '"stale"'}).status_code == 200
+
+
+def test_range_requests(client, url):
+    r = client.get(url, headers={"Range": "bytes=2-5"})
+    assert r.status_code == 206 and r.content == b"2345"
+    assert r.headers["content-range"] == "bytes 2-5/10"
+    assert client.get(url, headers={"Range": "bytes=-3"}).content == b"789"
+
+    r = client.get(url, headers={"Range": "bytes=20-"})
+    assert r.status_code == 416
+    assert r.headers["content-range"] == "bytes */10"
+
+
+def test_if_range_with_a_stale_etag_sends_the_whole_file(client, url):
+    etag = client.get(url).headers["etag"]
+    r = client.get(url, headers={"Range": "bytes=0-1", "If-Range": etag})
+    assert r.status_code == 206 and r.content == b"01"
+    r = client.get(url, headers={"Range": "bytes=0-1", "If-Range": '"old"'})
+    assert r.status_code == 200 and r.content == DATA
+
+
+def test_read_route_honours_if_none_match(client, project, url):
+    pid = project["id"]
+    r = client.post(f"/projects/{pid}/files/read", json={"path": "f.bin"})
+    etag = r.json()["etag"]
+    assert client.post(f"/projects/{pid}/files/read", json={"path": "f.bin", "if_none_match": etag}).status_code == 304
+    window = client.post(f"/projects/{pid}/files/read", json={"path": "f.bin", "offset": 8, "length": 5}).json()
+    assert (window["content"], window["eof"]) == ("89", True)
+
+
+def test_missing_file(client, project):
+    assert client.get(f"/projects/{project['id']}/files/download?path=nope").status_code == 404
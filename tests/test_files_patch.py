@@ -0,0 +1,25 @@
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+
+
+def test_unified_diff_keeps_unicode_line_separators():
+    text = 'a\n\x0cb\nc = "x y"\n\x1c\x1d\x1e\x85\x0b\nd\n'
+    out = main._apply_unified_diff(text, "@@ -5,1 +5,1 @@\n-d\n+D\n")
+    assert out == 'a\n\x0cb\nc = "x y"\n\x1c\x1d\x1e\x85\x0b\nD\n'
+
+
+def test_unified_diff_hunk_lines_may_contain_form_feed():
+    out = main._apply_unified_diff("a\n\x0cb\nc\n", "@@ -2,1 +2,1 @@\n-\x0cb\n+\x0cB\n")
+    assert out == "a\n\x0cB\nc\n"
+
+
+def test_unified_diff_keeps_mixed_line_endings():
+    text = "a\r\nb\nc\r\nd\n"
+    out = main._apply_unified_diff(text, "@@ -2,2 +2,3 @@\n b\n-c\n+C\n+C2\n")
+    assert out == "a\r\nb\nC\r\nC2\r\nd\n"
+
+
+def test_unified_diff_keeps_missing_final_newline():
+    assert main._apply_unified_diff("a\nb", "@@ -1,1 +1,1 @@\n-a\n+A\n") == "A\nb"
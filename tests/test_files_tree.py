@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+import main
+
+FILES = ["a.txt", "b/c.py", "b/d/e.py", "b/f.txt", "g/h.py", "z.py"]
+
+
+@pytest.fixture
+def tree(client, project):
+    for rel in FILES:
+        path = os.path.join(project["root"], rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(rel)
+    return f"/projects/{project['id']}/files/tree"
+
+
+def _all_pages(client, url, **params):
+    paths, cursor, pages = [], None, 0
+    while True:
+        r = client.get(url, params={**params, **({"cursor": cursor} if cursor else {})})
+        assert r.status_code == 200
+        body = r.json()
+        paths += [e["path"] for e in body["entries"]]
+        pages += 1
+        cursor = body["next_cursor"]
+        if not cursor:
+            return paths, pages
+
+
+def test_depth_first_listing(client, tree):
+    entries = client.get(tree, params={"depth": 0}).json()["entries"]
+    assert [e["path"] for e in entries] == ["a.txt", "b", "b/c.py", "b/d", "b/d/e.py", "b/f.txt", "g", "g/h.py", "z.py"]
+    first = entries[0]
+    assert (first["type"], first["size"], first["depth"]) == ("file", len("a.txt"), 1)
+    assert [e["path"] for e in client.get(tree).json()["entries"]] == ["a.txt", "b", "g", "z.py"]
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 100])
+def test_cursor_pages_cover_the_tree_once(client, tree, limit):
+    whole = [e["path"] for e in client.get(tree, params={"depth": 0}).json()["entries"]]
+    paths, pages = _all_pages(client, tree, depth=0, limit=limit)
+    assert paths == whole
+    assert pages == -(-len(whole) // limit)   # no trailing empty page
+
+
+def test_paging_a_subdirectory_with_glob(client, tree):
+    paths, _ = _all_pages(client, tree, path="b", depth=0, glob="*.py", limit=1)
+    assert paths == ["b/c.py", "b/d/e.py"]
+
+
+def test_cursor_survives_removal_of_its_entry(client, tree, project):
+    page = client.get(tree, params={"depth": 0, "limit": 3}).json()
+    assert page["entries"][-1]["path"] == "b/c.py"
+    os.remove(os.path.join(project["root"], "b", "c.py"))
+    rest = client.get(tree, params={"depth": 0, "limit": 100, "cursor": page["next_cursor"]}).json()
+    assert [e["path"] for e in rest["entries"]] == ["b/d", "b/d/e.py", "b/f.txt", "g", "g/h.py", "z.py"]
+
+
+def test_large_directory_listing_is_cached_until_it_changes(client, tree, project, monkeypatch):
+    monkeypatch.setattr(main, "TREE_CACHE_MIN_ENTRIES", 1)
+    assert [e["path"] for e in client.get(tree, params={"path": "g"}).json()["entries"]] == ["g/h.py"]
+    with open(os.path.join(project["root"], "g", "i.py"), "w") as f:
+        f.write("new")
+    os.utime(os.path.join(project["root"], "g"), ns=(0, 10 ** 18))   # make sure the mtime moves
+    assert [e["path"] for e in client.get(tree, params={"path": "g"}).json()["entries"]] == ["g/h.py", "g/i.py"]
+
+
+def test_bad_cursors_and_paths(client, tree):
+    assert client.get(tree, params={"cursor": "%%%"}).status_code == 400
+    other = main.tree_cursor("g/h.py")
+    assert client.get(tree, params={"path": "b", "cursor": other}).status_code == 400
+    assert client.get(tree, params={"path": "b", "cursor": main.tree_cursor("b")}).status_code == 400
+    assert client.get(tree, params={"path": "missing"}).json() == {"entries": [], "next_cursor": None}
+    assert client.get(tree, params={"path": "../.."}).status_code == 400
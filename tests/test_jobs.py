@@ -0,0 +1,123 @@
+import asyncio, os, time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def jobs_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "JOBS_DIR", str(tmp_path / "jobs"))
+    return tmp_path / "jobs"
+
+
+@pytest.fixture
+def chat(client, project):
+    pid = project["id"]
+    cid = client.post(f"/projects/{pid}/chats", json={"title": "t"}).json()["chat"]["id"]
+    return pid, cid
+
+
+def _agent(reply="done", fail=None, steps=0, block=None):
+    async def agent(messages, project, pid=None, on_event=None):
+        for step in range(steps):
+            await on_event({"type": "step", "step": step})
+        if block is not None:
+            await block.wait()
+        if fail:
+            raise main.HTTPException(502, fail)
+        return reply
+    return agent
+
+
+def _wait(client, pid, job_id, *states, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = client.get(f"/projects/{pid}/jobs/{job_id}").json()
+        if job["status"] in states:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job stuck in {job['status']}")
+
+
+def _send(client, pid, cid, text="hi"):
+    r = client.post(f"/projects/{pid}/chats/{cid}/message", json={"content": text, "background": True})
+    assert r.status_code == 202
+    return r.json()["id"]
+
+
+def test_background_turn_runs_and_commits(client, chat, monkeypatch):
+    pid, cid = chat
+    monkeypatch.setattr(main, "llm_chat_agent", _agent("hello", steps=2))
+    job_id = _send(client, pid, cid)
+    job = _wait(client, pid, job_id, "succeeded")
+    assert job["result"] == {"reply": "hello", "interleaved": 0}
+    assert job["steps"] == 2 and "content" not in job
+    msgs = client.get(f"/projects/{pid}/chats/{cid}").json()["chat"]["messages"]
+    assert [m["content"] for m in msgs] == ["hi", "hello"]
+    assert [j["id"] for j in client.get(f"/projects/{pid}/jobs", params={"status": "succeeded"}).json()["jobs"]] == [job_id]
+
+
+def test_failed_turn_is_recorded(client, chat, monkeypatch):
+    pid, cid = chat
+    monkeypatch.setattr(main, "llm_chat_agent", _agent(fail="upstream down"))
+    job = _wait(client, pid, _send(client, pid, cid), "failed")
+    assert job["error"] == {"status_code": 502, "detail": "upstream down"}
+    assert client.get(f"/projects/{pid}/chats/{cid}").json()["chat"]["messages"] == []
+
+
+def test_cancel_running_job_at_next_step(client, chat, monkeypatch):
+    pid, cid = chat
+    block = asyncio.Event()
+
+    async def agent(messages, project, pid=None, on_event=None):
+        await on_event({"type": "step", "step": 0})
+        while not block.is_set():
+            await asyncio.sleep(0.01)
+        await on_event({"type": "step", "step": 1})
+        return "too late"
+
+    monkeypatch.setattr(main, "llm_chat_agent", agent)
+    job_id = _send(client, pid, cid)
+    _wait(client, pid, job_id, "running")
+    assert client.post(f"/projects/{pid}/jobs/{job_id}/cancel").json()["cancel_requested"] is True
+    block.set()
+    assert _wait(client, pid, job_id, "cancelled")["result"] is None
+
+
+def test_unknown_and_foreign_jobs(client, chat):
+    pid, cid = chat
+    other = client.post("/projects", json={"name": "other"}).json()["project"]["id"]
+    job = main.job_create(pid, cid, "queued only")
+    assert client.get(f"/projects/{other}/jobs/{job['id']}").status_code == 404
+    assert client.get(f"/projects/{pid}/jobs/{'0' * 32}").status_code == 404
+    assert client.post(f"/projects/{pid}/jobs/not-a-job/cancel").status_code == 404
+    assert client.post(f"/projects/nope/chats/{cid}/message",
+                       json={"content": "x", "background": True}).status_code == 404
+
+
+def test_restart_recovers_queued_and_orphaned_jobs(client, chat, monkeypatch):
+    pid, cid = chat
+    queued = main.job_create(pid, cid, "left queued")["id"]
+    orphan = main.job_create(pid, cid, "owner died")["id"]
+    live = main.job_create(pid, cid, "owner alive")["id"]
+    main._job_update(orphan, lambda j: j.update(status="running", owner="dead", heartbeat=time.time() - 3600))
+    main._job_update(live, lambda j: j.update(status="running", owner="other", heartbeat=time.time()))
+
+    monkeypatch.setattr(main, "llm_chat_agent", _agent("recovered"))
+    with TestClient(main.app) as restarted:   # startup runs the janitor's first scan
+        for job_id in (queued, orphan):
+            assert _wait(restarted, pid, job_id, "succeeded")["result"]["reply"] == "recovered"
+        assert restarted.get(f"/projects/{pid}/jobs/{live}").json()["status"] == "running"
+
+
+def test_shutdown_hands_running_jobs_back_to_the_queue(chat, monkeypatch, jobs_dir):
+    pid, cid = chat
+    monkeypatch.setattr(main, "llm_chat_agent", _agent(block=asyncio.Event()))
+    with TestClient(main.app) as c:
+        job_id = _send(c, pid, cid)
+        _wait(c, pid, job_id, "running")
+    job = main.job_load(job_id)
+    assert (job["status"], job["owner"]) == ("queued", None)
+    assert os.path.exists(jobs_dir / f"{job_id}.json")
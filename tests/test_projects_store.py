@@ -0,0 +1,62 @@
+import json, os
+
+import main
+
+
+def _fresh_store(monkeypatch, tmp_path, legacy=None):
+    data = tmp_path / "data"
+    data.mkdir()
+    if legacy is not None:
+        (data / "projects.json").write_text(json.dumps({"projects": legacy}), encoding="utf-8")
+    monkeypatch.setattr(main, "DATA_DIR", str(data))
+    monkeypatch.setattr(main, "PROJECTS_FILE", str(data / "projects.json"))
+    monkeypatch.setattr(main, "PROJECTS_DB", str(data / "projects.db"))
+    monkeypatch.setattr(main, "PROJECTS_BACKEND", "sqlite")
+    monkeypatch.setitem(main._PROJECT_STORE, "store", None)
+    main.project_cache_bump()
+    return data
+
+
+def test_projects_json_is_migrated_once(client, monkeypatch, tmp_path):
+    legacy = [
+        {"id": "b2", "name": "second"},
+        {"name": "no id, skipped"},
+        {"id": "a1", "name": "first"},
+    ]
+    data = _fresh_store(monkeypatch, tmp_path, legacy)
+
+    r = client.get("/projects")
+    assert r.status_code == 200
+    assert [p["id"] for p in r.json()["projects"]] == ["b2", "a1"]   # legacy order kept
+    assert not (data / "projects.json").exists()
+    assert (data / "projects.json.migrated").exists()
+
+    # A projects.json that reappears later is not imported a second time.
+    (data / "projects.json").write_text(json.dumps({"projects": [{"id": "zz"}]}), encoding="utf-8")
+    again = main._SqliteProjectStore(str(data / "projects.db"))
+    assert [p["id"] for p in again.list()] == ["b2", "a1"]
+
+
+def test_sqlite_store_crud(client, monkeypatch, tmp_path):
+    _fresh_store(monkeypatch, tmp_path)
+    created = client.post("/projects", json={"name": "one", "root": str(tmp_path / "ws")}).json()["project"]
+    pid = created["id"]
+
+    r = client.put(f"/projects/{pid}", json={"name": "renamed"})
+    assert r.status_code == 200
+    assert [p["name"] for p in client.get("/projects").json()["projects"]] == ["renamed"]
+
+    assert client.delete(f"/projects/{pid}").status_code == 200
+    assert client.get("/projects").json()["projects"] == []
+    assert client.put(f"/projects/{pid}", json={"name": "gone"}).status_code == 404
+    assert client.delete(f"/projects/{pid}").status_code == 404
+
+
+def test_registry_sees_writes_from_another_connection(client, monkeypatch, tmp_path):
+    data = _fresh_store(monkeypatch, tmp_path)
+    assert client.get("/projects").json()["projects"] == []
+    # Another worker's connection commits; data_version changes and the cache revalidates.
+    other = main._SqliteProjectStore(str(data / "projects.db"))
+    other.put({"id": "ext", "name": "external"})
+    assert [p["id"] for p in client.get("/projects").json()["projects"]] == ["ext"]
+    assert main.project_get("ext")["name"] == "external"
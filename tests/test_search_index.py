@@ -0,0 +1,84 @@
+import os, threading, time
+
+import pytest
+
+import main
+
+
+def _search(pid, query, **args):
+    return main._llm_execute_tool(pid, "search_text", {"query": query, **args})
+
+
+def _paths(out):
+    return sorted({m["path"] for m in out["matches"]})
+
+
+@pytest.fixture
+def indexed(client, project, monkeypatch):
+    monkeypatch.setattr(main, "SEARCH_INDEX_SYNC_SECONDS", 0)
+    pid = project["id"]
+    client.post(f"/projects/{pid}/files/write", json={"path": "a.py", "content": "alpha_token = 1\n"})
+    client.post(f"/projects/{pid}/files/write", json={"path": "pkg/b.py", "content": "beta_token = 2\n"})
+    idx = main.search_index_for(main.workspace_root(pid))
+    assert idx.ready.wait(10)
+    return pid
+
+
+def test_indexed_search_finds_literals_and_regexes(indexed):
+    out = _search(indexed, "alpha_token")
+    assert out["indexed"] and _paths(out) == ["a.py"]
+    assert _paths(_search(indexed, r"\w+_token = \d", regex=True)) == ["a.py", "pkg/b.py"]
+    assert _paths(_search(indexed, "BETA_TOKEN", ignore_case=True)) == ["pkg/b.py"]
+    assert _search(indexed, "missing_token")["matches"] == []
+
+
+def test_file_routes_invalidate_the_index(client, indexed):
+    pid = indexed
+    client.post(f"/projects/{pid}/files/write", json={"path": "a.py", "content": "gamma_token = 3\n"})
+    assert _search(pid, "alpha_token")["matches"] == []
+    assert _paths(_search(pid, "gamma_token")) == ["a.py"]
+
+    client.post(f"/projects/{pid}/files/rename", json={"src": "pkg", "dst": "lib"})
+    assert _paths(_search(pid, "beta_token")) == ["lib/b.py"]
+
+    client.post(f"/projects/{pid}/files/delete", json={"path": "lib"})
+    assert _search(pid, "beta_token")["matches"] == []
+
+
+def test_outside_edits_are_picked_up_by_the_sync(indexed):
+    root = main.workspace_root(indexed)
+    with open(os.path.join(root, "c.txt"), "w", encoding="utf-8") as f:
+        f.write("delta_token\n")
+    os.remove(os.path.join(root, "a.py"))
+    assert _paths(_search(indexed, "delta_token")) == ["c.txt"]
+    assert _search(indexed, "alpha_token")["matches"] == []
+
+
+def test_binary_files_are_skipped_and_bad_regex_is_rejected(indexed):
+    root = main.workspace_root(indexed)
+    with open(os.path.join(root, "blob.dat"), "wb") as f:
+        f.write(b"\0epsilon_token\n")
+    assert _search(indexed, "epsilon_token")["matches"] == []
+    with pytest.raises(main.HTTPException) as e:
+        _search(indexed, "(unclosed", regex=True)
+    assert e.value.status_code == 400
+
+
+def test_concurrent_queries_share_sync_walks(indexed, monkeypatch):
+    walk = main._walk_workspace
+    calls = []
+
+    def slow_walk(root, links=None):
+        calls.append(root)
+        time.sleep(0.2)
+        return walk(root, links)
+
+    monkeypatch.setattr(main, "_walk_workspace", slow_walk)
+    threads = [threading.Thread(target=_search, args=(indexed, "alpha_token")) for _ in range(8)]
+    for t in threads:
+        t.start()
+        time.sleep(0.01)
+    for t in threads:
+        t.join(10)
+    # The first walk may predate some calls; one more walk covers all that queued behind it.
+    assert len(calls) <= 2
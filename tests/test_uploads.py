@@ -0,0 +1,92 @@
+import hashlib, os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def quota_project(client, tmp_path):
+    r = client.post("/projects", json={"name": "quota", "root": str(tmp_path / "ws"), "quota_bytes": 25})
+    return r.json()["project"]
+
+
+def _init(client, pid, **body):
+    r = client.post(f"/projects/{pid}/files/uploads", json=body)
+    assert r.status_code == 200
+    return f"/projects/{pid}/files/uploads/{r.json()['upload_id']}"
+
+
+def _put(client, url, offset, data):
+    return client.put(url, params={"offset": offset}, content=data)
+
+
+def test_chunked_upload_round_trip(client, project):
+    pid = project["id"]
+    url = _init(client, pid, path="sub/f.bin", size=10, sha256=hashlib.sha256(b"0123456789").hexdigest())
+    assert _put(client, url, 0, b"01234").json()["offset"] == 5
+    assert _put(client, url, 0, b"01234").status_code == 409   # stale offset
+    assert client.get(url).json()["offset"] == 5
+    assert _put(client, url, 5, b"56789").json()["offset"] == 10
+
+    r = client.post(url + "/complete")
+    assert r.status_code == 200
+    assert r.json()["sha256"] == hashlib.sha256(b"0123456789").hexdigest()
+    with open(os.path.join(project["root"], "sub", "f.bin"), "rb") as f:
+        assert f.read() == b"0123456789"
+    assert client.get(url).status_code == 404
+
+
+def test_rejected_chunk_leaves_offset_and_hash_intact(client, project):
+    pid = project["id"]
+    url = _init(client, pid, path="f.bin", size=10, sha256=hashlib.sha256(b"0123456789").hexdigest())
+    _put(client, url, 0, b"01234")
+    assert _put(client, url, 5, b"56789XYZ").status_code == 413   # past the declared size
+    assert client.get(url).json()["offset"] == 5
+    _put(client, url, 5, b"56789")
+    assert client.post(url + "/complete").status_code == 200
+
+
+def test_incomplete_and_mismatched_uploads_are_refused(client, project):
+    pid = project["id"]
+    url = _init(client, pid, path="f.bin", size=4)
+    _put(client, url, 0, b"ab")
+    assert client.post(url + "/complete").status_code == 409
+
+    url = _init(client, pid, path="g.bin", sha256="0" * 64)
+    _put(client, url, 0, b"data")
+    assert client.post(url + "/complete").status_code == 422
+    assert not os.path.exists(os.path.join(project["root"], "g.bin"))
+
+
+def test_abort_and_unknown_ids(client, project):
+    pid = project["id"]
+    url = _init(client, pid, path="f.bin")
+    _put(client, url, 0, b"abc")
+    assert client.delete(url).status_code == 200
+    assert client.get(url).status_code == 404
+    assert client.get(f"/projects/{pid}/files/uploads/not-an-id").status_code == 404
+    assert os.listdir(main.uploads_dir(pid)) == []
+
+
+def test_pending_uploads_count_against_quota(client, quota_project):
+    pid = quota_project["id"]
+    held = _init(client, pid, path="a.bin")
+    assert _put(client, held, 0, b"x" * 12).status_code == 200
+    other = _init(client, pid, path="b.bin")
+    assert _put(client, other, 0, b"y" * 14).status_code == 413   # 12 pending + 14 > 25
+    assert _put(client, other, 0, b"y" * 13).status_code == 200
+    assert client.post(held + "/complete").status_code == 200
+    # Declared sizes are checked up front.
+    assert client.post(f"/projects/{pid}/files/uploads", json={"path": "c.bin", "size": 26}).status_code == 413
+
+
+def test_overwrites_are_credited_with_the_replaced_size(client, quota_project):
+    pid = quota_project["id"]
+    for _ in range(4):
+        r = client.post(f"/projects/{pid}/files/upload", files={"file": ("f.bin", b"z" * 20)})
+        assert r.status_code == 200
+    assert main.workspace_usage(quota_project["root"]) == 20
+    r = client.post(f"/projects/{pid}/files/upload", files={"file": ("g.bin", b"z" * 6)})
+    assert r.status_code == 413
+    assert not os.path.exists(os.path.join(quota_project["root"], "g.bin"))